@@ -1,33 +1,88 @@
 # app.py
 
-import sys
 import streamlit as st
 import pandas as pd
-import io # Mantenuto per ExcelWriter
 import numpy as np
-import base64
-import os
-from pathlib import Path
-from fpdf import FPDF, XPos, YPos
+# fpdf, pdfplumber, chardet e i motori Excel si caricano al primo uso (profiling.importa)
 
 # Importa le funzioni di LOGICA da core_logic
-from core_logic import SolverA3, estrai_dati_bolla_reale
+from core_logic import (
+    risolvi_a3, risolvi_a3_min_righe,
+    estrai_dati_bolla_da_bytes, estrai_bolle_multiple, conta_pagine_pdf, PESO_SCALA
+)
 
 # Importa le funzioni di STILE e UTILITY da styles.py
 from styles import (
     apply_custom_css, 
+    load_static_assets,
     create_pdf_from_df,
-    prepare_data_entry_export
+    create_excel_from_df,
+    create_bulk_exports,
+    prepare_data_entry_export_da_risultato
 ) 
 
+# Esecuzione in background (solve + export, lettura dei file caricati)
+from jobs import (
+    BackgroundJob, JobPesante, JobIngestione, JobAnnullato, LimiteSuperato, get_process_pool,
+    risolvi_in_processo, stima_calcolo, MAX_RIGHE, MAX_PAGINE_PDF, BUDGET_MIN_RIGHE
+)
+
+# Profilazione opzionale delle sessioni (cProfile/tracemalloc + input anonimizzati)
+from profiling import profila, profiling_da_env, PROFILE_DIR, TEMPI_IMPORT
+
+# Ledger persistente delle disponibilità A3 tra dichiarazioni
+from ledger import LedgerA3, LedgerModificato, COLONNE_LETTURA
+
+
+@st.cache_resource(show_spinner=False)
+def get_ledger():
+    """Ledger A3 unico per processo, condiviso da tutte le sessioni."""
+    return LedgerA3()
+
+
+@st.cache_resource(show_spinner=False, max_entries=16)
+def risolvi_a3_condiviso(impronta_voci, impronta_partite, percorso, motore, _voci_df_solver, _partite_df_solver, _on_progress=None, _profilo=False):
+    """
+    Risoluzione condivisa da tutte le sessioni: a parità di voci/partite il
+    RisultatoA3 (immutabile) viene calcolato una volta e non duplicato per utente.
+    La chiave di cache sono le impronte dell'intero contenuto delle tabelle
+    (data_utils.impronta_tabella), più percorso e motore: le tabelle e la callback
+    di avanzamento non vengono hashate da Streamlit.
+    percorso='flusso' usa la cascata a flusso (tabelle oltre MAX_CELLE_GRIGLIA) su un
+    processo worker (profilato lì, con `_profilo`): gli array del risultato tornano mappati in memoria, senza copie;
+    motore='min_righe' cerca un'allocazione con meno righe entro BUDGET_MIN_RIGHE.
+
+    Restituisce (RisultatoA3, statistiche del motore a righe minime o None).
+    """
+    if percorso == "flusso":
+        return risolvi_in_processo(_voci_df_solver, _partite_df_solver, percorso, motore, _on_progress, _profilo)
+    if motore == "min_righe":
+        return risolvi_a3_min_righe(
+            _voci_df_solver, _partite_df_solver, budget_secondi=BUDGET_MIN_RIGHE, on_progress=_on_progress
+        )
+    return risolvi_a3(_voci_df_solver, _partite_df_solver, _on_progress), None
+
 # Importa le funzioni di DATA da data_utils.py
 from data_utils import (
-    _normalize,
     # extract_m2_classic_data è stata rimossa perché obsoleta
-    read_excel_or_csv,
-    select_three_columns
+    filtra_righe,
+    applica_diff_editor,
+    IndiceQuadratura,
+    GRUPPI_VOCI,
+    GRUPPI_PARTITE,
+    diagnosi_quadratura,
+    prepara_dati_solver,
+    hash_contenuto,
+    impronta_tabella,
+    leggi_a3_in_cache,
+    leggi_a3_multipli_in_cache
 )
 
+def profiling_attivo():
+    """Profilazione attiva da variabile d'ambiente (EASYM2_PROFILE=1) o da URL (?profile=1)."""
+    return profiling_da_env() or st.query_params.get("profile") == "1"
+
+
 # FUNZIONE DI ORCHESTRAZIONE (CONTROLLER) - LOGICA UNIFICATA
 def run_processing(): 
     """
@@ -36,133 +91,325 @@ def run_processing():
     
     Restituisce 4 valori: (msg, df_risultato, residui, opzione_processing).
     """
-    
-    # 1. Prepara VOCI dall'editor
-    try:
-        voci_df_editor = st.session_state.voci_final_data.copy()
-        
-        # Mappa dai nomi visualizzati (es. 'Colli') ai nomi interni del solver (es. 'colli')
-        voci_df_solver = voci_df_editor.rename(columns={
-            "Voce Doganale": "nome",
-            "Colli": "colli",
-            "Peso lordo": "peso"
-        }).copy()
-        
-        voci_df_solver["nome"] = voci_df_solver["nome"].astype(str).str.strip()
-        voci_df_solver["colli"] = pd.to_numeric(voci_df_solver["colli"], errors="coerce").fillna(0)
-        voci_df_solver["peso"] = pd.to_numeric(voci_df_solver["peso"], errors="coerce").fillna(0)
-        
-    except Exception as e:
-        return f"Errore during la preparazione delle Voci H1: {e}", None, None, None
+    with profila("run_processing", profiling_attivo()) as snapshot:
+        snapshot["voci_editor"] = st.session_state.voci_final_data
+        snapshot["partite_editor"] = st.session_state.partite_final_data
+        report_msg, voci_df_solver, partite_df_solver = _prepara_dati_calcolo()
+    if voci_df_solver is None:
+        return report_msg, None, None, None
 
+    # Controllo di ammissione: oltre i limiti si rifiuta o si passa al percorso a flusso
+    stima = stima_calcolo(len(voci_df_solver), len(partite_df_solver))
+    if stima["rifiutato"]:
+        return f"Errore: calcolo troppo grande ({stima['rifiutato']}).", None, None, None
 
-    # 2. Prepara PARTITE A3 dall'editor
-    try:
-        partite_df_editor = st.session_state.partite_final_data.copy()
-        
-        cols_editor = partite_df_editor.columns
-        
-        # Modo Avanzato: (Partita A3/MRN E Contenitore sono presenti E sono diversi)
-        is_avanzato = (
-            'Contenitore' in cols_editor and 
-            'Partita A3/MRN' in cols_editor and
-            not partite_df_editor.empty and 
-            (partite_df_editor['Partita A3/MRN'] != partite_df_editor['Contenitore']).any()
+    # 3. Flusso di Elaborazione UNIFICATO (Sempre SolverA3), in BACKGROUND
+    # Solving ed export girano su un thread worker: la sessione resta
+    # utilizzabile durante il calcolo e l'operatore può annullarlo.
+    # I calcoli a flusso (sopra soglia) vanno in coda sul worker dedicato.
+    # (Fuori dal blocco profilato: il job ha il suo profilo "calcolo_export")
+    classe_job = JobPesante if stima["percorso"] == "flusso" else BackgroundJob
+    motore = "min_righe" if st.session_state.get("min_righe") else "cascata"
+    st.session_state.job_calcolo = classe_job(
+        esegui_calcolo_m2, voci_df_solver, partite_df_solver, report_msg,
+        percorso=stima["percorso"], motore=motore, profilo=profiling_attivo()
+    )
+    st.session_state.job_esito = None
+
+    # Ritorniamo sempre 'singolo_h1' per attivare la visualizzazione della griglia
+    return report_msg, voci_df_solver, None, 'singolo_h1'
+
+
+def _prepara_dati_calcolo():
+    """Dati degli editor -> tabelle del solver (vedi data_utils.prepara_dati_solver)."""
+    return prepara_dati_solver(
+        st.session_state.voci_final_data,
+        st.session_state.partite_final_data,
+        ledger=get_ledger() if st.session_state.get("usa_ledger") else None
+    )
+
+
+def esegui_calcolo_m2(job, voci_df_solver, partite_df_solver, report_msg, percorso="denso", motore="cascata", profilo=False):
+    """
+    Stadi di SOLVING ed EXPORT, eseguiti su un thread worker (vedi jobs.BackgroundJob).
+    Non legge né scrive st.session_state: restituisce il dizionario dei risultati.
+    Con `profilo` il calcolo viene profilato e gli input salvati (anonimizzati) per la riesecuzione.
+    """
+    with profila("calcolo_export", profilo) as snapshot:
+        snapshot["voci"] = voci_df_solver
+        snapshot["partite"] = partite_df_solver
+        return _calcola_ed_esporta(job, voci_df_solver, partite_df_solver, report_msg, percorso, motore, profilo)
+
+
+def _calcola_ed_esporta(job, voci_df_solver, partite_df_solver, report_msg, percorso, motore, profilo=False):
+    if percorso == "flusso":
+        fase = "Calcolo SolverA3 (a flusso)"
+    elif motore == "min_righe":
+        fase = "Calcolo SolverA3 (ricerca righe minime)"
+    else:
+        fase = "Calcolo SolverA3"
+    job.report(
+        fase,
+        voci=0, voci_totali=len(voci_df_solver),
+        partite=0, partite_totali=len(partite_df_solver)
+    )
+
+    def on_progress(voci_processate, partite_consumate):
+        job.report(voci=voci_processate, partite=partite_consumate)
+        job.check_cancel()
+        job.check_tempo()
+
+    # Cascata SolverA3 (garantisce la quadratura); risultato immutabile e condiviso
+    risultato, statistiche = risolvi_a3_condiviso(
+        impronta_tabella(voci_df_solver), impronta_tabella(partite_df_solver), percorso, motore,
+        voci_df_solver, partite_df_solver, on_progress, profilo
+    )
+    if statistiche is not None:
+        report_msg += (
+            f" Righe M2: {statistiche['righe']} (cascata: {statistiche['righe_cascata']})."
         )
 
-        if is_avanzato:
-             # MODO AVANZATO (MRN)
-             rename_map = {
-                'Partita A3/MRN': 'nome', 
-                'Peso lordo': 'peso', 
-                'Colli': 'colli',
-                'Contenitore': 'Contenitore'
-             }
-             column_list = ['nome', 'colli', 'peso', 'Contenitore']
-             
-             if 'MRN-S' in cols_editor:
-                rename_map['MRN-S'] = 'MRN-S'
-                column_list.append('MRN-S')
-
-             partite_df_solver = partite_df_editor.rename(columns=rename_map)[column_list].copy()
-             report_msg = "Allocazione completata con criterio **Avanzato (MRN)**."
-
-        elif 'Partita A3/MRN' in cols_editor:
-             # MODO CLASSICO (Container)
-             rename_map = {
-                'Partita A3/MRN': 'nome', 
-                'Peso lordo': 'peso', 
-                'Colli': 'colli',
-             }
-             partite_df_solver = partite_df_editor.rename(columns=rename_map).copy()
-             partite_df_solver['Contenitore'] = partite_df_solver['nome'] 
-             partite_df_solver['MRN-S'] = None
-             report_msg = "Allocazione completata con criterio **Classico (Container)**."
-        
+    # Export (formato lungo, PDF ed Excel) calcolati una sola volta, non a ogni rerun
+    job.report("Preparazione export")
+    df_export_long = prepare_data_entry_export_da_risultato(risultato)
+    job.check_cancel()
+
+    job.report("Generazione PDF")
+    pdf_output = create_pdf_from_df(df_export_long)
+    job.check_cancel()
+
+    job.report("Generazione Excel")
+    excel_output = create_excel_from_df(df_export_long)
+    job.check_cancel()
+
+    # CSV / JSON Lines / Parquet per il caricamento massivo (senza rileggere l'Excel)
+    job.report("Generazione export bulk")
+    export_bulk = create_bulk_exports(df_export_long)
+
+    return {
+        "risultato": risultato,
+        "voci_attuali": risultato.voci_attuali(),
+        "partite_attuali": risultato.partite_attuali(),
+        "df_export_long": df_export_long,
+        "pdf_output": pdf_output,
+        "excel_output": excel_output,
+        "export_bulk": export_bulk,
+        "report_message": report_msg,
+        # Scarico registrabile solo se le disponibilità sono state lette dal ledger
+        "da_ledger": set(COLONNE_LETTURA) <= set(partite_df_solver.columns)
+    }
+
+
+@st.fragment(run_every=1.0)
+def mostra_avanzamento_calcolo():
+    """
+    Mostra l'avanzamento del job di calcolo (aggiornato ogni secondo) con il
+    pulsante di annullamento. A job concluso salva i risultati e rilancia l'app.
+    """
+    job = st.session_state.get("job_calcolo")
+    if job is None:
+        return
+
+    if job.done():
+        st.session_state.job_calcolo = None
+        try:
+            risultati = job.result()
+        except JobAnnullato:
+            st.session_state.job_esito = "Calcolo annullato dall'operatore."
+            st.session_state.risultati = None
+        except LimiteSuperato as e:
+            st.session_state.job_esito = f"Calcolo interrotto: {e}."
+            st.session_state.risultati = None
+        except Exception as e:
+            st.session_state.job_esito = f"Errore critico during il calcolo SolverA3: {e}"
+            st.session_state.risultati = None
         else:
-            return "Errore: Dati A3 non validi. Colonne 'Partita A3/MRN' non trovata.", None, None, None
+            st.session_state.risultati = risultati
+            # Salva il messaggio di successo nello stato
+            st.session_state.report_message = risultati["report_message"]
+        st.rerun()
 
-        
-        # Pulizia valori (comune a entrambi i percorsi)
-        partite_df_solver['nome'] = partite_df_solver['nome'].astype(str).str.strip().str.upper()
-        partite_df_solver['Contenitore'] = partite_df_solver['Contenitore'].astype(str).str.strip().str.upper()
-        partite_df_solver['colli'] = pd.to_numeric(partite_df_solver['colli'], errors='coerce')
-        partite_df_solver['peso'] = pd.to_numeric(partite_df_solver['peso'], errors='coerce')
-        if 'MRN-S' in partite_df_solver.columns:
-            partite_df_solver['MRN-S'] = partite_df_solver['MRN-S'].astype(str).str.strip()
-
-        # Filtra righe non valide
-        partite_df_solver = partite_df_solver.dropna(subset=['nome', 'colli', 'peso', 'Contenitore'])
-        partite_df_solver = partite_df_solver[
-            (partite_df_solver['colli'] > 0) | (partite_df_solver['peso'] > 0)
-        ]
-        
-        if 'MRN-S' not in partite_df_solver.columns:
-            partite_df_solver['MRN-S'] = None
-        
-        if partite_df_solver.empty:
-            return "Errore: Nessuna riga A3 valida trovata nei dati (colli/peso > 0).", None, None, None
-            
-    except Exception as e:
-        return f"Errore during l'analisi e preparazione dei dati A3: {e}", None, None, None
+    stage, progress = job.snapshot()
+    voci_tot = progress.get("voci_totali", 0)
+    frazione = progress.get("voci", 0) / voci_tot if voci_tot else 0.0
+    st.progress(
+        min(frazione, 1.0),
+        text=(
+            f"{stage} – voci {progress.get('voci', 0)}/{voci_tot}, "
+            f"partite consumate {progress.get('partite', 0)}/{progress.get('partite_totali', 0)} "
+            f"({job.elapsed():.0f} s)"
+        )
+    )
+    if job.cancelled:
+        st.caption("Annullamento in corso...")
+    elif st.button("✖ Annulla calcolo", key="annulla_calcolo", type="secondary"):
+        job.cancel()
 
 
-    # 3. Flusso di Elaborazione UNIFICATO (Sempre SolverA3)
+# --- LETTURA DEI FILE IN BACKGROUND (parte appena arriva l'upload) ---
+# Bolle e A3 vengono lette su worker (JobIngestione), non durante il rerun:
+# le due letture si sovrappongono tra loro e alla revisione dell'operatore,
+# e gli editor si riempiono quando il risultato è pronto.
+
+def _estrai_bolla_su_pool(contenuto, profilo=False):
+    """Una bolla su un processo worker (non contende il GIL con la lettura A3)."""
     try:
-        # Esegui il SolverA3 (garantisce la quadratura)
-        solver = SolverA3(voci_df_solver, partite_df_solver) 
-        griglia_colli, griglia_peso = solver.risolvi()
-
-        # Popola lo stato di sessione con i risultati
-        voci_att = pd.DataFrame({
-            "Colli Allocati": griglia_colli.sum(axis=1),
-            "Peso Allocato": griglia_peso.sum(axis=1),
-            "Colli Attesi": solver.voci["colli"],
-            "Peso Atteso": solver.voci["peso"]
-        })
-        part_att = pd.DataFrame({
-            "Colli Allocati": griglia_colli.sum(axis=0),
-            "Peso Allocato": griglia_peso.sum(axis=0),
-            "Colli Attesi": solver.partite["colli"],
-            "Peso Atteso": solver.partite["peso"]
-        })
-        
-        st.session_state.risultati = {
-            "griglia_colli": griglia_colli,
-            "griglia_peso": griglia_peso,
-            "voci_attuali": voci_att,
-            "partite_attuali": part_att
-        }
-        st.session_state.solver = solver 
-        
-        # Salva il messaggio di successo nello stato
-        st.session_state.report_message = report_msg 
+        return get_process_pool().submit(estrai_dati_bolla_da_bytes, contenuto, profilo).result()
+    except Exception:
+        return estrai_dati_bolla_da_bytes(contenuto, profilo) # Pool non disponibile: estrazione locale
 
-        # Ritorniamo sempre 'singolo_h1' per attivare la visualizzazione della griglia
-        return report_msg, voci_df_solver.copy(), None, 'singolo_h1'
-    
-    except Exception as e:
-        return f"Errore critico during il calcolo SolverA3: {e}", None, None, None
+
+def ingerisci_bolle(job, files, profilo=False):
+    """
+    Voci dalle bolle PDF [(nome, bytes), ...]. Non tocca st.session_state.
+    Oltre MAX_PAGINE_PDF pagine in totale solleva LimiteSuperato (prima di estrarre).
+    """
+    job.report("Controllo delle pagine")
+    pagine_pdf = 0
+    for _, contenuto in files:
+        job.check_cancel()
+        pagine_pdf += conta_pagine_pdf(contenuto)
+    if pagine_pdf > MAX_PAGINE_PDF:
+        raise LimiteSuperato(
+            f"{pagine_pdf} pagine da analizzare, oltre il limite di {MAX_PAGINE_PDF}: carica meno bolle alla volta"
+        )
+
+    job.report("Estrazione dal PDF" if len(files) == 1 else f"Estrazione da {len(files)} PDF")
+    # Profili "upload_pdf" registrati nei processi che estraggono (qui si aspetta soltanto)
+    if len(files) == 1:
+        voci_df, senza_voci = _estrai_bolla_su_pool(files[0][1], profilo), []
+    else:
+        # Più bolle per la stessa spedizione: estrazione concorrente
+        # su processi worker, voci in ordine di file (colonna 'Bolla')
+        voci_df, senza_voci = estrai_bolle_multiple(files, executor=get_process_pool(), profilo=profilo)
+    return voci_df, senza_voci
+
+
+def ingerisci_a3(job, firma, files, profilo=False):
+    """Partite dai file A3 [(nome, bytes), ...] con la loro firma. Non tocca st.session_state."""
+    job.report("Lettura A3" if len(files) == 1 else f"Lettura di {len(files)} file A3")
+    # Profili "upload_a3" registrati dove avviene la lettura (anche nei processi worker)
+    if len(files) == 1:
+        (nome_a3, contenuto_a3), (_, impronta_a3) = files[0], firma[0]
+        df3 = leggi_a3_in_cache(impronta_a3, nome_a3, contenuto_a3, profilo) # RICONOSCIMENTO AUTOMATICO
+        esito_unione, illeggibili = None, []
+    else:
+        # Più file A3 (es. uno per container/spedizioniere): parsing in parallelo
+        # su processi worker, poi unione tramite indice MRN/MRN-S/Contenitore
+        df3, esito_unione, illeggibili = leggi_a3_multipli_in_cache(
+            firma, files, _executor=get_process_pool(), _profilo=profilo
+        )
+    return df3, esito_unione, illeggibili
+
+
+def applica_bolle(risultato):
+    """Voci estratte -> editor voci. Restituisce i messaggi da mostrare [(livello, testo)]."""
+    voci_df, senza_voci = risultato
+    esiti = []
+    if senza_voci:
+        esiti.append(("warning", f"⚠️ Nessuna voce trovata in: {', '.join(senza_voci)}"))
+    if voci_df.empty:
+        esiti.append(("warning", "Nessuna voce trovata nel PDF."))
+        return esiti
+
+    # Mappa 'Voce' -> 'Voce Doganale' e altri
+    vmap_pdf = {}
+    for c in voci_df.columns:
+        cl = str(c).strip().lower()
+        if ("voce" in cl) or ("taric" in cl):
+            vmap_pdf[c] = "Voce Doganale"
+        if "colli" in cl:
+            vmap_pdf[c] = "Colli"
+        if "peso" in cl:
+            vmap_pdf[c] = "Peso lordo"
+    st.session_state.voci_data_source = voci_df.rename(columns=vmap_pdf)
+    reset_editor("editor_voci")
+    st.session_state.passa_a_tab_a3 = True
+
+    esiti.append(("success", f"✅ {len(voci_df)} voci estratte."))
+    return esiti
+
+
+def applica_a3(risultato):
+    """Partite lette -> editor partite. Restituisce i messaggi da mostrare [(livello, testo)]."""
+    df3, esito_unione, illeggibili = risultato
+    esiti = []
+    if illeggibili:
+        esiti.append(("warning", f"⚠️ File non letti: {', '.join(illeggibili)}"))
+    if esito_unione is None and df3.empty:
+        esiti.append(("warning", "⚠️ Impossibile leggere il file caricato. Verifica il formato (.xls/.xlsx/.csv)."))
+        return esiti
+    if len(df3) > MAX_RIGHE:
+        esiti.append(("error", f"⛔ {len(df3):,} partite, oltre il limite di {MAX_RIGHE:,} righe: file non caricato."))
+        return esiti
+    if df3.empty:
+        return esiti
+
+    # (copia propria della sessione: cache_data non condivide l'oggetto)
+    st.session_state.partite_data_source = df3
+    reset_editor("editor_partite")
+
+    if esito_unione is None:
+        esiti.append(("success", f"✅ {len(df3)} partite importate."))
+        return esiti
+    esiti.append(("success", f"✅ {len(df3)} partite importate da {len(st.session_state.firma_a3_caricata) - len(illeggibili)} file."))
+    if esito_unione["duplicati"]:
+        esiti.append(("info", f"{esito_unione['duplicati']} righe duplicate tra file diversi scartate."))
+    if esito_unione["conflitti"]:
+        esiti.append((
+            "warning",
+            f"⚠️ {len(esito_unione['conflitti'])} partite presenti in più file con colli/peso diversi: "
+            "verifica le righe (colonna 'File A3')."
+        ))
+    return esiti
+
+
+def avvia_ingestione(chiave_job, fn, *args, esiti=None):
+    """
+    Scarta la lettura precedente (e i suoi messaggi) e, se c'è una funzione,
+    avvia subito quella dei nuovi file. `esiti` sostituisce i messaggi (es. file rifiutati).
+    """
+    job = st.session_state.get(chiave_job)
+    if job is not None:
+        job.cancel()
+    st.session_state[chiave_job] = JobIngestione(fn, *args, profilo=profiling_attivo()) if fn else None
+    st.session_state[f"{chiave_job}_esiti"] = esiti or []
+
+
+@st.fragment(run_every=0.5)
+def mostra_ingestione(chiave_job, applica):
+    """
+    Stato della lettura in background `chiave_job` (aggiornato ogni mezzo secondo).
+    A lettura conclusa applica il risultato alla sessione e rilancia l'app,
+    così l'editor mostra i dati appena letti.
+    """
+    job = st.session_state.get(chiave_job)
+    if job is None:
+        return
+
+    if job.done():
+        st.session_state[chiave_job] = None
+        try:
+            st.session_state[f"{chiave_job}_esiti"] = applica(job.result())
+        except JobAnnullato:
+            pass
+        except LimiteSuperato as e:
+            st.session_state[f"{chiave_job}_esiti"] = [("error", f"⛔ {e}.")]
+        except Exception as e:
+            st.session_state[f"{chiave_job}_esiti"] = [("error", f"Errore durante la lettura del file: {e}")]
+        st.rerun()
+
+    stage, _ = job.snapshot()
+    st.caption(f"⏳ {stage}... ({job.elapsed():.0f} s)")
+
+
+def mostra_esiti_ingestione(chiave_job, applica):
+    """Avanzamento della lettura in corso oppure i messaggi dell'ultima lettura."""
+    if st.session_state.get(chiave_job) is not None:
+        mostra_ingestione(chiave_job, applica)
+        return
+    for livello, testo in st.session_state.get(f"{chiave_job}_esiti", []):
+        getattr(st, livello)(testo)
 
 
 # --- CONFIGURAZIONE BASE ---
@@ -177,19 +424,9 @@ st.set_page_config(
 apply_custom_css()
 
 # --- LOGO IN ALTO A SINISTRA ---
-BASE_DIR = os.path.dirname(__file__)
-# CORREZIONE: Il file fornito è .jpg, non .png
-LOGO_FILENAME = "LOGO_EASYM2.png" 
-LOGO_PATH = os.path.join(BASE_DIR, LOGO_FILENAME)
-mime_type = "image/jpeg" # CORREZIONE: Mime type per jpg
-
-img_tag = '<span style="font-size:2rem;">📦</span>'
-try:
-    with open(LOGO_PATH, "rb") as image_file:
-        LOGO_BASE64_STRING = base64.b64encode(image_file.read()).decode()
-        img_tag = f'<img src="data:{mime_type};base64,{LOGO_BASE64_STRING}" style="height:auto; max-height:80px; width:auto;">'
-except FileNotFoundError:
-    pass
+# Logo e template arrivano dalla cache di processo (caricati una volta sola)
+STATIC_ASSETS = load_static_assets()
+img_tag = STATIC_ASSETS["logo_img_tag"]
 
 st.markdown(
     f"""
@@ -201,13 +438,7 @@ st.markdown(
 )
 
 # --- LOAD TEMPLATE FILE ---
-TEMPLATE_FILENAME = "EASYM2_A3_TEMPLATE.xlsx"
-TEMPLATE_PATH = os.path.join(BASE_DIR, TEMPLATE_FILENAME)
-try:
-    with open(TEMPLATE_PATH, "rb") as f:
-        TEMPLATE_BYTES = f.read()
-except FileNotFoundError:
-    TEMPLATE_BYTES = None 
+TEMPLATE_BYTES = STATIC_ASSETS["template_bytes"]
 
 # --- SESSION STATE ---
 # Standardizza i dati di default per matchare le colonne caricate
@@ -225,6 +456,8 @@ if "partite_data_source" not in st.session_state:
     
 if "risultati" not in st.session_state:
     st.session_state.risultati = None
+if "job_calcolo" not in st.session_state:
+    st.session_state.job_calcolo = None
 if "active_tab_key" not in st.session_state:
     st.session_state.active_tab_key = 0
 
@@ -241,6 +474,179 @@ def run_js_tab_switch(tab_index):
     st.components.v1.html(js_code, height=0)
 
 
+# --- EDITOR PER TABELLE GRANDI (vista paginata + modifiche per differenza) ---
+SOGLIA_TABELLA_GRANDE = 300 # Oltre queste righe l'editor mostra solo una pagina/filtro
+RIGHE_PER_PAGINA = 100
+
+def reset_editor(editor_key):
+    """Scarta lo stato del data_editor (es. dopo un nuovo upload)."""
+    if editor_key in st.session_state:
+        del st.session_state[editor_key]
+    versione_key = f"{editor_key}_versione"
+    st.session_state[versione_key] = st.session_state.get(versione_key, 0) + 1
+
+# Indice di quadratura (totali per gruppo) di ogni tabella master: chiave di sessione e gruppi
+INDICI_QUADRATURA = {
+    "voci_data_source": ("indice_quadratura_voci", GRUPPI_VOCI),
+    "partite_data_source": ("indice_quadratura_partite", GRUPPI_PARTITE),
+}
+
+def indice_quadratura(source_key, tabella):
+    """
+    IndiceQuadratura di `tabella`, ricostruito solo se la tabella è un'altra
+    (nuovo upload); le modifiche degli editor lo aggiornano in place, per differenza.
+    """
+    chiave, gruppi = INDICI_QUADRATURA[source_key]
+    indice = st.session_state.get(chiave)
+    if indice is None or indice.sorgente is not tabella:
+        indice = IndiceQuadratura(tabella, gruppi)
+        st.session_state[chiave] = indice
+    return indice
+
+def _salva_modifiche_vista(source_key, widget_key, editor_key, indice_vista):
+    """Callback: applica al master solo le righe toccate nella vista, poi rimonta l'editor."""
+    modifiche = st.session_state.get(widget_key)
+    if modifiche:
+        master = st.session_state[source_key]
+        indice = st.session_state.get(INDICI_QUADRATURA[source_key][0])
+        if indice is not None and indice.sorgente is not master:
+            indice = None # Indice di un'altra tabella: si ricostruisce alla verifica
+        st.session_state[source_key] = applica_diff_editor(master, indice_vista, modifiche, indice)
+    reset_editor(editor_key) # La vista riparte dal master aggiornato, senza riapplicare i diff
+
+def editor_tabella(source_key, editor_key, column_config):
+    """
+    data_editor sulla tabella master st.session_state[source_key].
+    - Tabelle piccole: editor sull'intera tabella.
+    - Tabelle grandi: filtro + paginazione; al browser va solo la pagina visibile.
+    In entrambi i casi le modifiche vengono applicate al master (e all'indice di
+    quadratura) come differenze di riga.
+    Restituisce la tabella da usare per verifica e calcolo.
+    """
+    master = st.session_state[source_key]
+
+    if not master.index.is_unique:
+        master = master.reset_index(drop=True)
+        st.session_state[source_key] = master
+    widget_key = f"{editor_key}_v{st.session_state.get(f'{editor_key}_versione', 0)}"
+
+    if len(master) <= SOGLIA_TABELLA_GRANDE:
+        st.data_editor(
+            master,
+            key=widget_key,
+            num_rows="dynamic",
+            height=240,
+            column_config=column_config,
+            on_change=_salva_modifiche_vista,
+            args=(source_key, widget_key, editor_key, list(master.index))
+        )
+        return st.session_state[source_key]
+
+    # Filtro testuale + pagina
+    col_filtro, col_pagina = st.columns([2, 1])
+    with col_filtro:
+        filtro = st.text_input(
+            "Filtra righe", key=f"{editor_key}_filtro",
+            placeholder="🔍 Filtra (voce, MRN, container...)", label_visibility="collapsed"
+        )
+    indice = master.index[filtra_righe(master, filtro)] if filtro else master.index
+
+    n_pagine = max(1, -(-len(indice) // RIGHE_PER_PAGINA))
+    pagina_key = f"{editor_key}_pagina"
+    if st.session_state.get(pagina_key, 1) > n_pagine:
+        st.session_state[pagina_key] = 1
+    with col_pagina:
+        pagina = st.number_input(
+            "Pagina", min_value=1, max_value=n_pagine, step=1,
+            key=pagina_key, label_visibility="collapsed"
+        )
+
+    inizio = (pagina - 1) * RIGHE_PER_PAGINA
+    indice_vista = indice[inizio:inizio + RIGHE_PER_PAGINA]
+
+    st.data_editor(
+        master.loc[indice_vista],
+        key=widget_key,
+        num_rows="dynamic",
+        height=240,
+        column_config=column_config,
+        on_change=_salva_modifiche_vista,
+        args=(source_key, widget_key, editor_key, list(indice_vista))
+    )
+    st.caption(
+        f"Righe {min(inizio + 1, len(indice))}–{inizio + len(indice_vista)} di {len(indice)} "
+        f"(pagina {pagina}/{n_pagine}, {len(master)} totali)"
+    )
+    return st.session_state[source_key]
+
+
+# --- VISUALIZZATORE RISULTATI (paginazione lato server) ---
+RIGHE_RISULTATI_PER_PAGINA = 200
+FILTRI_RISULTATI = {
+    "Voce Doganale (H1)": "Voce",
+    "Contenitore": "Container",
+    "Partita A3/MRN": "MRN"
+}
+
+@st.fragment
+def visualizza_risultati(df_export_long):
+    """
+    Mostra l'allocazione M2 in formato lungo con filtro (voce, container, MRN),
+    ordinamento e paginazione calcolati sul server: al browser arriva solo la
+    pagina visibile. È un fragment, quindi sfogliare non riesegue l'intera app.
+    """
+    if len(df_export_long) <= RIGHE_RISULTATI_PER_PAGINA:
+        st.dataframe(df_export_long, width="stretch", hide_index=True)
+        return
+
+    filtri = {c: etichetta for c, etichetta in FILTRI_RISULTATI.items() if c in df_export_long.columns}
+    colonne_ui = st.columns([1] * len(filtri) + [1.2, 0.8])
+
+    # 1. Filtri per colonna
+    maschera = np.ones(len(df_export_long), dtype=bool)
+    for col_ui, (colonna, etichetta) in zip(colonne_ui, filtri.items()):
+        with col_ui:
+            testo = st.text_input(
+                etichetta, key=f"filtro_ris_{etichetta}",
+                placeholder=f"🔍 {etichetta}", label_visibility="collapsed"
+            )
+        if testo:
+            maschera &= df_export_long[colonna].astype(str).str.contains(
+                testo, case=False, regex=False, na=False
+            ).to_numpy()
+    vista = df_export_long[maschera]
+
+    # 2. Ordinamento
+    with colonne_ui[-2]:
+        ordina_per = st.selectbox(
+            "Ordina per", ["(ordine M2)"] + list(df_export_long.columns),
+            key="ordina_risultati", label_visibility="collapsed"
+        )
+    if ordina_per != "(ordine M2)":
+        vista = vista.sort_values(by=ordina_per, kind="stable")
+
+    # 3. Pagina
+    n_pagine = max(1, -(-len(vista) // RIGHE_RISULTATI_PER_PAGINA))
+    if st.session_state.get("pagina_risultati", 1) > n_pagine:
+        st.session_state.pagina_risultati = 1
+    with colonne_ui[-1]:
+        pagina = st.number_input(
+            "Pagina", min_value=1, max_value=n_pagine, step=1,
+            key="pagina_risultati", label_visibility="collapsed"
+        )
+
+    inizio = (pagina - 1) * RIGHE_RISULTATI_PER_PAGINA
+    st.dataframe(
+        vista.iloc[inizio:inizio + RIGHE_RISULTATI_PER_PAGINA],
+        width="stretch",
+        hide_index=True
+    )
+    st.caption(
+        f"Righe {min(inizio + 1, len(vista))}–{min(inizio + RIGHE_RISULTATI_PER_PAGINA, len(vista))} "
+        f"di {len(vista)} (pagina {pagina}/{n_pagine}, {len(df_export_long)} totali)"
+    )
+
+
 # --- LAYOUT PRINCIPALE ---
 col_left, col_right = st.columns([1.2, 1.8], gap="medium")
 
@@ -254,45 +660,38 @@ with col_left:
     with tab_voci:
         c1, c2 = st.columns([1, 2]) 
         with c1:
-            pdf = st.file_uploader("Carica Bolla Doganale (PDF)", type="pdf", key="pdf_bolla")
-            if pdf:
-                with st.spinner("Estrazione dal PDF..."):
-                    
-                    # MODIFICA: la funzione ora ritorna solo 1 df
-                    voci_df = estrai_dati_bolla_reale(pdf) 
-                    
-                    if not voci_df.empty:
-                        
-                        # Mappa 'Voce' -> 'Voce Doganale' e altri
-                        vmap_pdf = {}
-                        for c in voci_df.columns:
-                            cl = str(c).strip().lower()
-                            if ("voce" in cl) or ("taric" in cl):
-                                vmap_pdf[c] = "Voce Doganale"
-                            if "colli" in cl:
-                                vmap_pdf[c] = "Colli"
-                            if "peso" in cl:
-                                vmap_pdf[c] = "Peso lordo"
-                        voci_df_mapped = voci_df.rename(columns=vmap_pdf)
-
-                        st.session_state.voci_data_source = voci_df_mapped.copy() 
-                        
-                        if 'editor_voci' in st.session_state:
-                            del st.session_state.editor_voci
-                        
-                        st.success(f"✅ {len(voci_df)} voci estratte.")
-                        run_js_tab_switch(1) 
-                    else:
-                        st.warning("Nessuna voce trovata nel PDF.")
+            pdf_files = st.file_uploader(
+                "Carica Bolla Doganale (PDF)", type="pdf", key="pdf_bolla",
+                accept_multiple_files=True
+            )
+
+            # Lettura avviata SOLO quando arrivano file diversi (impronta del contenuto):
+            # i rerun successivi non rileggono la bolla e non azzerano le modifiche nell'editor
+            if pdf_files:
+                contenuti_pdf = [(f.name, f.getvalue()) for f in pdf_files]
+                firma_pdf = tuple((nome, hash_contenuto(contenuto)) for nome, contenuto in contenuti_pdf)
+            else:
+                firma_pdf = None
+
+            if firma_pdf is not None and firma_pdf != st.session_state.get("firma_pdf_caricata"):
+                st.session_state.firma_pdf_caricata = firma_pdf
+                # Anche il limite di pagine si controlla sul worker (il rerun non apre i PDF)
+                avvia_ingestione("job_bolle", ingerisci_bolle, contenuti_pdf)
+            elif firma_pdf is None and st.session_state.get("firma_pdf_caricata") is not None:
+                # Uploader svuotato: la stessa bolla, se ricaricata, verrà letta di nuovo
+                st.session_state.firma_pdf_caricata = None
+                avvia_ingestione("job_bolle", None)
+
+            mostra_esiti_ingestione("job_bolle", applica_bolle)
+            if st.session_state.pop("passa_a_tab_a3", False):
+                run_js_tab_switch(1)
         with c2:
             st.caption("Verifica e modifica i dati estratti:")
             
-            voci_data_edited = st.data_editor(
-                st.session_state.voci_data_source,
-                key="editor_voci", 
-                num_rows="dynamic",
-                height=240,
-                column_config={
+            voci_data_edited = editor_tabella(
+                "voci_data_source",
+                "editor_voci",
+                {
                     "Voce Doganale": st.column_config.TextColumn(width=200), # Larghezza fissa in px
                     "Colli": st.column_config.NumberColumn(width=80, format="%d"),
                     "Peso lordo": st.column_config.NumberColumn(width=100, format="%.3f")
@@ -304,7 +703,10 @@ with col_left:
     with tab_a3:
         c1, c2 = st.columns([1, 2])
         with c1:
-            excel_a3_file = st.file_uploader("Carica A3 (Excel/CSV)", type=["xlsx", "xls", "csv"], key="excel_a3")
+            excel_a3_files = st.file_uploader(
+                "Carica A3 (Excel/CSV)", type=["xlsx", "xls", "csv"], key="excel_a3",
+                accept_multiple_files=True
+            )
             
             if TEMPLATE_BYTES:
                 st.download_button(
@@ -320,18 +722,33 @@ with col_left:
                 if 'TEMPLATE_BYTES' in locals():
                     st.warning("File template non trovato.")
 
-            if excel_a3_file:
-                df_in = read_excel_or_csv(excel_a3_file, just_read=False) 
-                if not df_in.empty:
-                    df3 = select_three_columns(df_in) # Usa il RICONOSCIMENTO AUTOMATICO
-                    if not df3.empty:
-                         st.session_state.partite_data_source = df3.copy()
-                         
-                         if 'editor_partite' in st.session_state:
-                             del st.session_state.editor_partite
-                             
-                         st.success(f"✅ {len(df3)} partite importate.")
-                             
+            # Ledger A3: riparte dai residui delle dichiarazioni precedenti
+            st.toggle(
+                "Usa residui ledger A3",
+                key="usa_ledger",
+                help="Per le partite già scaricate in M2 precedenti usa colli/peso residui registrati, invece dei valori del file."
+            )
+            if st.session_state.usa_ledger:
+                st.caption(f"📒 {len(get_ledger())} partite nel ledger.")
+
+            # Nuova ingestione SOLO quando arrivano file diversi (impronta del contenuto):
+            # i rerun successivi non rileggono il file e non azzerano le modifiche nell'editor
+            if excel_a3_files:
+                contenuti_a3 = [(f.name, f.getvalue()) for f in excel_a3_files]
+                firma_a3 = tuple((nome, hash_contenuto(contenuto)) for nome, contenuto in contenuti_a3)
+            else:
+                firma_a3 = None
+
+            if firma_a3 is not None and firma_a3 != st.session_state.get("firma_a3_caricata"):
+                st.session_state.firma_a3_caricata = firma_a3
+                avvia_ingestione("job_a3", ingerisci_a3, firma_a3, contenuti_a3)
+            elif firma_a3 is None and st.session_state.get("firma_a3_caricata") is not None:
+                # Uploader svuotato: lo stesso file, se ricaricato, verrà importato di nuovo
+                st.session_state.firma_a3_caricata = None
+                avvia_ingestione("job_a3", None)
+
+            mostra_esiti_ingestione("job_a3", applica_a3)
+
         with c2:
             st.caption("Controlla/modifica i dati caricati:")
 
@@ -349,12 +766,10 @@ with col_left:
                     width=80, format="%d"
                 ) # Larghezza fissa in px
             
-            partite_data_edited = st.data_editor(
-                st.session_state.partite_data_source,
-                key="editor_partite",
-                num_rows="dynamic",
-                height=240,
-                column_config=partite_config 
+            partite_data_edited = editor_tabella(
+                "partite_data_source",
+                "editor_partite",
+                partite_config
             )
             st.session_state.partite_final_data = partite_data_edited
 
@@ -362,26 +777,19 @@ with col_left:
     st.markdown("---") # Separatore visivo
     st.caption("VERIFICA TOTALI (H1 vs A3)")
     
+    diagnosi = None
     try:
         voci_data = st.session_state.get('voci_final_data', default_voci)
         partite_data = st.session_state.get('partite_final_data', default_partite)
-        
-        if not voci_data.empty and 'Colli' in voci_data.columns and 'Peso lordo' in voci_data.columns:
-            voci_colli_tot = pd.to_numeric(voci_data['Colli'], errors='coerce').sum()
-            voci_peso_tot = pd.to_numeric(voci_data['Peso lordo'], errors='coerce').sum()
-        else:
-            voci_colli_tot = 0.0
-            voci_peso_tot = 0.0
 
-        if not partite_data.empty and 'Colli' in partite_data.columns and 'Peso lordo' in partite_data.columns:
-            part_colli_tot = pd.to_numeric(partite_data['Colli'], errors='coerce').sum()
-            part_peso_tot = pd.to_numeric(partite_data['Peso lordo'], errors='coerce').sum()
-        else:
-            part_colli_tot = 0.0
-            part_peso_tot = 0.0
+        # Totali mantenuti per differenza (O(righe modificate)), non ricalcolati a ogni rerun
+        indice_voci = indice_quadratura("voci_data_source", voci_data)
+        indice_partite = indice_quadratura("partite_data_source", partite_data)
+        voci_colli_tot, voci_peso_tot = indice_voci.colli, indice_voci.peso
+        part_colli_tot, part_peso_tot = indice_partite.colli, indice_partite.peso
 
-        diff_colli = round(voci_colli_tot - part_colli_tot, 0)
-        diff_peso = round(voci_peso_tot - part_peso_tot, 3) 
+        diff_colli = voci_colli_tot - part_colli_tot
+        diff_peso = round((indice_voci.peso_g - indice_partite.peso_g) / PESO_SCALA, 3)
 
         is_match_colli = (diff_colli == 0)
         is_match_peso = (diff_peso == 0) 
@@ -396,6 +804,9 @@ with col_left:
         colli_icon = "✅" if is_match_colli else "❌"
         peso_icon = "✅" if is_match_peso else "❌"
 
+        if not totals_are_zero:
+            diagnosi = diagnosi_quadratura(indice_voci, indice_partite)
+
     except Exception as e: 
         is_disabled = True
         diff_colli = 0.0
@@ -408,6 +819,15 @@ with col_left:
         st.error(f"Errore nella verifica: {e}") 
 
     
+    # Un solo calcolo per sessione alla volta, e non su dati ancora in lettura
+    job_in_corso = st.session_state.job_calcolo is not None
+    lettura_in_corso = any(st.session_state.get(k) is not None for k in ("job_bolle", "job_a3"))
+
+    # Stima delle risorse PRIMA del calcolo (righe degli editor: limite superiore)
+    stima = stima_calcolo(len(st.session_state.voci_final_data), len(st.session_state.partite_final_data))
+    if stima["rifiutato"]:
+        is_disabled = True
+
     # --- Interfaccia di verifica con 3 colonne ---
     check_col1, check_col2, check_col3 = st.columns([0.8, 1, 1])
 
@@ -432,14 +852,48 @@ with col_left:
             type="primary", 
             width="stretch", 
             key="main_calcola_m2",
-            disabled=is_disabled 
+            disabled=is_disabled or job_in_corso or lettura_in_corso
         )
     
-    if is_disabled:
+    if lettura_in_corso:
+        st.info("Lettura dei file caricati in corso: il calcolo si abilita quando gli editor sono aggiornati.")
+    elif is_disabled and not stima["rifiutato"]:
         if totals_are_zero and is_match_colli and is_match_peso:
             st.info("Carica i dati o inserisci valori per abilitare il calcolo.")
         else:
             st.warning("⚠️ I totali non coincidono. Correggi i dati negli editor per abilitare il calcolo.")
+
+    # Gruppi/righe da controllare (usa il filtro dell'editor per trovarli)
+    if diagnosi is not None and not diagnosi.empty:
+        with st.expander(f"🔎 Dove cercare ({len(diagnosi)})", expanded=is_disabled):
+            st.dataframe(diagnosi, width="stretch", hide_index=True)
+    elif is_disabled and not totals_are_zero and not (is_match_colli and is_match_peso):
+        st.caption("Nessun contenitore/MRN/voce spiega da solo la differenza: controlla i valori riga per riga.")
+
+    if stima["rifiutato"]:
+        st.error(f"⛔ Calcolo troppo grande: {stima['rifiutato']}.")
+    else:
+        st.caption(
+            f"Stima: {stima['voci']:,} voci × {stima['partite']:,} partite, "
+            f"~{stima['memoria_mb']:,.1f} MB, ~{stima['secondi']:,.1f} s"
+            + (" · calcolo a flusso, in coda sul worker dedicato" if stima["percorso"] == "flusso" else "")
+        )
+
+    # Motore alternativo: meno righe di data entry, stessa quadratura (non sul percorso a flusso)
+    st.toggle(
+        "Minimizza righe M2",
+        key="min_righe",
+        disabled=stima["percorso"] == "flusso",
+        help=(
+            f"Cerca per max {BUDGET_MIN_RIGHE} s un'allocazione con meno coppie voce/partita "
+            "(meno righe da inserire). Se non la trova usa la cascata classica."
+        )
+    )
+
+    if profiling_attivo():
+        st.caption(f"🧪 Profilazione attiva: profili e input anonimizzati in {PROFILE_DIR}")
+        if TEMPI_IMPORT:
+            st.caption("Import differiti: " + ", ".join(f"{m} {s:.2f} s" for m, s in TEMPI_IMPORT.items()))
     
 # --- COLONNA DESTRA (RISULTATI) ---------------------------------------------
 with col_right:
@@ -461,12 +915,20 @@ with col_right:
                 st.session_state.risultati = None
             
             else:
-                pass
+                # Il job è partito: i risultati precedenti non valgono più
+                st.session_state.risultati = None
 
     ris = st.session_state.risultati
     
-    if ris is None:
-        st.info("Carica i dati e premi «Calcola M2» nella colonna di sinistra.")
+    if st.session_state.job_calcolo is not None:
+        # Calcolo in background: avanzamento + annullamento (si aggiorna da solo)
+        mostra_avanzamento_calcolo()
+
+    elif ris is None:
+        if st.session_state.get("job_esito"):
+            st.warning(st.session_state.job_esito)
+        else:
+            st.info("Carica i dati e premi «Calcola M2» nella colonna di sinistra.")
         
     # --- VISUALIZZAZIONE RISULTATO UNIFICATO (Sempre Griglia SolverA3) ---
     elif ris is not None:
@@ -478,11 +940,8 @@ with col_right:
         diff_colli = abs(ris["voci_attuali"]["Colli Attesi"] - ris["voci_attuali"]["Colli Allocati"]).sum()
         diff_pesi = abs(ris["voci_attuali"]["Peso Atteso"] - ris["voci_attuali"]["Peso Allocato"]).sum() 
         
-        df_export_long = prepare_data_entry_export(
-            ris["griglia_colli"], 
-            ris["griglia_peso"],
-            st.session_state.solver.partite 
-        )
+        # Export già preparati dal job di calcolo
+        df_export_long = ris["df_export_long"]
 
         # 2. La Griglia (CENTRO)
         st.markdown("""
@@ -493,11 +952,7 @@ with col_right:
             </style>
         """, unsafe_allow_html=True)
         
-        st.dataframe(
-            df_export_long, 
-            width="stretch", 
-            hide_index=True
-        )
+        visualizza_risultati(df_export_long)
         
         # 3. Blocco Azioni e Conferma (SOTTO)
         
@@ -511,19 +966,37 @@ with col_right:
         
         st.markdown("<hr style='margin: 0.5rem 0rem;'>", unsafe_allow_html=True)
         
-        col_conf, col_lab, col_pdf, col_xls = st.columns([2.2, 0.8, 0.5, 0.5], vertical_alignment="center") 
+        col_conf, col_lab, col_pdf, col_xls, col_bulk = st.columns([2.2, 0.8, 0.5, 0.5, 0.5], vertical_alignment="center") 
         
         with col_conf:
             st.markdown(f'<span style="font-size: 0.95rem; font-weight: 600; color: {msg_color};">{quad_msg}</span>', unsafe_allow_html=True)
+
+            # Conferma dello scarico: i residui diventano la disponibilità del prossimo M2
+            if ris.get("registrato_ledger"):
+                st.caption("📒 Scarico registrato nel ledger A3.")
+            elif not ris.get("da_ledger"):
+                st.caption("📒 Per registrare lo scarico attiva 'Usa residui ledger A3' e ricalcola.")
+            elif st.button("📒 Registra scarico nel ledger", key="registra_ledger", type="secondary"):
+                try:
+                    n_registrate = get_ledger().registra(
+                        ris["risultato"].partite,
+                        ris["risultato"].partite_colli_residui,
+                        ris["risultato"].partite_peso_residui
+                    )
+                except LedgerModificato as e:
+                    st.error(f"⛔ Ledger A3 cambiato dopo il calcolo ({e}): ricalcola prima di registrare.")
+                else:
+                    ris["registrato_ledger"] = True
+                    st.toast(f"Scarico di {n_registrate} partite registrato nel ledger A3.")
+                    st.rerun()
         
         with col_lab:
             st.markdown('<span style="font-weight: 600; text-align: right; display: block; margin-right: 10px;">SCARICA:</span>', unsafe_allow_html=True)
         
         with col_pdf:
-            pdf_output = create_pdf_from_df(df_export_long)
             st.download_button(
                 label="PDF", 
-                data=pdf_output, 
+                data=ris["pdf_output"], 
                 file_name="easy_m2_pdf.pdf", 
                 type="secondary", 
                 key="dl_pdf",
@@ -531,31 +1004,32 @@ with col_right:
             )
         
         with col_xls:
-            excel_data = io.BytesIO()
-            with pd.ExcelWriter(excel_data, engine='xlsxwriter') as writer:
-                 df_export_long.to_excel(writer, index=False, sheet_name='Data Entry M2')
-                 
-                 # 1. Ottieni il foglio di lavoro
-                 worksheet = writer.sheets['Data Entry M2']
-                 
-                 # 2. Itera sulle colonne e imposta la larghezza
-                 for i, col in enumerate(df_export_long.columns):
-                     # Trova la larghezza massima
-                     max_len = max(
-                         df_export_long[col].astype(str).map(len).max(), # Larghezza dati
-                         len(str(col)) # Larghezza intestazione
-                     )
-                     # Imposta la larghezza della colonna (con un po' di padding)
-                     worksheet.set_column(i, i, max_len + 2)
-                     
-            excel_data.seek(0)
-            
             st.download_button(
                 label="EXCEL", 
-                data=excel_data, 
+                data=ris["excel_output"], 
                 file_name="easy_m2_excel.xlsx", 
                 mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", 
                 type="secondary", 
                 key="dl_excel",
                 width="stretch" 
-            )
\ No newline at end of file
+            )
+
+        with col_bulk:
+            # Formati per il caricamento massivo nel gestionale doganale
+            with st.popover("ALTRI", width="stretch"):
+                export_bulk = ris["export_bulk"]
+                st.download_button(
+                    label="CSV", data=export_bulk["csv"], file_name="easy_m2.csv",
+                    mime="text/csv", key="dl_csv", width="stretch"
+                )
+                st.download_button(
+                    label="JSON Lines", data=export_bulk["jsonl"], file_name="easy_m2.jsonl",
+                    mime="application/x-ndjson", key="dl_jsonl", width="stretch"
+                )
+                if "parquet" in export_bulk:
+                    st.download_button(
+                        label="Parquet", data=export_bulk["parquet"], file_name="easy_m2.parquet",
+                        mime="application/vnd.apache.parquet", key="dl_parquet", width="stretch"
+                    )
+                else:
+                    st.caption("Parquet non disponibile (pyarrow non installato).")
\ No newline at end of file
@@ -2,8 +2,59 @@
 
 import pandas as pd
 import numpy as np
+import os
 import re
-import pdfplumber
+import io
+import itertools
+import random
+import time
+from bisect import bisect_left, insort
+from dataclasses import dataclass
+
+# pdfplumber/pdfminer si caricano al primo PDF, non all'avvio dell'app
+from profiling import importa, profila
+
+# --- FORMATO TABELLARE COMPATTO (Voci/Partite per il solver) ---
+
+# Peso in virgola fissa: millesimi di kg (grammi), la stessa precisione del solver
+PESO_SCALA = 1000
+COLONNE_CHIAVE = ["nome", "Contenitore", "MRN-S"]
+
+
+def compatta_tabella_solver(df):
+    """
+    Converte UNA sola volta una tabella voci/partite (colonne del solver) nel
+    formato interno compatto:
+    - chiavi testuali ('nome', 'Contenitore', 'MRN-S') categoriche (stringhe internate)
+    - 'colli' int32
+    - peso in virgola fissa: 'peso_g' int64 (grammi) al posto di 'peso' float
+    Le altre colonne passano così come sono, senza copie.
+    """
+    colonne = {}
+    for col in df.columns:
+        if col in COLONNE_CHIAVE:
+            colonne[col] = df[col].astype("category")
+        elif col == "colli":
+            colonne[col] = pd.to_numeric(df[col], errors="coerce").fillna(0).round(0).astype(np.int32)
+        elif col == "peso":
+            peso = pd.to_numeric(df[col], errors="coerce").fillna(0)
+            colonne["peso_g"] = (peso * PESO_SCALA).round(0).astype(np.int64)
+        else:
+            colonne[col] = df[col]
+    return pd.DataFrame(colonne, index=df.index)
+
+
+def colli_array(df):
+    """Colonna 'colli' come array float (0 per i mancanti)."""
+    return pd.to_numeric(df["colli"], errors="coerce").fillna(0).to_numpy(dtype=float)
+
+
+def peso_array(df):
+    """Peso in kg come array float, sia dal formato compatto ('peso_g') sia da 'peso'."""
+    if "peso_g" in df.columns:
+        return df["peso_g"].to_numpy(dtype=float) / PESO_SCALA
+    return pd.to_numeric(df["peso"], errors="coerce").fillna(0).to_numpy(dtype=float)
+
 
 # --- MOTORE DI SOLVING AUTOMATICO (Logica Sequenziale a Cascata) ---
 class SolverA3:
@@ -21,54 +72,102 @@ class SolverA3:
     Questo rispetta i limiti massimi di colli E peso di entrambe le parti.
     """
     def __init__(self, voci, partite):
-        self.voci = voci.reset_index(drop=True).copy()
-        self.partite = partite.reset_index(drop=True).copy()
+        # Nessuna copia: il solver non modifica mai le tabelle, solo i propri array
+        self.voci = voci.reset_index(drop=True)
+        self.partite = partite.reset_index(drop=True)
 
-        # Tabelle di allocazione iniziali
-        self.griglia_colli = pd.DataFrame(
-            0.0, index=self.voci["nome"], columns=self.partite["nome"]
-        )
-        self.griglia_peso = pd.DataFrame(
-            0.0, index=self.voci["nome"], columns=self.partite["nome"]
+        # Identità POSIZIONALE: la voce i è la riga i, la partita j è la colonna j.
+        # I nomi restano solo etichette per l'output, così TARIC o MRN duplicati
+        # non collidono più tra loro.
+        n_voci = len(self.voci)
+        n_partite = len(self.partite)
+
+        # Tabelle di allocazione iniziali (array NumPy, indicizzate per posizione)
+        self._colli = np.zeros((n_voci, n_partite))
+        self._peso = np.zeros((n_voci, n_partite))
+        self.griglia_colli = None
+        self.griglia_peso = None
+
+        # Valori attesi (array posizionali, letti una sola volta dalle tabelle)
+        self.voci_colli = colli_array(self.voci)
+        self.voci_peso = peso_array(self.voci)
+        self.partite_colli = colli_array(self.partite)
+        self.partite_peso = peso_array(self.partite)
+
+        # Traccia la disponibilità rimanente delle Partite A3 (colonne), per posizione
+        self.partite_colli_disponibili = self.partite_colli.copy()
+        self.partite_peso_disponibili = self.partite_peso.copy()
+
+    def _griglia(self, valori):
+        """Etichetta una griglia posizionale con i nomi di voci e partite (solo per l'output)."""
+        return pd.DataFrame(
+            valori,
+            index=pd.Index(self.voci["nome"].to_numpy(), name="nome"),
+            columns=pd.Index(self.partite["nome"].to_numpy(), name="nome"),
         )
+        
+    def _notifica_avanzamento(self, on_progress, voci_processate):
+        """Riporta (voci processate, partite esaurite) alla callback, se presente."""
+        if on_progress is None:
+            return
+        partite_consumate = int(np.count_nonzero(
+            (self.partite_colli_disponibili < 0.5) & (self.partite_peso_disponibili < 0.0005)
+        ))
+        on_progress(voci_processate, partite_consumate)
+
+    def risolvi(self, on_progress=None):
+        """
+        Esegue la cascata e restituisce (griglia_colli, griglia_peso).
 
-        # Traccia la disponibilità rimanente delle Partite A3 (colonne)
-        # Usiamo .to_dict() per un accesso più rapido
-        self.partite_colli_disponibili = self.partite.set_index('nome')['colli'].to_dict()
-        self.partite_peso_disponibili = self.partite.set_index('nome')['peso'].to_dict()
+        on_progress: callback opzionale on_progress(voci_processate, partite_consumate),
+        chiamata prima di ogni voce H1 e a fine calcolo. Può sollevare un'eccezione
+        per interrompere il calcolo (es. annullamento dall'interfaccia).
+        """
+        self._cascata(on_progress)
         
-    def risolvi(self):
+        # Pulisci i colli (devono essere interi)
+        self.griglia_colli = self._griglia(self._colli.round(0).astype(int))
+        self.griglia_peso = self._griglia(self._peso)
+        
+        return self.griglia_colli, self.griglia_peso
+
+    def _cascata(self, on_progress=None):
+        """Allocazione a cascata sugli array posizionali (self._colli / self._peso)."""
+        colli_disponibili = self.partite_colli_disponibili
+        peso_disponibili = self.partite_peso_disponibili
+        voci_colli = self.voci_colli
+        voci_peso = self.voci_peso
+        n_partite = len(self.partite)
         
         # Loop 1: Itera su ogni VOCE H1 (Riga) in ordine
-        for voce_idx in self.voci.index:
-            voce_nome = self.voci.loc[voce_idx, "nome"]
+        for i in range(len(self.voci)):
+            self._notifica_avanzamento(on_progress, i)
             
             # Usiamo round() per sicurezza con i float
-            colli_necessari_voce = round(self.voci.loc[voce_idx, "colli"], 0)
-            peso_necessario_voce = round(self.voci.loc[voce_idx, "peso"], 3)
+            colli_necessari_voce = round(voci_colli[i], 0)
+            peso_necessario_voce = round(voci_peso[i], 3)
 
             # Se questa voce H1 non ha bisogno di nulla, salta
             if colli_necessari_voce <= 0 and peso_necessario_voce <= 0.000:
                 continue
             
             # Loop 2: Itera su ogni PARTITA A3 (Colonna) per riempire la Voce H1
-            for partita_idx in self.partite.index:
-                partita_nome = self.partite.loc[partita_idx, "nome"]
+            for j in range(n_partite):
                 
                 # --- 1. Allocazione COLLI (Serbatoio 1) ---
-                colli_disponibili_partita = round(self.partite_colli_disponibili.get(partita_nome, 0), 0)
+                colli_disponibili_partita = round(colli_disponibili[j], 0)
                 
                 if colli_necessari_voce > 0 and colli_disponibili_partita > 0:
                     colli_da_allocare = min(colli_necessari_voce, colli_disponibili_partita)
                     
-                    self.griglia_colli.loc[voce_nome, partita_nome] += colli_da_allocare
+                    self._colli[i, j] += colli_da_allocare
                     
                     # Aggiorna i totali rimanenti
-                    self.partite_colli_disponibili[partita_nome] -= colli_da_allocare
+                    colli_disponibili[j] -= colli_da_allocare
                     colli_necessari_voce -= colli_da_allocare
                 
                 # --- 2. Allocazione PESO (Serbatoio 2) ---
-                peso_disponibile_partita = round(self.partite_peso_disponibili.get(partita_nome, 0), 3)
+                peso_disponibile_partita = round(peso_disponibili[j], 3)
 
                 if peso_necessario_voce > 0 and peso_disponibile_partita > 0:
                     peso_da_allocare = min(peso_necessario_voce, peso_disponibile_partita)
@@ -82,15 +181,15 @@ class SolverA3:
                     if peso_da_allocare > peso_disponibile_partita:
                          peso_da_allocare = peso_disponibile_partita
 
-                    self.griglia_peso.loc[voce_nome, partita_nome] += peso_da_allocare
+                    self._peso[i, j] += peso_da_allocare
                     
                     # Aggiorna i totali rimanenti
-                    self.partite_peso_disponibili[partita_nome] -= peso_da_allocare
+                    peso_disponibili[j] -= peso_da_allocare
                     peso_necessario_voce -= peso_da_allocare
                     
                     # Riarrotonda i residui per evitare errori di precisione float
                     peso_necessario_voce = round(peso_necessario_voce, 3)
-                    self.partite_peso_disponibili[partita_nome] = round(self.partite_peso_disponibili[partita_nome], 3)
+                    peso_disponibili[j] = round(peso_disponibili[j], 3)
 
                 # --- 3. Controllo Uscita ---
                 # Se questa Voce H1 è piena, smetti di cercare nelle Partite A3
@@ -100,11 +199,557 @@ class SolverA3:
             
             # (Fine loop partite)
         # (Fine loop voci)
-        
-        # Pulisci i colli (devono essere interi)
-        self.griglia_colli = self.griglia_colli.round(0).astype(int)
-        
-        return self.griglia_colli, self.griglia_peso
+        self._notifica_avanzamento(on_progress, len(self.voci))
+
+
+# --- RISULTATO IMMUTABILE (condivisibile tra sessioni) ---
+
+def _sola_lettura(valori, dtype):
+    """Copia di un array marcata non scrivibile."""
+    valori = np.array(valori, dtype=dtype)
+    valori.flags.writeable = False
+    return valori
+
+
+@dataclass(frozen=True, eq=False)
+class RisultatoA3:
+    """
+    Esito di una risoluzione, in SOLA LETTURA: può stare in una cache di processo
+    ed essere letto da più sessioni contemporaneamente.
+
+    Le allocazioni sono in formato sparso (solo le celle non vuote: la cascata
+    ne produce al più voci + partite), per posizione:
+    la k-esima allocazione va dalla partita colonne[k] alla voce righe[k].
+    Gli array non sono scrivibili; le tabelle si leggono tramite le proprietà
+    voci/partite, che ne restituiscono una copia (superficiale: con il
+    copy-on-write di pandas le modifiche non tornano mai sull'originale).
+    Anche le tabelle di input sono tenute come copie superficiali, senza duplicarne i dati.
+    """
+    _voci: pd.DataFrame
+    _partite: pd.DataFrame
+    righe: np.ndarray
+    colonne: np.ndarray
+    colli: np.ndarray
+    peso: np.ndarray
+    partite_colli_residui: np.ndarray
+    partite_peso_residui: np.ndarray
+
+    @classmethod
+    def da_solver(cls, solver):
+        """Congela lo stato di un SolverA3 dopo la cascata."""
+        colli = solver._colli.round(0)
+        righe, colonne = np.nonzero((colli != 0) | (solver._peso != 0))
+        return cls(
+            _voci=solver.voci.copy(deep=False),
+            _partite=solver.partite.copy(deep=False),
+            righe=_sola_lettura(righe, np.int64),
+            colonne=_sola_lettura(colonne, np.int64),
+            colli=_sola_lettura(colli[righe, colonne], np.int64),
+            peso=_sola_lettura(solver._peso[righe, colonne], float),
+            partite_colli_residui=_sola_lettura(solver.partite_colli_disponibili, float),
+            partite_peso_residui=_sola_lettura(solver.partite_peso_disponibili, float),
+        )
+
+    # Campi numerici: bastano questi (più le tabelle di input) per ricostruire il risultato
+    CAMPI_ARRAY = (
+        "righe", "colonne", "colli", "peso", "partite_colli_residui", "partite_peso_residui"
+    )
+
+    def array(self):
+        """Gli array del risultato, per nome (senza copie)."""
+        return {campo: getattr(self, campo) for campo in self.CAMPI_ARRAY}
+
+    @classmethod
+    def da_array(cls, voci, partite, array):
+        """
+        Ricostruisce il risultato dalle tabelle di input e dagli array di array()
+        (es. mappati in memoria da un altro processo): gli array non vengono copiati,
+        devono essere già in sola lettura.
+        """
+        for campo in cls.CAMPI_ARRAY:
+            if array[campo].flags.writeable:
+                raise ValueError(f"Array '{campo}' scrivibile: serve una vista in sola lettura.")
+        return cls(
+            _voci=voci.reset_index(drop=True),
+            _partite=partite.reset_index(drop=True),
+            **{campo: array[campo] for campo in cls.CAMPI_ARRAY}
+        )
+
+    @property
+    def voci(self):
+        """Voci normalizzate (indice 0..n-1)."""
+        return self._voci.copy(deep=False)
+
+    @property
+    def partite(self):
+        """Partite normalizzate (indice 0..n-1, allineate ai residui)."""
+        return self._partite.copy(deep=False)
+
+    def griglie(self):
+        """(griglia_colli, griglia_peso) densi come da SolverA3.risolvi()."""
+        colli = np.zeros((len(self._voci), len(self._partite)), dtype=int)
+        peso = np.zeros((len(self._voci), len(self._partite)))
+        colli[self.righe, self.colonne] = self.colli
+        peso[self.righe, self.colonne] = self.peso
+        indice = pd.Index(self._voci["nome"].to_numpy(), name="nome")
+        colonne = pd.Index(self._partite["nome"].to_numpy(), name="nome")
+        return (
+            pd.DataFrame(colli, index=indice, columns=colonne),
+            pd.DataFrame(peso, index=indice, columns=colonne),
+        )
+
+    def voci_attuali(self):
+        """Colli/peso allocati e attesi per voce (allineamento posizionale)."""
+        n = len(self._voci)
+        return pd.DataFrame({
+            "Colli Allocati": np.bincount(self.righe, weights=self.colli, minlength=n).astype(int),
+            "Peso Allocato": np.bincount(self.righe, weights=self.peso, minlength=n),
+            "Colli Attesi": colli_array(self._voci),
+            "Peso Atteso": peso_array(self._voci)
+        }, index=pd.Index(self._voci["nome"].to_numpy(), name="nome"))
+
+    def partite_attuali(self):
+        """Colli/peso allocati e attesi per partita (allineamento posizionale)."""
+        n = len(self._partite)
+        return pd.DataFrame({
+            "Colli Allocati": np.bincount(self.colonne, weights=self.colli, minlength=n).astype(int),
+            "Peso Allocato": np.bincount(self.colonne, weights=self.peso, minlength=n),
+            "Colli Attesi": colli_array(self._partite),
+            "Peso Atteso": peso_array(self._partite)
+        }, index=pd.Index(self._partite["nome"].to_numpy(), name="nome"))
+
+
+def risolvi_a3(voci, partite, on_progress=None):
+    """
+    Versione PURA di SolverA3: non modifica voci/partite e restituisce un
+    RisultatoA3 immutabile (stessa cascata, stesse allocazioni).
+    """
+    solver = SolverA3(voci, partite)
+    solver._cascata(on_progress)
+    return RisultatoA3.da_solver(solver)
+
+
+def risolvi_a3_streaming(voci, partite, on_progress=None, dimensione_blocco=5000):
+    """
+    Come risolvi_a3, ma con SolverA3Streaming: niente griglie dense voci x partite,
+    in memoria solo le allocazioni e la finestra delle partite con disponibilità.
+    Stesse allocazioni della cascata classica; da usare per le tabelle molto grandi.
+    """
+    voci = voci.reset_index(drop=True)
+    partite = partite.reset_index(drop=True)
+    solver = SolverA3Streaming(
+        voci, (partite.iloc[k:k + dimensione_blocco] for k in range(0, len(partite), dimensione_blocco))
+    )
+
+    righe, colonne, colli, peso = [], [], [], []
+    # Peso residuo aggiornato prelievo per prelievo, con gli stessi arrotondamenti della cascata
+    peso_residui = peso_array(partite).copy()
+    voce_corrente = -1
+    for riga in solver.risolvi():
+        if on_progress is not None and riga["voce"] != voce_corrente:
+            voce_corrente = riga["voce"]
+            on_progress(voce_corrente, solver.partite_lette - len(solver._finestra))
+        righe.append(riga["voce"])
+        colonne.append(riga["partita"])
+        colli.append(riga["Colli Allocati"])
+        peso.append(riga["Peso Allocato"])
+        if riga["Peso Allocato"] > 0:
+            peso_residui[riga["partita"]] = round(peso_residui[riga["partita"]] - riga["Peso Allocato"], 3)
+    if on_progress is not None:
+        on_progress(len(voci), solver.partite_lette - len(solver._finestra))
+
+    # Residui: disponibilità iniziale meno allocato; la finestra ha i valori esatti
+    righe = np.array(righe, dtype=np.int64)
+    colonne = np.array(colonne, dtype=np.int64)
+    colli = np.array(colli, dtype=np.int64)
+    peso = np.array(peso, dtype=float)
+    colli_residui = colli_array(partite) - np.bincount(colonne, weights=colli, minlength=len(partite))
+    for partita in solver._finestra:
+        colli_residui[partita[0]] = partita[4]
+        peso_residui[partita[0]] = partita[5]
+
+    return _risultato_da_allocazioni(voci, partite, righe, colonne, colli, peso, colli_residui, peso_residui)
+
+
+def _risultato_da_allocazioni(voci, partite, righe, colonne, colli, peso, colli_residui, peso_residui):
+    """RisultatoA3 da allocazioni sparse (ordinate per voce, poi per partita)."""
+    righe = np.asarray(righe, dtype=np.int64)
+    colonne = np.asarray(colonne, dtype=np.int64)
+    ordine = np.lexsort((colonne, righe))
+    return RisultatoA3(
+        _voci=voci.copy(deep=False),
+        _partite=partite.copy(deep=False),
+        righe=_sola_lettura(righe[ordine], np.int64),
+        colonne=_sola_lettura(colonne[ordine], np.int64),
+        colli=_sola_lettura(np.asarray(colli, dtype=np.int64)[ordine], np.int64),
+        peso=_sola_lettura(np.asarray(peso, dtype=float)[ordine], float),
+        partite_colli_residui=_sola_lettura(colli_residui, float),
+        partite_peso_residui=_sola_lettura(peso_residui, float),
+    )
+
+
+# --- MOTORE A RIGHE MINIME (meno celle voce/partita = meno righe di data entry) ---
+
+BUDGET_MIN_RIGHE = 3.0 # Secondi di ricerca predefiniti
+MAX_TENTATIVI_SENZA_MIGLIORAMENTI = 200 # Perturbazioni inutili consecutive prima di fermarsi
+
+
+class _PartiteOrdinate:
+    """
+    Partite ancora disponibili ordinate per (colli, peso) residui arrotondati.
+    L'ordine si costruisce una volta per tentativo e si aggiorna solo per le partite
+    toccate da ogni voce (bisect), invece di riordinare tutte le partite a ogni voce.
+    """
+    def __init__(self, attive, colli_disponibili, peso_disponibili):
+        self.chiavi = sorted(
+            (round(colli_disponibili[j], 0), round(peso_disponibili[j], 3), j) for j in attive
+        )
+        self._chiave = {chiave[2]: chiave for chiave in self.chiavi}
+
+    def aggiorna(self, j, colli, peso, esaurita):
+        """Riposiziona la partita j dopo un'allocazione (la toglie se esaurita)."""
+        vecchia = self._chiave.pop(j)
+        del self.chiavi[bisect_left(self.chiavi, vecchia)]
+        if not esaurita:
+            nuova = (round(colli, 0), round(peso, 3), j)
+            insort(self.chiavi, nuova)
+            self._chiave[j] = nuova
+
+
+def _cascata_posizioni(voci_colli, voci_peso, partite_colli, partite_peso,
+                       ordine_voci, ordine_partite=None, on_voce=None, scadenza=None):
+    """
+    Cascata generalizzata sulle posizioni, con gli stessi arrotondamenti di SolverA3:
+    le voci nell'ordine `ordine_voci`; per ogni voce le partite ancora disponibili
+    nell'ordine dato da ordine_partite(colli_necessari, peso_necessario, partite_ordinate)
+    (None = ordine originale, cioè la cascata classica).
+
+    Ogni voce scorre TUTTE le partite disponibili finché è piena, quindi la quadratura
+    è la stessa della cascata per qualunque ordine.
+    Restituisce (righe, colonne, colli, peso, colli_residui, peso_residui),
+    oppure None se si supera la scadenza (time.monotonic()).
+    """
+    # Scalari numpy come in SolverA3: round() sui float64 arrotonda come la cascata classica
+    colli_disponibili = list(np.asarray(partite_colli, dtype=float))
+    peso_disponibili = list(np.asarray(partite_peso, dtype=float))
+
+    def esaurita(j):
+        return round(colli_disponibili[j], 0) <= 0 and round(peso_disponibili[j], 3) <= 0.000
+
+    attive = [j for j in range(len(colli_disponibili)) if not esaurita(j)]
+    ordinate = None if ordine_partite is None else _PartiteOrdinate(attive, colli_disponibili, peso_disponibili)
+    righe, colonne, colli_allocati, peso_allocato = [], [], [], []
+
+    for n, i in enumerate(ordine_voci):
+        if scadenza is not None and time.monotonic() > scadenza:
+            return None
+        if on_voce is not None:
+            on_voce(n, len(colli_disponibili) - len(attive))
+
+        colli_necessari_voce = round(voci_colli[i], 0)
+        peso_necessario_voce = round(voci_peso[i], 3)
+        if colli_necessari_voce <= 0 and peso_necessario_voce <= 0.000:
+            continue
+
+        inizio_voce = len(colonne)
+        ordine = attive if ordinate is None else ordine_partite(
+            colli_necessari_voce, peso_necessario_voce, ordinate
+        )
+        visitate = 0
+        for visitate, j in enumerate(ordine, 1):
+            colli_da_allocare = 0
+            peso_da_allocare = 0.0
+
+            # --- 1. Allocazione COLLI (Serbatoio 1) ---
+            colli_disponibili_partita = round(colli_disponibili[j], 0)
+            if colli_necessari_voce > 0 and colli_disponibili_partita > 0:
+                colli_da_allocare = min(colli_necessari_voce, colli_disponibili_partita)
+                colli_disponibili[j] -= colli_da_allocare
+                colli_necessari_voce -= colli_da_allocare
+
+            # --- 2. Allocazione PESO (Serbatoio 2) ---
+            peso_disponibile_partita = round(peso_disponibili[j], 3)
+            if peso_necessario_voce > 0 and peso_disponibile_partita > 0:
+                peso_da_allocare = round(min(peso_necessario_voce, peso_disponibile_partita), 3)
+                if peso_da_allocare > peso_necessario_voce:
+                     peso_da_allocare = peso_necessario_voce
+                if peso_da_allocare > peso_disponibile_partita:
+                     peso_da_allocare = peso_disponibile_partita
+                peso_disponibili[j] = round(peso_disponibili[j] - peso_da_allocare, 3)
+                peso_necessario_voce = round(peso_necessario_voce - peso_da_allocare, 3)
+
+            if colli_da_allocare > 0 or peso_da_allocare > 0:
+                righe.append(i)
+                colonne.append(j)
+                colli_allocati.append(int(round(colli_da_allocare, 0)))
+                peso_allocato.append(peso_da_allocare)
+
+            # --- 3. Controllo Uscita ---
+            if colli_necessari_voce <= 0 and peso_necessario_voce <= 0.000:
+                break
+
+        # Solo le partite toccate da questa voce cambiano posizione o si esauriscono
+        toccate = colonne[inizio_voce:]
+        if ordinate is not None:
+            for j in toccate:
+                ordinate.aggiorna(j, colli_disponibili[j], peso_disponibili[j], esaurita(j))
+        else:
+            # Cascata classica: le partite toccate sono tra le prime `visitate`
+            esaurite = {j for j in toccate if esaurita(j)}
+            if esaurite:
+                attive = [j for j in attive[:visitate] if j not in esaurite] + attive[visitate:]
+
+    return righe, colonne, colli_allocati, peso_allocato, colli_disponibili, peso_disponibili
+
+
+def _partite_miglior_adattamento(colli_necessari, peso_necessario, partite):
+    """
+    Prima la più piccola partita che copre da sola la voce (una riga; se c'è, quella
+    uguale alla voce), poi le più grandi (meno spezzature).
+    Le partite sono già ordinate: si cerca per bisezione, senza riordinare.
+    """
+    chiavi = partite.chiavi
+    for pos in range(bisect_left(chiavi, (colli_necessari, peso_necessario)), len(chiavi)):
+        if chiavi[pos][1] >= peso_necessario:
+            coprente = chiavi[pos][2]
+            return itertools.chain((coprente,), (j for *_, j in reversed(chiavi) if j != coprente))
+    return (j for *_, j in reversed(chiavi))
+
+
+def _partite_piu_grandi(colli_necessari, peso_necessario, partite):
+    """Partite dalla più capiente alla meno capiente."""
+    return (j for *_, j in reversed(partite.chiavi))
+
+
+def _ordini_voci_iniziali(voci_colli, voci_peso, partite_colli, partite_peso):
+    """Ordini delle voci da provare per primi (euristiche)."""
+    n = len(voci_colli)
+    originale = list(range(n))
+    offerte = {(round(c, 0), round(p, 3)) for c, p in zip(partite_colli, partite_peso)}
+    esatte_prima = sorted(originale, key=lambda i: (round(voci_colli[i], 0), round(voci_peso[i], 3)) not in offerte)
+    grandi_prima = sorted(originale, key=lambda i: (-voci_colli[i], -voci_peso[i]))
+    pesanti_prima = sorted(originale, key=lambda i: (-voci_peso[i], -voci_colli[i]))
+    return [originale, esatte_prima, grandi_prima, pesanti_prima]
+
+
+def risolvi_a3_min_righe(voci, partite, budget_secondi=BUDGET_MIN_RIGHE, on_progress=None, seme=0):
+    """
+    Motore alternativo: cerca ordini delle voci e scelte delle partite che riducono
+    il numero di celle (voce, partita) non vuote, cioè le righe del data entry M2.
+
+    Parte SEMPRE dalla cascata classica (stesso risultato di risolvi_a3) e ne accetta
+    un'alternativa solo se ha meno righe e gli STESSI totali allocati per ogni voce
+    (stessa quadratura). Il budget conta dall'inizio della chiamata e un tentativo
+    parte solo se c'è il tempo di finirlo (stimato dal tentativo precedente).
+    Allo scadere restituisce il migliore trovato, al limite la cascata stessa.
+
+    Restituisce (RisultatoA3, {"righe_cascata", "righe", "tentativi"}).
+    """
+    voci = voci.reset_index(drop=True)
+    partite = partite.reset_index(drop=True)
+    voci_colli, voci_peso = colli_array(voci), peso_array(voci)
+    partite_colli, partite_peso = colli_array(partite), peso_array(partite)
+    argomenti = (list(voci_colli), list(voci_peso), partite_colli, partite_peso)
+
+    # 1. Cascata classica: riferimento e risultato di ripiego (sempre completata)
+    inizio = time.monotonic()
+    scadenza = inizio + budget_secondi
+    migliore = _cascata_posizioni(*argomenti, range(len(voci)), on_voce=on_progress)
+    durata_tentativo = time.monotonic() - inizio # Stima iniziale: un tentativo costa circa una cascata
+    righe_cascata = len(migliore[0])
+
+    def totali_voce(allocazione):
+        righe, _, colli, peso = allocazione[:4]
+        return (
+            np.bincount(righe, weights=colli, minlength=len(voci)) if righe else np.zeros(len(voci)),
+            np.bincount(righe, weights=peso, minlength=len(voci)) if righe else np.zeros(len(voci)),
+        )
+    colli_riferimento, peso_riferimento = totali_voce(migliore)
+    partite_consumate = sum(
+        1 for c, p in zip(migliore[4], migliore[5]) if round(c, 0) <= 0 and round(p, 3) <= 0.000
+    )
+
+    def accettabile(allocazione):
+        colli_voce, peso_voce = totali_voce(allocazione)
+        return (
+            np.array_equal(colli_voce, colli_riferimento)
+            and np.allclose(peso_voce, peso_riferimento, rtol=0, atol=0.0005)
+        )
+
+    # 2. Ricerca entro il budget: euristiche, poi perturbazioni del miglior ordine
+    generatore = random.Random(seme)
+    ordine_migliore, politica_migliore = list(range(len(voci))), None
+    tentativi = 0
+    senza_miglioramenti = 0
+
+    candidati = [
+        (ordine, politica)
+        for ordine in _ordini_voci_iniziali(*argomenti)
+        for politica in (_partite_miglior_adattamento, _partite_piu_grandi)
+    ]
+    while righe_cascata > len(voci):
+        if time.monotonic() + durata_tentativo > scadenza:
+            break # Il prossimo tentativo non finirebbe entro il budget: non si comincia
+        if candidati:
+            ordine, politica = candidati.pop(0)
+        else:
+            if len(voci) < 2 or senza_miglioramenti >= MAX_TENTATIVI_SENZA_MIGLIORAMENTI:
+                break
+            # Perturbazione: scambia due voci nel miglior ordine trovato
+            ordine = list(ordine_migliore)
+            a, b = generatore.randrange(len(ordine)), generatore.randrange(len(ordine))
+            ordine[a], ordine[b] = ordine[b], ordine[a]
+            politica = politica_migliore or _partite_miglior_adattamento
+
+        if on_progress is not None:
+            on_progress(len(voci), partite_consumate) # Permette annullamento/limite di tempo
+        inizio_tentativo = time.monotonic()
+        allocazione = _cascata_posizioni(*argomenti, ordine, politica, scadenza=scadenza)
+        durata_tentativo = time.monotonic() - inizio_tentativo
+        tentativi += 1
+        if allocazione is None:
+            break # Budget esaurito a metà tentativo
+        if len(allocazione[0]) < len(migliore[0]) and accettabile(allocazione):
+            migliore, ordine_migliore, politica_migliore = allocazione, ordine, politica
+            senza_miglioramenti = 0
+        else:
+            senza_miglioramenti += 1
+
+    righe, colonne, colli, peso, colli_residui, peso_residui = migliore
+    risultato = _risultato_da_allocazioni(
+        voci, partite, righe, colonne, colli, peso,
+        np.array(colli_residui, dtype=float), np.array(peso_residui, dtype=float)
+    )
+    return risultato, {"righe_cascata": righe_cascata, "righe": len(righe), "tentativi": tentativi}
+
+
+# --- VARIANTE A FLUSSO (Partite A3 lette a blocchi) ---
+class SolverA3Streaming:
+    """
+    Stessa logica "a cascata" di SolverA3, ma le Partite A3 arrivano a blocchi
+    da un iteratore di DataFrame (es. pd.read_csv(..., chunksize=...)).
+
+    La cascata va solo in avanti: una partita esaurita (colli E peso) non viene
+    più riletta, quindi in memoria resta solo la "finestra" delle partite con
+    disponibilità residua. Un nuovo blocco viene letto solo quando la voce H1
+    corrente non è ancora piena e la finestra è finita.
+
+    I blocchi devono avere le colonne del solver ('nome', 'colli', 'peso' o 'peso_g';
+    'Contenitore' e 'MRN-S' opzionali). risolvi() è un generatore che emette
+    le righe di allocazione non appena sono definitive.
+    """
+    def __init__(self, voci, partite_chunks):
+        self.voci = voci.reset_index(drop=True)
+        self._chunks = iter(partite_chunks)
+
+        # Finestra: [posizione globale, nome, Contenitore, MRN-S, colli residui, peso residuo]
+        self._finestra = []
+        self.partite_lette = 0
+
+        # Fabbisogno residuo per voce (per posizione), aggiornato durante il calcolo
+        self.voci_colli_residui = colli_array(self.voci).round(0)
+        self.voci_peso_residui = peso_array(self.voci).round(3)
+
+    def _carica_blocco(self):
+        """Accoda alla finestra il prossimo blocco di partite. False se il flusso è finito."""
+        try:
+            blocco = next(self._chunks)
+        except StopIteration:
+            return False
+
+        nomi = blocco["nome"].to_numpy()
+        contenitori = blocco["Contenitore"].to_numpy() if "Contenitore" in blocco.columns else nomi
+        mrns = blocco["MRN-S"].to_numpy() if "MRN-S" in blocco.columns else [None] * len(blocco)
+        colli = colli_array(blocco)
+        peso = peso_array(blocco)
+
+        for k in range(len(blocco)):
+            self._finestra.append(
+                [self.partite_lette, nomi[k], contenitori[k], mrns[k], colli[k], peso[k]]
+            )
+            self.partite_lette += 1
+        return True
+
+    @staticmethod
+    def _esaurita(partita):
+        return round(partita[4], 0) <= 0 and round(partita[5], 3) <= 0.000
+
+    def risolvi(self):
+        """Generatore di righe di allocazione (dict), una per coppia (voce, partita) non vuota."""
+        finestra = self._finestra
+
+        # Loop 1: Itera su ogni VOCE H1 (Riga) in ordine
+        for i in range(len(self.voci)):
+            voce_nome = self.voci.at[i, "nome"]
+            colli_necessari_voce = self.voci_colli_residui[i]
+            peso_necessario_voce = self.voci_peso_residui[i]
+
+            # Se questa voce H1 non ha bisogno di nulla, salta
+            if colli_necessari_voce <= 0 and peso_necessario_voce <= 0.000:
+                continue
+
+            # Loop 2: scorre la finestra, leggendo nuovi blocchi solo se serve
+            k = 0
+            while True:
+                if k == len(finestra):
+                    if not self._carica_blocco():
+                        break # Flusso A3 finito: la voce resta con un residuo
+                    continue
+                partita = finestra[k]
+                k += 1
+
+                colli_da_allocare = 0
+                peso_da_allocare = 0.0
+
+                # --- 1. Allocazione COLLI (Serbatoio 1) ---
+                colli_disponibili_partita = round(partita[4], 0)
+                if colli_necessari_voce > 0 and colli_disponibili_partita > 0:
+                    colli_da_allocare = min(colli_necessari_voce, colli_disponibili_partita)
+                    partita[4] -= colli_da_allocare
+                    colli_necessari_voce -= colli_da_allocare
+
+                # --- 2. Allocazione PESO (Serbatoio 2) ---
+                peso_disponibile_partita = round(partita[5], 3)
+                if peso_necessario_voce > 0 and peso_disponibile_partita > 0:
+                    peso_da_allocare = round(min(peso_necessario_voce, peso_disponibile_partita), 3)
+
+                    # Check di sicurezza per non allocare più del dovuto (a causa di errori float)
+                    if peso_da_allocare > peso_necessario_voce:
+                         peso_da_allocare = peso_necessario_voce
+                    if peso_da_allocare > peso_disponibile_partita:
+                         peso_da_allocare = peso_disponibile_partita
+
+                    partita[5] = round(partita[5] - peso_da_allocare, 3)
+                    peso_necessario_voce = round(peso_necessario_voce - peso_da_allocare, 3)
+
+                if colli_da_allocare > 0 or peso_da_allocare > 0:
+                    yield {
+                        "voce": i,
+                        "Voce Doganale (H1)": voce_nome,
+                        "partita": partita[0],
+                        "Partita A3/MRN": partita[1],
+                        "Contenitore": partita[2],
+                        "MRN-S": partita[3],
+                        "Colli Allocati": int(round(colli_da_allocare, 0)),
+                        "Peso Allocato": peso_da_allocare,
+                    }
+
+                # --- 3. Controllo Uscita ---
+                if colli_necessari_voce <= 0 and peso_necessario_voce <= 0.000:
+                    break
+
+            self.voci_colli_residui[i] = colli_necessari_voce
+            self.voci_peso_residui[i] = peso_necessario_voce
+
+            # Scarta le partite esaurite: la finestra contiene solo disponibilità residua
+            finestra[:] = [p for p in finestra if not self._esaurita(p)]
+
+    def partite_residue(self):
+        """DataFrame delle partite della finestra (lette e non esaurite) con i residui."""
+        return pd.DataFrame(
+            self._finestra,
+            columns=["partita", "nome", "Contenitore", "MRN-S", "colli", "peso"]
+        )
 
 
 # --- Funzioni di estrazione (Attive) ---
@@ -139,33 +784,301 @@ def _pulizia_peso_globale(series_pesi):
     return pd.to_numeric(testo_pulito_copia, errors='coerce')
 
 
-def estrai_dati_bolla_reale(file_caricato):
+# --- PRE-FILTRO PAGINE (prima passata economica, senza analisi di layout) ---
+
+# Intestazione di un blocco articolo, cercata nel testo grezzo senza spazi
+PATTERN_ARTICOLO_GREZZO = re.compile(rb"Sing\.\d+Reg\.4000", re.IGNORECASE)
+PATTERN_STRINGA_PDF = re.compile(rb"\((?:\\.|[^\\)])*\)")
+# Testo fuori dalle stringhe letterali della pagina: Form XObject (/Nome Do) e stringhe esadecimali
+PATTERN_XOBJECT_PDF = re.compile(rb"/[^\s/\[\]()<>{}%]+\s+Do\b")
+PATTERN_ESADECIMALE_PDF = re.compile(rb"(?<!<)<[0-9A-Fa-f\s]*>(?!>)")
+# Byte che non sono testo (id di glifo, escape ottali) dentro le stringhe letterali
+PATTERN_NON_TESTO_PDF = re.compile(rb"[\x00-\x08\x0e-\x1f\x7f-\xff]|\\[0-7]")
+# Font i cui codici nelle stringhe sono caratteri leggibili: semplici, non incorporati, codifica standard
+FONT_SEMPLICI = {"Type1", "MMType1", "TrueType"}
+CODIFICHE_STANDARD = {"WinAnsiEncoding", "MacRomanEncoding", "StandardEncoding"}
+PATTERN_SOTTOINSIEME_FONT = re.compile(r"^[A-Z]{6}\+")
+PAGINE_CONTINUAZIONE = 1 # Pagine successive incluse: un blocco può proseguire oltre la pagina
+
+
+def _font_standard(pagina):
+    """
+    True se tutti i font della pagina sono semplici (Type1/TrueType), non incorporati
+    e con codifica standard: solo così i byte delle stringhe sono il testo della pagina.
+    Font Type0/Identity-H, incorporati o sottoinsiemi scrivono id di glifo.
+    """
+    try:
+        resolve1 = importa("pdfminer.pdftypes").resolve1
+        literal_name = importa("pdfminer.psparser").literal_name
+        font = resolve1((pagina.resources or {}).get("Font")) or {}
+        for riferimento in font.values():
+            spec = resolve1(riferimento)
+            if literal_name(spec.get("Subtype")) not in FONT_SEMPLICI:
+                return False
+            codifica = resolve1(spec.get("Encoding"))
+            if codifica is not None and literal_name(codifica) not in CODIFICHE_STANDARD:
+                return False # Identity-H, Differences...: i codici non sono caratteri
+            if PATTERN_SOTTOINSIEME_FONT.match(literal_name(spec.get("BaseFont"))):
+                return False
+            descrittore = resolve1(spec.get("FontDescriptor")) or {}
+            if any(chiave in descrittore for chiave in ("FontFile", "FontFile2", "FontFile3")):
+                return False
+    except Exception:
+        return False
+    return True
+
+
+def _testo_grezzo_pagina(pagina):
+    """
+    Testo "grezzo" di una pagina (PDFPage di pdfminer): solo le stringhe letterali
+    del content stream, concatenate e senza spazi. Nessuna analisi dei caratteri/layout.
+    Restituisce None se il testo non è leggibile così (font CID o incorporati, byte non
+    testuali, stringhe esadecimali, contenuti in Form XObject...): la pagina va allora
+    sempre analizzata per intero.
+    """
+    try:
+        resolve1 = importa("pdfminer.pdftypes").resolve1
+        contenuti = resolve1(pagina.attrs.get("Contents"))
+        if contenuti is None:
+            return b""
+        if not isinstance(contenuti, list):
+            contenuti = [contenuti]
+        dati = b"".join(resolve1(stream).get_data() for stream in contenuti)
+    except Exception:
+        return None
+
+    if not _font_standard(pagina):
+        return None # Stringhe scritte in id di glifo: il testo grezzo non è affidabile
+    if PATTERN_XOBJECT_PDF.search(dati) or PATTERN_ESADECIMALE_PDF.search(dati):
+        return None # Parte del testo non è nelle stringhe letterali: il pre-filtro non lo vede
+    testo = b"".join(m.group(0)[1:-1] for m in PATTERN_STRINGA_PDF.finditer(dati))
+    if PATTERN_NON_TESTO_PDF.search(testo):
+        return None
+    testo = re.sub(rb"\s+", b"", testo)
+    if dati.strip() and not re.search(rb"[A-Za-z]{3}", testo):
+        return None # C'è contenuto ma non è testo leggibile: serve l'estrazione completa
+    return testo
+
+
+def _pagine_rilevanti(pagine):
+    """
+    Indici delle pagine che possono contenere blocchi articolo (più le pagine di
+    continuazione). Le pagine non leggibili in modo grezzo sono sempre incluse.
+    Se la passata grezza non trova nulla, per sicurezza si analizzano tutte le pagine.
+    """
+    rilevanti = set()
+    for indice, pagina in enumerate(pagine):
+        testo = _testo_grezzo_pagina(pagina)
+        if testo is None:
+            rilevanti.add(indice)
+        elif PATTERN_ARTICOLO_GREZZO.search(testo):
+            rilevanti.update(range(indice, min(indice + 1 + PAGINE_CONTINUAZIONE, len(pagine))))
+
+    if not rilevanti:
+        return list(range(len(pagine)))
+    return sorted(rilevanti)
+
+
+# --- BACKEND DI ESTRAZIONE TESTO ---
+# Ogni backend riceve (documento, indici pagine) e restituisce il testo delle pagine,
+# una riga per riga del documento, oppure None se non è utilizzabile (libreria assente...).
+# In automatico si provano i backend veloci e il testo viene accettato solo se ha la
+# struttura attesa dei blocchi articolo; altrimenti si usa pdfplumber (riferimento).
+
+BACKEND_PDF = os.environ.get("EASYM2_BACKEND_PDF", "auto").strip().lower() # auto | nome backend
+BACKEND_VELOCI = ("pypdfium2", "pdfminer")
+BACKEND_RIFERIMENTO = "pdfplumber"
+TOLLERANZA_X = 2 # Come extract_text(x_tolerance=2, y_tolerance=2) di pdfplumber
+TOLLERANZA_Y = 2
+
+PATTERN_SPLITTER = re.compile(r"Sing\.\s+\d+\s+Reg\.\s+40\s+00", re.IGNORECASE)
+PATTERN_COLLI = re.compile(r"Colli\s+PK\s+(\d+)", re.IGNORECASE)
+PATTERN_PESO = re.compile(r"P\.lordo\D+([\d'.,]+)", re.IGNORECASE)
+PATTERN_TARIC = re.compile(r"Taric\D+(\d+)", re.IGNORECASE)
+
+
+@dataclass
+class DocumentoPdf:
+    """Bytes del PDF e pagine pdfminer (analizzate una sola volta per pre-filtro e backend)."""
+    contenuto: bytes
+    pagine: list
+
+
+def _apri_pdf(contenuto):
+    pdfparser = importa("pdfminer.pdfparser")
+    pdfdocument = importa("pdfminer.pdfdocument")
+    pdfpage = importa("pdfminer.pdfpage")
+    documento = pdfdocument.PDFDocument(pdfparser.PDFParser(io.BytesIO(contenuto)))
+    return DocumentoPdf(contenuto, list(pdfpage.PDFPage.create_pages(documento)))
+
+
+def _bytes_pdf(file_caricato):
+    """Bytes di un PDF passato come bytes, file caricato/BytesIO o percorso."""
+    if isinstance(file_caricato, (bytes, bytearray)):
+        return bytes(file_caricato)
+    if hasattr(file_caricato, "getvalue"):
+        return file_caricato.getvalue()
+    if hasattr(file_caricato, "read"):
+        return file_caricato.read()
+    with open(file_caricato, "rb") as f:
+        return f.read()
+
+
+def _righe_da_caratteri(caratteri):
+    """
+    Righe di testo da [(alto, x0, x1, testo)], come le costruisce pdfplumber:
+    caratteri raggruppati per quota (TOLLERANZA_Y), ordinati per x, spazio tra
+    parole staccate più di TOLLERANZA_X.
+    """
+    righe = []
+    caratteri.sort()
+    inizio = 0
+    for fine in range(1, len(caratteri) + 1):
+        if fine < len(caratteri) and caratteri[fine][0] - caratteri[fine - 1][0] <= TOLLERANZA_Y:
+            continue
+        pezzi = []
+        x_precedente = None
+        for _, x0, x1, testo in sorted(caratteri[inizio:fine], key=lambda c: c[1]):
+            if x_precedente is not None and x0 - x_precedente > TOLLERANZA_X:
+                pezzi.append(" ")
+            pezzi.append(testo)
+            x_precedente = x1
+        riga = " ".join("".join(pezzi).split())
+        if riga:
+            righe.append(riga)
+        inizio = fine
+    return "\n".join(righe)
+
+
+def _testo_pdfminer(documento, indici):
+    """Caratteri dal content stream senza analisi di layout (LAParams=None), righe ricostruite qui."""
+    pdfinterp = importa("pdfminer.pdfinterp")
+    converter = importa("pdfminer.converter")
+    LTChar = importa("pdfminer.layout").LTChar
+
+    risorse = pdfinterp.PDFResourceManager(caching=True)
+    aggregatore = converter.PDFPageAggregator(risorse, laparams=None)
+    interprete = pdfinterp.PDFPageInterpreter(risorse, aggregatore)
+    pagine = []
+    for indice in indici:
+        interprete.process_page(documento.pagine[indice])
+        caratteri = [
+            (-oggetto.y1, oggetto.x0, oggetto.x1, oggetto.get_text())
+            for oggetto in aggregatore.get_result() if isinstance(oggetto, LTChar)
+        ]
+        pagine.append(_righe_da_caratteri(caratteri))
+    return "\n".join(pagine)
+
+
+def _testo_pypdfium2(documento, indici):
+    """Estrazione testo di PDFium (libreria C, opzionale)."""
+    try:
+        pdfium = importa("pypdfium2")
+    except ImportError:
+        return None
+    pdf = pdfium.PdfDocument(documento.contenuto)
+    try:
+        pagine = []
+        for indice in indici:
+            pagina = pdf[indice]
+            testo_pagina = pagina.get_textpage()
+            pagine.append(testo_pagina.get_text_range().replace("\r\n", "\n"))
+            testo_pagina.close()
+            pagina.close()
+        return "\n".join(pagine)
+    finally:
+        pdf.close()
+
+
+def _testo_pdfplumber(documento, indici):
+    """Layout completo dei caratteri: lento ma è il comportamento di riferimento."""
+    with importa("pdfplumber").open(io.BytesIO(documento.contenuto)) as pdf:
+        return "".join(
+            (pdf.pages[indice].extract_text(x_tolerance=TOLLERANZA_X, y_tolerance=TOLLERANZA_Y) or "") + "\n"
+            for indice in indici
+        )
+
+
+BACKEND_TESTO_PDF = {
+    "pypdfium2": _testo_pypdfium2,
+    "pdfminer": _testo_pdfminer,
+    "pdfplumber": _testo_pdfplumber,
+}
+
+
+def _struttura_valida(testo, articoli_attesi):
+    """
+    True se il testo ha la struttura attesa: almeno un blocco articolo, tanti blocchi
+    quante le intestazioni che il backend vede su TUTTE le pagine (il conteggio non
+    dipende dal pre-filtro), e in ogni blocco Colli PK, P.lordo e Taric.
+    """
+    blocchi = PATTERN_SPLITTER.split(testo)[1:]
+    if not blocchi or len(blocchi) != articoli_attesi:
+        return False
+    return all(
+        PATTERN_COLLI.search(blocco) and PATTERN_PESO.search(blocco) and PATTERN_TARIC.search(blocco)
+        for blocco in blocchi
+    )
+
+
+def estrai_testo_bolla(contenuto, backend=None):
+    """
+    Testo delle pagine rilevanti di una bolla (bytes) -> (testo, nome del backend usato).
+    backend: nome in BACKEND_TESTO_PDF oppure "auto" (predefinito: EASYM2_BACKEND_PDF).
+    """
+    backend = backend or BACKEND_PDF
+    if backend != "auto" and backend not in BACKEND_TESTO_PDF:
+        raise ValueError(f"Backend PDF sconosciuto: {backend}")
+    documento = _apri_pdf(contenuto)
+    if backend == BACKEND_RIFERIMENTO:
+        # Il riferimento non dipende dal pre-filtro: sempre tutte le pagine
+        return _testo_pdfplumber(documento, range(len(documento.pagine))), backend
+
+    # Backend veloci solo sulle pagine con blocchi articolo (e loro continuazioni)
+    indici = _pagine_rilevanti(documento.pagine)
+    escluse = sorted(set(range(len(documento.pagine))) - set(indici))
+
+    if backend != "auto":
+        return BACKEND_TESTO_PDF[backend](documento, indici) or "", backend
+
+    for nome in BACKEND_VELOCI:
+        estrai = BACKEND_TESTO_PDF[nome]
+        try:
+            testo = estrai(documento, indici)
+            # Controllo indipendente dal pre-filtro: il backend legge anche le pagine
+            # escluse, che non devono contenere intestazioni articolo
+            testo_escluse = estrai(documento, escluse) if testo is not None and escluse else ""
+        except Exception:
+            testo = None # Backend veloce in errore su questo PDF: si passa al successivo
+        if testo is None or testo_escluse is None:
+            continue
+        articoli_attesi = len(PATTERN_SPLITTER.findall(testo)) + len(PATTERN_SPLITTER.findall(testo_escluse))
+        if _struttura_valida(testo, articoli_attesi):
+            return testo, nome
+    # Struttura non confermata (anche: articoli in pagine escluse dal pre-filtro),
+    # il riferimento analizza quindi tutte le pagine
+    return _testo_pdfplumber(documento, range(len(documento.pagine))), BACKEND_RIFERIMENTO
+
+
+def estrai_dati_bolla_reale(file_caricato, backend=None):
     """
     Estrae i dati delle Voci Doganali da un PDF.
-    Restituisce solo il DataFrame delle voci.
+    Restituisce solo il DataFrame delle voci (backend di testo usato in attrs["backend_pdf"]).
     """
     voci_list = []
-    testo_completo = ""
     try:
-        with pdfplumber.open(file_caricato) as pdf:
-            for pagina in pdf.pages:
-                testo_completo += pagina.extract_text(x_tolerance=2, y_tolerance=2) + "\n"
-        
-        pattern_splitter = re.compile(r"Sing\.\s+\d+\s+Reg\.\s+40\s+00", re.IGNORECASE)
-        pattern_colli = re.compile(r"Colli\s+PK\s+(\d+)", re.IGNORECASE)
-        pattern_peso = re.compile(r"P\.lordo\D+([\d'.,]+)", re.IGNORECASE)
-        pattern_taric = re.compile(r"Taric\D+(\d+)", re.IGNORECASE)
+        testo_completo, backend_usato = estrai_testo_bolla(_bytes_pdf(file_caricato), backend)
 
-        blocchi_articolo = pattern_splitter.split(testo_completo)
+        blocchi_articolo = PATTERN_SPLITTER.split(testo_completo)
 
         if len(blocchi_articolo) < 2:
             # Nessun blocco articolo trovato
             return pd.DataFrame() 
 
         for i, blocco_testo in enumerate(blocchi_articolo[1:]):
-            match_colli = pattern_colli.search(blocco_testo)
-            match_peso = pattern_peso.search(blocco_testo)
-            match_taric = pattern_taric.search(blocco_testo)
+            match_colli = PATTERN_COLLI.search(blocco_testo)
+            match_peso = PATTERN_PESO.search(blocco_testo)
+            match_taric = PATTERN_TARIC.search(blocco_testo)
             colli = match_colli.group(1) if match_colli else "0"
             peso = match_peso.group(1) if match_peso else "0"
             desc = match_taric.group(1) if match_taric else f"Taric Sconosciuto {i+1}"
@@ -180,9 +1093,66 @@ def estrai_dati_bolla_reale(file_caricato):
         ).fillna(0).astype(int)
         
         voci_estratte_df['Peso Totale'] = _pulizia_peso_globale(voci_estratte_df['Peso Totale']).fillna(0.0)
+        voci_estratte_df.attrs["backend_pdf"] = backend_usato
         
         return voci_estratte_df
         
     except Exception:
         # Errore durante l'estrazione
-        return pd.DataFrame()
\ No newline at end of file
+        return pd.DataFrame()
+
+
+def conta_pagine_pdf(contenuto):
+    """Numero di pagine di un PDF (bytes), senza estrarre il testo. 0 se illeggibile."""
+    try:
+        return len(_apri_pdf(contenuto).pagine)
+    except Exception:
+        return 0
+
+
+def estrai_dati_bolla_da_bytes(contenuto, profilo=False):
+    """
+    Come estrai_dati_bolla_reale, ma dai bytes del PDF (eseguibile in un processo worker).
+    Con `profilo` l'estrazione è profilata nel processo che la esegue (fase "upload_pdf").
+    """
+    with profila("upload_pdf", profilo) as snapshot:
+        voci_df = estrai_dati_bolla_reale(io.BytesIO(contenuto))
+        snapshot["voci_pdf"] = voci_df
+    return voci_df
+
+
+def estrai_bolle_multiple(files, executor=None, profilo=False):
+    """
+    Estrae le voci da più bolle PDF [(nome, bytes), ...], in parallelo se viene
+    passato un executor (es. pool di processi).
+
+    Le voci vengono concatenate nell'ordine dei file (e, dentro ogni file, nell'ordine
+    del documento), indipendentemente da quale estrazione finisce prima.
+    La colonna 'Bolla' indica il documento di provenienza.
+
+    Restituisce (voci_df, nomi dei file senza voci).
+    """
+    nomi = [nome for nome, _ in files]
+    contenuti = [contenuto for _, contenuto in files]
+
+    risultati = None
+    if executor is not None and len(files) > 1:
+        try:
+            risultati = list(executor.map(estrai_dati_bolla_da_bytes, contenuti, [profilo] * len(contenuti)))
+        except Exception:
+            risultati = None # Pool non disponibile: ripiega sull'estrazione sequenziale
+    if risultati is None:
+        risultati = [estrai_dati_bolla_da_bytes(contenuto, profilo) for contenuto in contenuti]
+
+    parti = []
+    senza_voci = []
+    for nome, voci_df in zip(nomi, risultati):
+        if voci_df.empty:
+            senza_voci.append(nome)
+            continue
+        voci_df["Bolla"] = nome
+        parti.append(voci_df)
+
+    if not parti:
+        return pd.DataFrame(), senza_voci
+    return pd.concat(parti, ignore_index=True), senza_voci
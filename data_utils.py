@@ -4,10 +4,14 @@ import streamlit as st
 import pandas as pd
 import io
 import re
+import hashlib
 import unicodedata
-import chardet # Necessario per la robustezza del CSV
 import numpy as np # Necessario per il check float/int
 
+from core_logic import compatta_tabella_solver, PESO_SCALA
+from ledger import chiavi_partite
+from profiling import importa, profila # chardet solo al primo CSV (import differito)
+
 # --- FUNZIONI DI UTILITÀ (PER PULIZIA DATI) ---
 
 def _normalize(s: str) -> str:
@@ -18,6 +22,11 @@ def _normalize(s: str) -> str:
     s = re.sub(r'[^a-z0-9 ]+', ' ', s)
     return re.sub(r'\s+', ' ', s)
 
+def _rileva_encoding(contenuto):
+    """Encoding di un CSV (chardet, caricato solo al primo CSV). Ripiego: latin-1."""
+    return importa("chardet").detect(contenuto)["encoding"] or "latin-1"
+
+
 def read_excel_or_csv(uploaded_file, just_read=False):
     """
     Legge un file Excel o CSV (M2 o A3) in modo tollerante e multi-formato.
@@ -43,10 +52,11 @@ def read_excel_or_csv(uploaded_file, just_read=False):
             if name.endswith(f".{ext}") or (ext == "csv" and "," in uploaded_file.name):
                 if ext == "csv":
                     raw.seek(0)
-                    enc = chardet.detect(raw.read())["encoding"] or "latin-1"
+                    enc = _rileva_encoding(raw.read())
                     raw.seek(0)
                     df_raw = pd.read_csv(raw, header=None, sep=None, engine="python", encoding=enc)
                 else:
+                    importa(engine) # Motore Excel al primo file di quel formato (tempo registrato)
                     df_raw = pd.read_excel(raw, header=None, engine=engine)
                 if not df_raw.empty:
                     break
@@ -74,7 +84,7 @@ def read_excel_or_csv(uploaded_file, just_read=False):
     try:
         if name.endswith(".csv"):
             raw2.seek(0)
-            enc = chardet.detect(raw2.read())["encoding"] or "latin-1"
+            enc = _rileva_encoding(raw2.read())
             raw2.seek(0)
             df = pd.read_csv(raw2, header=header_row, sep=None, engine="python", encoding=enc)
         elif name.endswith(".xls"):
@@ -91,6 +101,226 @@ def read_excel_or_csv(uploaded_file, just_read=False):
     df = df.loc[:, ~df.columns.duplicated()]
     return df
 
+# --- MODIFICHE PER DIFFERENZA (editor su tabelle grandi) ---
+
+def filtra_righe(df: pd.DataFrame, testo: str) -> pd.Series:
+    """Maschera delle righe in cui almeno una colonna testuale contiene `testo` (case-insensitive)."""
+    maschera = pd.Series(False, index=df.index)
+    for c in df.columns:
+        if df[c].dtype == object or isinstance(df[c].dtype, (pd.StringDtype, pd.CategoricalDtype)):
+            maschera |= df[c].astype(str).str.contains(testo, case=False, regex=False, na=False)
+    return maschera
+
+
+def applica_diff_editor(master: pd.DataFrame, indice_vista, modifiche: dict, indice_quadratura=None) -> pd.DataFrame:
+    """
+    Applica al DataFrame master le modifiche di un st.data_editor mostrato su una VISTA
+    (pagina o filtro) del master.
+
+    `indice_vista`: etichette dell'indice di master delle righe mostrate, nell'ordine della vista.
+    `modifiche`: stato del widget ({"edited_rows", "added_rows", "deleted_rows"}, posizioni nella vista).
+    `indice_quadratura`: IndiceQuadratura del master da tenere allineato (solo righe toccate).
+
+    Le celle modificate vengono scritte in place (costo proporzionale alle righe toccate);
+    solo aggiunte ed eliminazioni ricostruiscono la tabella.
+    """
+    modificate = [indice_vista[int(pos)] for pos in modifiche.get("edited_rows", {})]
+    eliminate = [indice_vista[int(pos)] for pos in modifiche.get("deleted_rows", [])]
+    if indice_quadratura is not None:
+        # Contributi vecchi tolti PRIMA della scrittura in place, una sola volta per
+        # riga (una riga modificata e poi eliminata compare in entrambe le liste)
+        indice_quadratura.rimuovi(master.loc[sorted(set(modificate) | set(eliminate))])
+
+    for pos, cambi in modifiche.get("edited_rows", {}).items():
+        etichetta = indice_vista[int(pos)]
+        for col, valore in cambi.items():
+            try:
+                master.loc[etichetta, col] = valore
+            except (TypeError, ValueError):
+                # Valore non compatibile col dtype (es. decimale in colonna intera)
+                master[col] = master[col].astype(object)
+                master.loc[etichetta, col] = valore
+
+    if eliminate:
+        master = master.drop(index=eliminate)
+
+    aggiunte = modifiche.get("added_rows", [])
+    if aggiunte:
+        inizio = int(master.index.max()) + 1 if len(master) else 0
+        nuove = pd.DataFrame(aggiunte, columns=master.columns, index=range(inizio, inizio + len(aggiunte)))
+        master = pd.concat([master, nuove])
+
+    if indice_quadratura is not None:
+        indice_quadratura.aggiungi(master.loc[[e for e in modificate if e not in eliminate]])
+        if aggiunte:
+            indice_quadratura.aggiungi(master.iloc[-len(aggiunte):])
+        indice_quadratura.sorgente = master
+    return master
+
+
+# --- INDICE DI QUADRATURA (verifica totali pre-calcolo) ---
+
+# Gruppi per tabella: nome del gruppo -> colonne che lo identificano
+GRUPPI_VOCI = {"Bolla": ("Bolla",), "Voce": ("Voce Doganale",)}
+GRUPPI_PARTITE = {
+    "Contenitore": ("Contenitore",),
+    "MRN": ("Partita A3/MRN",),
+    "Partita": ("Partita A3/MRN", "MRN-S", "Contenitore"),
+}
+
+
+def _presente(serie):
+    if pd.api.types.is_numeric_dtype(serie):
+        return serie.notna()
+    return serie.notna() & (serie.astype(str).str.strip() != "")
+
+
+def _etichetta_gruppo(df, colonne):
+    parti = [df[c].astype(object).where(_presente(df[c]), "").astype(str).str.strip() for c in colonne]
+    etichetta = parti[0]
+    for parte in parti[1:]:
+        etichetta = etichetta + " / " + parte
+    return etichetta.replace("", "(vuoto)")
+
+
+def _contributi_righe(df, gruppi):
+    """
+    Per ogni riga: colli (interi), peso in grammi (interi), eventuale problema
+    (valore non numerico o negativo) ed etichetta di ogni gruppo.
+    """
+    vuota = pd.Series(np.nan, index=df.index)
+    colli_grezzi = df["Colli"] if "Colli" in df.columns else vuota
+    peso_grezzo = df["Peso lordo"] if "Peso lordo" in df.columns else vuota
+    colli = pd.to_numeric(colli_grezzi, errors="coerce")
+    peso = pd.to_numeric(peso_grezzo, errors="coerce")
+
+    problema = pd.Series("", index=df.index, dtype=object)
+    problema[(colli < 0) | (peso < 0)] = "valore negativo"
+    problema[(_presente(colli_grezzi) & colli.isna()) | (_presente(peso_grezzo) & peso.isna())] = "valore non numerico"
+
+    contributi = pd.DataFrame({
+        "colli": colli.fillna(0).round(0).astype(np.int64),
+        "peso_g": (peso.fillna(0) * PESO_SCALA).round(0).astype(np.int64),
+        "problema": problema,
+    }, index=df.index)
+    for nome, colonne in gruppi.items():
+        contributi[nome] = _etichetta_gruppo(df, colonne)
+    return contributi
+
+
+class IndiceQuadratura:
+    """
+    Totali colli/peso di una tabella dell'editor, complessivi e per gruppo
+    (es. per Contenitore, MRN, voce). Il peso è in grammi interi, quindi gli
+    aggiornamenti successivi non accumulano errori float.
+
+    Si costruisce una volta sulla tabella (sorgente) e poi segue le modifiche con
+    rimuovi()/aggiungi() sulle sole righe toccate: la verifica dei totali prima del
+    calcolo costa O(righe cambiate), non O(righe totali).
+    """
+    def __init__(self, df, gruppi):
+        # Un gruppo usa le colonne presenti (es. Partita senza MRN-S = MRN + Contenitore)
+        self.gruppi = {
+            nome: tuple(c for c in colonne if c in df.columns)
+            for nome, colonne in gruppi.items() if any(c in df.columns for c in colonne)
+        }
+        self.colli = 0
+        self.peso_g = 0
+        self.totali = {nome: {} for nome in self.gruppi} # gruppo -> {etichetta: [colli, peso_g, righe]}
+        self.problemi = {} # etichetta riga -> problema (valori non numerici/negativi)
+        self.sorgente = df
+        self.aggiungi(df)
+
+    @property
+    def peso(self):
+        return self.peso_g / PESO_SCALA
+
+    def aggiungi(self, righe):
+        self._applica(righe, 1)
+
+    def rimuovi(self, righe):
+        self._applica(righe, -1)
+
+    def _applica(self, righe, segno):
+        if righe.empty:
+            return
+        contributi = _contributi_righe(righe, self.gruppi)
+        self.colli += segno * int(contributi["colli"].sum())
+        self.peso_g += segno * int(contributi["peso_g"].sum())
+
+        for nome in self.gruppi:
+            somme = contributi.groupby(nome, sort=False).agg(
+                colli=("colli", "sum"), peso_g=("peso_g", "sum"), righe=("colli", "size")
+            )
+            valori = zip(somme.index.tolist(), somme["colli"].tolist(), somme["peso_g"].tolist(), somme["righe"].tolist())
+            totali = self.totali[nome]
+            if not totali and segno > 0:
+                self.totali[nome] = {etichetta: [colli, peso_g, n] for etichetta, colli, peso_g, n in valori}
+                continue
+            for etichetta, colli, peso_g, n in valori:
+                totale = totali.setdefault(etichetta, [0, 0, 0])
+                totale[0] += segno * colli
+                totale[1] += segno * peso_g
+                totale[2] += segno * n
+                if totale[2] <= 0:
+                    del totali[etichetta]
+
+        if segno < 0:
+            for etichetta in contributi.index:
+                self.problemi.pop(etichetta, None)
+        else:
+            con_problemi = contributi["problema"] != ""
+            self.problemi.update(zip(contributi.index[con_problemi], contributi["problema"][con_problemi]))
+
+
+def diagnosi_quadratura(indice_voci, indice_partite, max_righe=50):
+    """
+    Dove cercare la differenza tra totali H1 e A3, come DataFrame
+    (Tabella, Gruppo, Valore, Colli, Peso lordo, Problema):
+    - righe con valori non numerici o negativi (sempre);
+    - gruppi (voce, bolla, contenitore, MRN) il cui totale da solo è la differenza:
+      voci senza partite corrispondenti, partite in più o mancanti tra le voci;
+    - partite ripetute, se l'A3 supera le voci.
+    La ricerca sui gruppi (O(gruppi)) si fa solo se i totali non coincidono.
+    """
+    righe = []
+    for tabella, indice in (("Voci H1", indice_voci), ("Partite A3", indice_partite)):
+        for etichetta, problema in list(indice.problemi.items())[:max_righe]:
+            riga = indice.sorgente.loc[etichetta] if etichetta in indice.sorgente.index else {}
+            righe.append({
+                "Tabella": tabella, "Gruppo": "Riga", "Valore": str(etichetta),
+                "Colli": riga.get("Colli"), "Peso lordo": riga.get("Peso lordo"), "Problema": problema,
+            })
+
+    diff_colli = indice_voci.colli - indice_partite.colli
+    diff_peso_g = indice_voci.peso_g - indice_partite.peso_g
+    if diff_colli or diff_peso_g:
+        # Voci in più rispetto all'A3 (differenza positiva) o partite in più (negativa)
+        for tabella, indice, segno, problema in (
+            ("Voci H1", indice_voci, 1, "totale pari alla differenza: voce senza partite A3?"),
+            ("Partite A3", indice_partite, -1, "totale pari alla differenza: partite in più?"),
+        ):
+            attesi = (segno * diff_colli, segno * diff_peso_g)
+            if attesi[0] < 0 or attesi[1] < 0:
+                continue
+            for gruppo, totali in indice.totali.items():
+                for etichetta, (colli, peso_g, _) in totali.items():
+                    if (colli, peso_g) == attesi:
+                        righe.append({
+                            "Tabella": tabella, "Gruppo": gruppo, "Valore": etichetta,
+                            "Colli": colli, "Peso lordo": peso_g / PESO_SCALA, "Problema": problema,
+                        })
+        if diff_colli < 0 or diff_peso_g < 0:
+            for etichetta, (colli, peso_g, n) in indice_partite.totali.get("Partita", {}).items():
+                if n > 1:
+                    righe.append({
+                        "Tabella": "Partite A3", "Gruppo": "Partita", "Valore": etichetta,
+                        "Colli": colli, "Peso lordo": peso_g / PESO_SCALA, "Problema": f"ripetuta {n} volte",
+                    })
+
+    return pd.DataFrame(righe[:max_righe], columns=["Tabella", "Gruppo", "Valore", "Colli", "Peso lordo", "Problema"])
+
+
 # --- BLOCCO RICONOSCIMENTO AUTOMATICO ---
 def select_three_columns(df: pd.DataFrame) -> pd.DataFrame:
     """
@@ -268,4 +498,251 @@ def select_three_columns(df: pd.DataFrame) -> pd.DataFrame:
         df_sel["MRN-S"] = df_sel["MRN-S"].astype(str).str.strip().str.replace(r'\.0$', '', regex=True)
 
     df_sel = df_sel.loc[:, ~df_sel.columns.duplicated()]
-    return df_sel
\ No newline at end of file
+    return df_sel
+
+
+# --- UPLOAD A3 MULTI-FILE ---
+
+def leggi_a3_da_bytes(nome_file, contenuto, profilo=False):
+    """
+    Legge e mappa (select_three_columns) un singolo file A3 dai suoi bytes.
+    Non usa st.*: può girare in un processo worker. Con `profilo` la lettura è
+    profilata nel processo che la esegue (fase "upload_a3").
+    """
+    with profila("upload_a3", profilo) as snapshot:
+        buffer = io.BytesIO(contenuto)
+        buffer.name = nome_file
+        df = read_excel_or_csv(buffer, just_read=True)
+        if not df.empty:
+            df = select_three_columns(df)
+        snapshot["partite_a3"] = df
+    return df
+
+
+def hash_contenuto(contenuto):
+    """Impronta (sha256) dei bytes di un file caricato."""
+    return hashlib.sha256(contenuto).hexdigest()
+
+
+def impronta_tabella(df):
+    """
+    Impronta (sha256) dell'INTERO contenuto di un DataFrame: colonne, tipi, indice e valori.
+    (L'hashing degli argomenti di st.cache_* campiona le tabelle grandi: non basta come chiave.)
+    """
+    impronta = hashlib.sha256(repr((list(df.columns), [str(t) for t in df.dtypes])).encode("utf-8"))
+    impronta.update(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+    return impronta.hexdigest()
+
+
+# --- CACHE DEL PARSING A3 (per impronta del contenuto) ---
+# st.cache_data restituisce a ogni chiamata una COPIA del risultato: il DataFrame
+# può andare in session_state ed essere modificato dall'editor (applica_diff_editor
+# lavora sul posto) senza toccare la versione in cache.
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def leggi_a3_in_cache(impronta, nome_file, _contenuto, _profilo=False):
+    """leggi_a3_da_bytes, ricalcolato solo per contenuti (impronta) mai visti."""
+    return leggi_a3_da_bytes(nome_file, _contenuto, _profilo)
+
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def leggi_a3_multipli_in_cache(firma, _files, _executor=None, _profilo=False):
+    """
+    Lettura + unione di più file A3, con cache per firma ((nome, impronta), ...).
+    Restituisce (df unito, esito dell'unione, nomi dei file illeggibili).
+    """
+    letture = leggi_a3_multipli(_files, executor=_executor, profilo=_profilo)
+    illeggibili = [nome for nome, df in letture if df.empty]
+    df3, esito_unione = unisci_partite_a3(letture)
+    return df3, esito_unione, illeggibili
+
+
+def leggi_a3_multipli(files, executor=None, profilo=False):
+    """
+    Legge più file A3 [(nome, bytes), ...], in parallelo se viene passato un executor
+    (con `profilo`, un profilo "upload_a3" per file, dal processo che lo legge).
+    Restituisce [(nome, df), ...] nello stesso ordine dei file (df vuoto se illeggibile).
+    """
+    nomi = [nome for nome, _ in files]
+    contenuti = [contenuto for _, contenuto in files]
+    if executor is not None and len(files) > 1:
+        try:
+            return list(zip(nomi, executor.map(leggi_a3_da_bytes, nomi, contenuti, [profilo] * len(files))))
+        except Exception:
+            pass # Pool non disponibile: ripiega sulla lettura sequenziale
+    return [(nome, leggi_a3_da_bytes(nome, contenuto, profilo)) for nome, contenuto in files]
+
+
+def _chiave_a3(valore):
+    testo = "" if valore is None else str(valore).strip().upper()
+    return "" if testo in ("", "NAN", "NONE") else re.sub(r'\.0$', '', testo)
+
+
+def unisci_partite_a3(tabelle):
+    """
+    Unisce le tabelle A3 di più file tramite un indice (MRN, MRN-S, Contenitore).
+
+    - Stessa chiave con gli STESSI colli/peso in un altro file: è la stessa partita
+      esportata due volte, viene tenuta una sola riga.
+    - Stessa chiave con valori DIVERSI: conflitto, entrambe le righe restano
+      (da verificare nell'editor) e vengono segnalate.
+    Le righe ripetute all'interno dello stesso file non vengono toccate.
+    Il file è identificato dalla posizione nell'upload, non dal nome: due file
+    con lo stesso nome sono comunque file diversi.
+
+    Restituisce (df_unito, {"duplicati": n, "conflitti": [chiavi]}).
+    Aggiunge la colonna 'File A3' con il file di provenienza.
+    """
+    indice = {} # chiave -> (posizione del file, colli, peso) della prima occorrenza
+    parti = []
+    duplicati = 0
+    conflitti = []
+
+    for posizione_file, (nome_file, df) in enumerate(tabelle):
+        if df.empty:
+            continue
+        mrn = df["Partita A3/MRN"] if "Partita A3/MRN" in df.columns else pd.Series("", index=df.index)
+        mrns = df["MRN-S"] if "MRN-S" in df.columns else pd.Series("", index=df.index)
+        contenitore = df["Contenitore"] if "Contenitore" in df.columns else mrn
+        colli = pd.to_numeric(df["Colli"], errors="coerce") if "Colli" in df.columns else pd.Series(np.nan, index=df.index)
+        peso = pd.to_numeric(df["Peso lordo"], errors="coerce") if "Peso lordo" in df.columns else pd.Series(np.nan, index=df.index)
+
+        tieni = np.ones(len(df), dtype=bool)
+        for pos, (m, s, c, n_colli, n_peso) in enumerate(zip(mrn, mrns, contenitore, colli, peso)):
+            chiave = (_chiave_a3(m), _chiave_a3(s), _chiave_a3(c))
+            valori = (round(n_colli, 0) if pd.notna(n_colli) else None,
+                      round(n_peso, 3) if pd.notna(n_peso) else None)
+            precedente = indice.get(chiave)
+            if precedente is None:
+                indice[chiave] = (posizione_file, *valori)
+            elif precedente[0] != posizione_file:
+                if precedente[1:] == valori:
+                    tieni[pos] = False
+                    duplicati += 1
+                else:
+                    conflitti.append(chiave)
+
+        parte = df[tieni].copy()
+        parte["File A3"] = nome_file
+        parti.append(parte)
+
+    if not parti:
+        return pd.DataFrame(), {"duplicati": 0, "conflitti": []}
+
+    unito = pd.concat(parti, ignore_index=True)
+    return unito, {"duplicati": duplicati, "conflitti": conflitti}
+
+
+# --- PREPARAZIONE DATI PER IL SOLVER ---
+
+def prepara_dati_solver(voci_editor, partite_editor, ledger=None):
+    """
+    Prepara le tabelle del solver dai dati degli editor (colonne visualizzate:
+    'Voce Doganale', 'Partita A3/MRN', 'Colli', 'Peso lordo', ...).
+    Con `ledger` (LedgerA3) colli/peso delle partite già registrate vengono dal ledger.
+    Non usa st.*: serve sia all'app sia al servizio HTTP.
+
+    Restituisce (report_msg, voci_df_solver, partite_df_solver); in caso di errore
+    (messaggio, None, None).
+    """
+    
+    # 1. Prepara VOCI dall'editor
+    try:
+        # Mappa dai nomi visualizzati (es. 'Colli') ai nomi interni del solver (es. 'colli')
+        # (rename crea già una nuova tabella: l'editor non viene toccato)
+        voci_df_solver = voci_editor.rename(columns={
+            "Voce Doganale": "nome",
+            "Colli": "colli",
+            "Peso lordo": "peso"
+        })
+        
+        voci_df_solver["nome"] = voci_df_solver["nome"].astype(str).str.strip()
+
+        # Formato interno compatto (chiavi categoriche, colli int32, peso in grammi)
+        voci_df_solver = compatta_tabella_solver(voci_df_solver)
+        
+    except Exception as e:
+        return f"Errore during la preparazione delle Voci H1: {e}", None, None
+
+
+    # 2. Prepara PARTITE A3 dall'editor
+    try:
+        partite_df_editor = partite_editor
+        
+        cols_editor = partite_df_editor.columns
+        
+        # Modo Avanzato: (Partita A3/MRN E Contenitore sono presenti E sono diversi)
+        is_avanzato = (
+            'Contenitore' in cols_editor and 
+            'Partita A3/MRN' in cols_editor and
+            not partite_df_editor.empty and 
+            (partite_df_editor['Partita A3/MRN'] != partite_df_editor['Contenitore']).any()
+        )
+
+        if is_avanzato:
+             # MODO AVANZATO (MRN)
+             rename_map = {
+                'Partita A3/MRN': 'nome', 
+                'Peso lordo': 'peso', 
+                'Colli': 'colli',
+                'Contenitore': 'Contenitore'
+             }
+             
+             if 'MRN-S' in cols_editor:
+                rename_map['MRN-S'] = 'MRN-S'
+
+             partite_df_solver = partite_df_editor[list(rename_map)].rename(columns=rename_map)
+             report_msg = "Allocazione completata con criterio **Avanzato (MRN)**."
+
+        elif 'Partita A3/MRN' in cols_editor:
+             # MODO CLASSICO (Container)
+             rename_map = {
+                'Partita A3/MRN': 'nome', 
+                'Peso lordo': 'peso', 
+                'Colli': 'colli',
+             }
+             partite_df_solver = partite_df_editor.rename(columns=rename_map)
+             partite_df_solver['Contenitore'] = partite_df_solver['nome'] 
+             partite_df_solver['MRN-S'] = None
+             report_msg = "Allocazione completata con criterio **Classico (Container)**."
+        
+        else:
+            return "Errore: Dati A3 non validi. Colonne 'Partita A3/MRN' non trovata.", None, None
+
+        
+        # Pulizia valori (comune a entrambi i percorsi)
+        partite_df_solver['nome'] = partite_df_solver['nome'].astype(str).str.strip().str.upper()
+        partite_df_solver['Contenitore'] = partite_df_solver['Contenitore'].astype(str).str.strip().str.upper()
+        partite_df_solver['colli'] = pd.to_numeric(partite_df_solver['colli'], errors='coerce')
+        partite_df_solver['peso'] = pd.to_numeric(partite_df_solver['peso'], errors='coerce')
+        if 'MRN-S' in partite_df_solver.columns:
+            partite_df_solver['MRN-S'] = partite_df_solver['MRN-S'].astype(str).str.strip()
+
+        # Chiave stabile per il ledger A3, calcolata PRIMA dei filtri
+        partite_df_solver['chiave_ledger'] = chiavi_partite(partite_df_solver)
+
+        # Disponibilità residue da dichiarazioni precedenti (ledger A3)
+        if ledger is not None:
+            partite_df_solver, n_da_ledger = ledger.applica_disponibilita(partite_df_solver)
+            if n_da_ledger:
+                report_msg += f" Residui di {n_da_ledger} partite letti dal ledger A3."
+
+        # Filtra righe non valide
+        partite_df_solver = partite_df_solver.dropna(subset=['nome', 'colli', 'peso', 'Contenitore'])
+        partite_df_solver = partite_df_solver[
+            (partite_df_solver['colli'] > 0) | (partite_df_solver['peso'] > 0)
+        ]
+        
+        if 'MRN-S' not in partite_df_solver.columns:
+            partite_df_solver['MRN-S'] = None
+        
+        if partite_df_solver.empty:
+            return "Errore: Nessuna riga A3 valida trovata nei dati (colli/peso > 0).", None, None
+
+        # Formato interno compatto: unica conversione, condiviso da solver ed export
+        partite_df_solver = compatta_tabella_solver(partite_df_solver)
+            
+    except Exception as e:
+        return f"Errore during l'analisi e preparazione dei dati A3: {e}", None, None
+
+    return report_msg, voci_df_solver, partite_df_solver
@@ -0,0 +1,362 @@
+# jobs.py
+
+import importlib
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+
+import numpy as np
+
+from core_logic import RisultatoA3, risolvi_a3, risolvi_a3_min_righe, risolvi_a3_streaming
+from profiling import profila
+
+# --- POOL DI PROCESSO ---
+# Un unico pool condiviso da tutte le sessioni Streamlit del server:
+# limita quanti calcoli girano contemporaneamente in background.
+MAX_JOB_WORKERS = 4
+_EXECUTOR = ThreadPoolExecutor(max_workers=MAX_JOB_WORKERS, thread_name_prefix="easym2-job")
+
+# Job sopra soglia: un worker dedicato, uno alla volta (gli altri restano in coda)
+# così un calcolo enorme non occupa i worker dei calcoli normali.
+_EXECUTOR_PESANTE = ThreadPoolExecutor(max_workers=1, thread_name_prefix="easym2-job-pesante")
+
+# Lettura dei file caricati (bolle PDF, A3): worker propri, così un upload parte
+# subito anche quando i worker dei calcoli sono tutti occupati.
+_EXECUTOR_INGESTIONE = ThreadPoolExecutor(max_workers=MAX_JOB_WORKERS, thread_name_prefix="easym2-ingestione")
+
+
+# --- LIMITI DI RISORSE (configurabili da variabili d'ambiente) ---
+
+def _limite(nome, predefinito):
+    try:
+        return int(os.environ.get(nome, predefinito))
+    except ValueError:
+        return predefinito
+
+
+MAX_RIGHE = _limite("EASYM2_MAX_RIGHE", 200_000) # Per tabella (voci o partite)
+MAX_PAGINE_PDF = _limite("EASYM2_MAX_PAGINE_PDF", 2_000) # Totale delle bolle caricate insieme
+MAX_CELLE_GRIGLIA = _limite("EASYM2_MAX_CELLE_GRIGLIA", 2_000_000) # Oltre: solver a flusso, in coda
+MAX_SECONDI_CALCOLO = _limite("EASYM2_MAX_SECONDI_CALCOLO", 600) # Tempo massimo di un calcolo
+BUDGET_MIN_RIGHE = _limite("EASYM2_BUDGET_MIN_RIGHE", 3) # Secondi di ricerca del motore a righe minime
+
+# Costi indicativi (misurati sulla cascata): per la stima mostrata prima del calcolo
+SECONDI_PER_CELLA = 2.5e-6 # Cascata densa: tempo ~ voci x partite
+SECONDI_PER_RIGA_FLUSSO = 2e-4 # Cascata a flusso: tempo ~ voci + partite
+BYTE_PER_CELLA = 16 # Due griglie float64 (colli e peso)
+
+
+class LimiteSuperato(Exception):
+    """Input o calcolo oltre i limiti di risorse configurati."""
+
+
+def stima_calcolo(n_voci, n_partite):
+    """
+    Stima, PRIMA di avviare il calcolo, memoria e tempo della cascata e sceglie il percorso:
+    - 'denso': SolverA3 classico (griglie voci x partite)
+    - 'flusso': SolverA3Streaming, senza griglie, su worker dedicato (in coda)
+    'rifiutato' contiene il motivo se le tabelle superano MAX_RIGHE, altrimenti None.
+    """
+    celle = n_voci * n_partite
+    if celle > MAX_CELLE_GRIGLIA:
+        percorso = "flusso"
+        memoria_mb = (n_voci + n_partite) * 200 / 1e6 # Finestra + allocazioni (ordine di grandezza)
+        secondi = (n_voci + n_partite) * SECONDI_PER_RIGA_FLUSSO
+    else:
+        percorso = "denso"
+        memoria_mb = celle * BYTE_PER_CELLA / 1e6
+        secondi = celle * SECONDI_PER_CELLA
+
+    rifiutato = None
+    if max(n_voci, n_partite) > MAX_RIGHE:
+        rifiutato = f"{max(n_voci, n_partite):,} righe (limite {MAX_RIGHE:,} per tabella)"
+
+    return {
+        "voci": n_voci,
+        "partite": n_partite,
+        "celle": celle,
+        "memoria_mb": memoria_mb,
+        "secondi": secondi,
+        "percorso": percorso,
+        "rifiutato": rifiutato,
+    }
+
+
+# Pool di PROCESSI per il parsing CPU-bound (Excel, PDF): creato al primo uso
+# e poi riusato, così i worker restano "caldi" (librerie già importate).
+MAX_PROCESS_WORKERS = min(4, os.cpu_count() or 1)
+_PROCESS_POOL = None
+_PROCESS_POOL_LOCK = threading.Lock()
+
+# Librerie importate da ogni worker all'avvio (pypdfium2 e i motori Excel opzionali possono mancare)
+MODULI_WORKER = (
+    "pandas", "pypdfium2", "pdfplumber", "chardet", "openpyxl", "xlrd", "pyxlsb", "xlsxwriter", "fpdf",
+    "core_logic", "data_utils", "styles",
+)
+
+
+def riscalda_worker():
+    """Inizializzatore dei processi worker: import pesanti fatti una volta, non alla prima richiesta."""
+    for modulo in MODULI_WORKER:
+        try:
+            importlib.import_module(modulo)
+        except ImportError:
+            pass
+
+
+def _pid_worker(_):
+    return os.getpid()
+
+
+def riscalda_pool():
+    """Avvia subito tutti i worker del pool (già con le librerie importate)."""
+    pool = get_process_pool()
+    return sorted(set(pool.map(_pid_worker, range(MAX_PROCESS_WORKERS))))
+
+
+def get_process_pool():
+    """Restituisce il pool di processi condiviso (spawn: sicuro anche con i thread di Streamlit)."""
+    global _PROCESS_POOL
+    with _PROCESS_POOL_LOCK:
+        # Un worker morto "rompe" il pool: in quel caso se ne crea uno nuovo
+        if _PROCESS_POOL is None or getattr(_PROCESS_POOL, "_broken", False):
+            _PROCESS_POOL = ProcessPoolExecutor(
+                max_workers=MAX_PROCESS_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=riscalda_worker
+            )
+        return _PROCESS_POOL
+
+
+def reset_process_pool():
+    """Scarta il pool (es. dopo un worker terminato in modo anomalo); il prossimo uso ne crea uno nuovo."""
+    global _PROCESS_POOL
+    with _PROCESS_POOL_LOCK:
+        if _PROCESS_POOL is not None:
+            _PROCESS_POOL.shutdown(wait=False, cancel_futures=True)
+        _PROCESS_POOL = None
+
+
+class JobAnnullato(Exception):
+    """Sollevata dentro il job quando l'operatore ha chiesto l'annullamento."""
+
+
+class BackgroundJob:
+    """
+    Esegue una funzione su un thread worker, fuori dal rerun di Streamlit.
+
+    La funzione riceve il job come primo argomento e lo usa per:
+    - riportare l'avanzamento (job.report(fase, voci=..., partite=...))
+    - controllare l'annullamento (job.check_cancel(), solleva JobAnnullato)
+
+    Il worker NON deve toccare st.session_state: il risultato si legge
+    dal thread dello script con job.done() / job.result().
+    """
+    esecutore = _EXECUTOR
+
+    def __init__(self, fn, *args, **kwargs):
+        self._lock = threading.Lock()
+        self._cancel = threading.Event()
+        self._stage = "In coda"
+        self._progress = {}
+        self.started_at = time.monotonic()
+        self.running_since = None # Inizio effettivo (dopo l'eventuale attesa in coda)
+        self._future = self.esecutore.submit(self._run, fn, args, kwargs)
+
+    def _run(self, fn, args, kwargs):
+        self.check_cancel() # Annullato mentre era ancora in coda
+        self.running_since = time.monotonic()
+        return fn(self, *args, **kwargs)
+
+    # --- Lato worker ---
+    def report(self, stage=None, **progress):
+        """Aggiorna fase e contatori di avanzamento (thread-safe)."""
+        with self._lock:
+            if stage is not None:
+                self._stage = stage
+            self._progress.update(progress)
+
+    def check_cancel(self):
+        """Interrompe il job se l'operatore ha premuto «Annulla»."""
+        if self._cancel.is_set():
+            raise JobAnnullato()
+
+    def check_tempo(self, limite=MAX_SECONDI_CALCOLO):
+        """Interrompe il job se è in esecuzione da più di `limite` secondi."""
+        if self.running_since is not None and time.monotonic() - self.running_since > limite:
+            raise LimiteSuperato(f"tempo di calcolo oltre {limite} s")
+
+    # --- Lato UI ---
+    def snapshot(self):
+        """Restituisce (fase, contatori) correnti."""
+        with self._lock:
+            return self._stage, dict(self._progress)
+
+    def cancel(self):
+        self._cancel.set()
+        self._future.cancel() # Se ancora in coda non partirà mai
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def elapsed(self):
+        return time.monotonic() - self.started_at
+
+    def done(self):
+        return self._future.done()
+
+    def result(self):
+        """Risultato del job; rilancia l'eccezione del worker (es. JobAnnullato)."""
+        if self._future.cancelled():
+            raise JobAnnullato()
+        return self._future.result()
+
+
+class JobPesante(BackgroundJob):
+    """Job oltre le soglie di risorse: gira sul worker dedicato, uno alla volta."""
+    esecutore = _EXECUTOR_PESANTE
+
+
+class JobIngestione(BackgroundJob):
+    """Lettura di file appena caricati, avviata subito e in parallelo agli altri upload."""
+    esecutore = _EXECUTOR_INGESTIONE
+
+
+# --- RISULTATI TRA PROCESSI (file mappati in memoria, niente pickle degli array) ---
+# Il worker scrive gli array del RisultatoA3 in un unico file, in /dev/shm (memoria
+# condivisa) se c'è spazio, altrimenti nella cartella temporanea; al processo dell'app
+# torna solo un descrittore di pochi byte. L'app mappa il file in sola lettura e usa
+# gli array direttamente (nessuna copia); il file viene rimosso subito, la mappatura
+# resta valida finché il risultato è in uso.
+DIR_MEMORIA_CONDIVISA = "/dev/shm"
+ALLINEAMENTO_BYTE = 64
+INTERVALLO_AVANZAMENTO = 0.2 # Secondi tra due letture dell'avanzamento del worker
+
+
+def _file_condiviso(dimensione):
+    cartella = tempfile.gettempdir()
+    if os.path.isdir(DIR_MEMORIA_CONDIVISA):
+        # /dev/shm nei container è spesso piccolo (64 MB): scrivere oltre lo spazio libero è fatale
+        if shutil.disk_usage(DIR_MEMORIA_CONDIVISA).free > 2 * dimensione:
+            cartella = DIR_MEMORIA_CONDIVISA
+    fd, percorso = tempfile.mkstemp(prefix="easym2_", suffix=".bin", dir=cartella)
+    os.close(fd)
+    return percorso
+
+
+def _rimuovi_file(percorso):
+    try:
+        os.remove(percorso)
+    except OSError:
+        pass
+
+
+def condividi_array(array):
+    """
+    Scrive gli array {nome: ndarray} in un file mappato (blocchi allineati a 64 byte).
+    Restituisce il descrittore picklabile {"percorso", "campi": [(nome, dtype, forma, offset)]}.
+    """
+    campi, dimensione = [], 0
+    for nome, valori in array.items():
+        valori = np.ascontiguousarray(valori)
+        campi.append((nome, valori.dtype.str, valori.shape, dimensione))
+        dimensione += -(-valori.nbytes // ALLINEAMENTO_BYTE) * ALLINEAMENTO_BYTE
+
+    percorso = _file_condiviso(dimensione)
+    try:
+        mappa = np.memmap(percorso, dtype=np.uint8, mode="w+", shape=(max(dimensione, ALLINEAMENTO_BYTE),))
+        for (_, _, _, offset), valori in zip(campi, array.values()):
+            valori = np.ascontiguousarray(valori).reshape(-1).view(np.uint8)
+            mappa[offset:offset + valori.nbytes] = valori
+        mappa.flush()
+        del mappa
+    except BaseException:
+        _rimuovi_file(percorso)
+        raise
+    return {"percorso": percorso, "campi": campi}
+
+
+def apri_array_condivisi(descrittore):
+    """
+    Mappa in sola lettura il file di condividi_array e restituisce {nome: ndarray}
+    senza copiare i dati. Il file viene rimosso: si può aprire una volta sola.
+    """
+    mappa = np.memmap(descrittore["percorso"], dtype=np.uint8, mode="r")
+    _rimuovi_file(descrittore["percorso"])
+    return {
+        nome: np.ndarray(forma, dtype=np.dtype(dtype), buffer=mappa, offset=offset)
+        for nome, dtype, forma, offset in descrittore["campi"]
+    }
+
+
+def _scarta_risultato(futuro):
+    """Callback: risultato di un worker non più atteso (annullato/errore lato app), file rimosso."""
+    if not futuro.cancelled() and futuro.exception() is None:
+        _rimuovi_file(futuro.result()[0]["percorso"])
+
+
+def _risolvi_nel_worker(voci, partite, percorso, motore, budget_secondi, percorso_canale, profilo=False):
+    """
+    (processo worker) Risoluzione con gli stessi motori dell'app. Avanzamento e
+    annullamento passano dal canale: 3 interi mappati (voci, partite consumate, annulla).
+    Con `profilo` la risoluzione è profilata qui, nel worker (fase "calcolo_worker").
+    """
+    canale = np.memmap(percorso_canale, dtype=np.int64, mode="r+", shape=(3,))
+
+    def on_progress(voci_processate, partite_consumate):
+        canale[0] = voci_processate
+        canale[1] = partite_consumate
+        if canale[2]:
+            raise JobAnnullato()
+
+    with profila("calcolo_worker", profilo):
+        if percorso == "flusso":
+            risultato, statistiche = risolvi_a3_streaming(voci, partite, on_progress), None
+        elif motore == "min_righe":
+            risultato, statistiche = risolvi_a3_min_righe(voci, partite, budget_secondi, on_progress)
+        else:
+            risultato, statistiche = risolvi_a3(voci, partite, on_progress), None
+    return condividi_array(risultato.array()), statistiche
+
+
+def risolvi_in_processo(voci, partite, percorso="denso", motore="cascata", on_progress=None, profilo=False):
+    """
+    Come risolvi_a3 / risolvi_a3_streaming / risolvi_a3_min_righe, ma sul pool di
+    processi: la cascata non occupa il GIL del processo dell'app e gli array del
+    risultato tornano tramite file mappato, senza pickle. Restituisce (RisultatoA3, statistiche).
+
+    on_progress(voci, partite) viene chiamata qui, nel thread chiamante, con
+    l'avanzamento del worker; se solleva (annullamento, limite di tempo) il worker
+    viene fermato e l'eccezione rilanciata. Con `profilo` il profilo si registra nel worker,
+    dove gira la risoluzione (qui si aspetterebbe soltanto).
+    """
+    percorso_canale = _file_condiviso(3 * 8)
+    canale = np.memmap(percorso_canale, dtype=np.int64, mode="w+", shape=(3,))
+    try:
+        futuro = get_process_pool().submit(
+            _risolvi_nel_worker, voci, partite, percorso, motore, BUDGET_MIN_RIGHE, percorso_canale, profilo
+        )
+        while True:
+            try:
+                descrittore, statistiche = futuro.result(timeout=INTERVALLO_AVANZAMENTO)
+                break
+            except FuturesTimeoutError:
+                if on_progress is None:
+                    continue
+                try:
+                    on_progress(int(canale[0]), int(canale[1]))
+                except BaseException:
+                    canale[2] = 1 # Il worker si ferma alla prossima voce
+                    futuro.add_done_callback(_scarta_risultato)
+                    raise
+    finally:
+        del canale
+        _rimuovi_file(percorso_canale)
+
+    return RisultatoA3.da_array(voci, partite, apri_array_condivisi(descrittore)), statistiche
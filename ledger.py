@@ -0,0 +1,221 @@
+# ledger.py
+
+import os
+import sqlite3
+import threading
+from contextlib import closing
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from core_logic import colli_array, peso_array
+
+# Percorso del file ledger (configurabile da variabile d'ambiente)
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_LEDGER_PATH = os.environ.get(
+    "EASYM2_LEDGER_PATH", os.path.join(BASE_DIR, "easym2_ledger.sqlite")
+)
+
+_VALORI_VUOTI = {"", "none", "nan", "nat", "<na>"}
+
+# Colonne aggiunte da applica_disponibilita: valori letti dal ledger (NaN se assente)
+COLONNE_LETTURA = ("colli_ledger", "peso_ledger")
+
+
+class LedgerModificato(Exception):
+    """Il ledger è cambiato dopo la lettura delle disponibilità: scarico non registrato."""
+
+
+def _pulisci(valore):
+    """Normalizza una parte della chiave (None/'nan'/'None' -> '')."""
+    if valore is None:
+        return ""
+    testo = str(valore).strip().upper()
+    if testo.lower() in _VALORI_VUOTI:
+        return ""
+    return testo
+
+
+def chiavi_partite(partite_df):
+    """
+    Chiavi ledger (MRN, MRN-S, Contenitore, occorrenza) per ogni riga, in ordine.
+
+    'occorrenza' distingue righe con la stessa terna nello stesso A3
+    (0 per la prima, 1 per la seconda...), così i duplicati non si fondono.
+    Va calcolata sull'A3 completo, PRIMA di scartare le righe vuote/esaurite,
+    altrimenti le occorrenze cambiano da una dichiarazione all'altra.
+    """
+    mrn = partite_df["nome"].map(_pulisci)
+    if "MRN-S" in partite_df.columns:
+        mrns = partite_df["MRN-S"].map(_pulisci)
+    else:
+        mrns = pd.Series("", index=partite_df.index)
+    if "Contenitore" in partite_df.columns:
+        contenitore = partite_df["Contenitore"].map(_pulisci)
+    else:
+        contenitore = mrn
+
+    terne = pd.DataFrame({"mrn": mrn, "mrns": mrns, "contenitore": contenitore})
+    occorrenza = terne.groupby(["mrn", "mrns", "contenitore"], sort=False).cumcount()
+    return [
+        (m, s, c, int(o))
+        for m, s, c, o in zip(terne["mrn"], terne["mrns"], terne["contenitore"], occorrenza)
+    ]
+
+
+def _chiavi(partite_df):
+    """Usa la colonna 'chiave_ledger' se già calcolata (prima dei filtri), altrimenti la calcola."""
+    if "chiave_ledger" in partite_df.columns:
+        return list(partite_df["chiave_ledger"])
+    return chiavi_partite(partite_df)
+
+
+class LedgerA3:
+    """
+    Registro persistente (SQLite) delle disponibilità residue delle Partite A3.
+
+    Dopo ogni calcolo CONFERMATO si scala dal ledger quanto consumato da ogni
+    partita; il calcolo successivo legge i residui al posto dei valori del file A3.
+    Le letture avvengono su un dizionario in memoria (O(1) per riga); SQLite serve
+    alla persistenza tra riavvii e rende atomiche le registrazioni concorrenti.
+    """
+    def __init__(self, path=DEFAULT_LEDGER_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        with closing(self._connetti()) as conn, conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS disponibilita (
+                    mrn TEXT NOT NULL,
+                    mrns TEXT NOT NULL,
+                    contenitore TEXT NOT NULL,
+                    occorrenza INTEGER NOT NULL,
+                    colli REAL NOT NULL,
+                    peso REAL NOT NULL,
+                    riferimento TEXT,
+                    aggiornato TEXT NOT NULL,
+                    PRIMARY KEY (mrn, mrns, contenitore, occorrenza)
+                )
+                """
+            )
+        self._residui = {}
+        self._ricarica()
+
+    def _ricarica(self):
+        """Rilegge i residui da SQLite (anche quelli scritti da altri processi)."""
+        with closing(self._connetti()) as conn:
+            righe = conn.execute(
+                "SELECT mrn, mrns, contenitore, occorrenza, colli, peso FROM disponibilita"
+            ).fetchall()
+        self._residui = {tuple(r[:4]): (r[4], r[5]) for r in righe}
+
+    def _connetti(self):
+        # Connessione breve per operazione: il ledger è condiviso tra sessioni/thread
+        return sqlite3.connect(self.path, timeout=10)
+
+    def __len__(self):
+        return len(self._residui)
+
+    def residuo(self, chiave):
+        """(colli, peso) residui per la chiave, o None se la partita non è nel ledger."""
+        return self._residui.get(chiave)
+
+    def applica_disponibilita(self, partite_df):
+        """
+        Sostituisce colli/peso con i residui del ledger per le partite già registrate
+        e ne annota i valori letti (COLONNE_LETTURA, NaN se la partita non c'è):
+        registra() li usa per accorgersi di scarichi registrati nel frattempo.
+        Restituisce (partite_df aggiornato, numero di righe prese dal ledger).
+        """
+        partite_df = partite_df.copy()
+        chiavi = _chiavi(partite_df)
+        with self._lock:
+            residui = [self._residui.get(k) for k in chiavi]
+
+        colli = pd.to_numeric(partite_df["colli"], errors="coerce").to_numpy(dtype=float, copy=True)
+        peso = pd.to_numeric(partite_df["peso"], errors="coerce").to_numpy(dtype=float, copy=True)
+        colli_letti = np.full(len(partite_df), np.nan)
+        peso_letti = np.full(len(partite_df), np.nan)
+        n_trovate = 0
+        for pos, residuo in enumerate(residui):
+            if residuo is not None:
+                colli[pos], peso[pos] = residuo
+                colli_letti[pos], peso_letti[pos] = residuo
+                n_trovate += 1
+
+        partite_df["colli"] = colli
+        partite_df["peso"] = peso
+        partite_df["colli_ledger"] = colli_letti
+        partite_df["peso_ledger"] = peso_letti
+        return partite_df, n_trovate
+
+    def registra(self, partite_df, colli_residui, peso_residui, riferimento=None):
+        """
+        Registra lo scarico di un calcolo confermato come CONSUMO (disponibilità usata
+        meno residuo), scalato in modo atomico dai valori salvati.
+        partite_df deve venire da applica_disponibilita (COLONNE_LETTURA); i residui
+        sono allineati per POSIZIONE alle sue righe. Se nel frattempo il ledger è
+        cambiato (es. scarico registrato da un'altra sessione) non registra nulla
+        e solleva LedgerModificato. Restituisce il numero di partite scaricate.
+        """
+        if not set(COLONNE_LETTURA) <= set(partite_df.columns):
+            raise ValueError("Disponibilità non lette dal ledger: attiva i residui del ledger e ricalcola.")
+        chiavi = _chiavi(partite_df)
+        consumo_colli = np.round(colli_array(partite_df) - np.asarray(colli_residui, dtype=float), 0)
+        consumo_peso = np.round(peso_array(partite_df) - np.asarray(peso_residui, dtype=float), 3)
+        colli_letti = partite_df["colli_ledger"].to_numpy(dtype=float)
+        peso_letti = partite_df["peso_ledger"].to_numpy(dtype=float)
+        colli_residui = np.round(np.asarray(colli_residui, dtype=float), 0)
+        peso_residui = np.round(np.asarray(peso_residui, dtype=float), 3)
+        adesso = datetime.now().isoformat(timespec="seconds")
+
+        n_scaricate = 0
+        with self._lock:
+            try:
+                with closing(self._connetti()) as conn, conn:
+                    for pos, chiave in enumerate(chiavi):
+                        if consumo_colli[pos] == 0 and consumo_peso[pos] == 0:
+                            continue # Partita non toccata: nulla da scalare
+                        if np.isnan(colli_letti[pos]):
+                            # Prima registrazione della partita: fallisce se un'altra
+                            # sessione l'ha inserita dopo la lettura
+                            conn.execute(
+                                """
+                                INSERT INTO disponibilita
+                                (mrn, mrns, contenitore, occorrenza, colli, peso, riferimento, aggiornato)
+                                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                                """,
+                                (*chiave, float(colli_residui[pos]), float(peso_residui[pos]), riferimento, adesso)
+                            )
+                        else:
+                            # Scalato nel database (niente scritture di valori assoluti),
+                            # solo se i valori sono ancora quelli letti per il calcolo
+                            aggiornate = conn.execute(
+                                """
+                                UPDATE disponibilita
+                                SET colli = ROUND(colli - ?, 0), peso = ROUND(peso - ?, 3),
+                                    riferimento = ?, aggiornato = ?
+                                WHERE mrn = ? AND mrns = ? AND contenitore = ? AND occorrenza = ?
+                                    AND colli = ? AND peso = ?
+                                """,
+                                (
+                                    float(consumo_colli[pos]), float(consumo_peso[pos]), riferimento, adesso,
+                                    *chiave, float(colli_letti[pos]), float(peso_letti[pos])
+                                )
+                            ).rowcount
+                            if not aggiornate:
+                                raise LedgerModificato(f"partita {chiave[0]} ({chiave[2]}) scaricata da un'altra registrazione")
+                        n_scaricate += 1
+            except sqlite3.IntegrityError as e:
+                raise LedgerModificato("partita registrata da un'altra sessione dopo il calcolo") from e
+            finally:
+                self._ricarica() # Anche dopo un conflitto: il prossimo calcolo legge i valori aggiornati
+        return n_scaricate
+
+    def azzera(self):
+        """Svuota il ledger (es. a inizio di un nuovo lotto A3)."""
+        with self._lock:
+            with closing(self._connetti()) as conn, conn:
+                conn.execute("DELETE FROM disponibilita")
+            self._residui.clear()
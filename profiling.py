@@ -0,0 +1,226 @@
+# profiling.py
+
+import cProfile
+import hashlib
+import importlib
+import io
+import json
+import os
+import pstats
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+import pandas as pd
+
+# --- CONFIGURAZIONE ---
+# Attivazione: variabile d'ambiente EASYM2_PROFILE=1 oppure parametro URL ?profile=1
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+PROFILE_DIR = os.environ.get("EASYM2_PROFILE_DIR", os.path.join(BASE_DIR, "profili"))
+
+# cProfile e tracemalloc sono globali al processo: un solo blocco profilato alla volta
+_PROFILE_LOCK = threading.Lock()
+
+# Librerie caricate solo al primo uso (PDF, Excel, encoding): non devono comparire all'avvio
+LIBRERIE_DIFFERITE = ("fpdf", "pypdfium2", "pdfplumber", "pdfminer", "chardet", "openpyxl", "xlrd", "pyxlsb", "xlsxwriter")
+# Moduli importati da app.py prima del primo widget
+MODULI_AVVIO = ("streamlit", "core_logic", "styles", "data_utils", "jobs", "ledger", "profiling")
+
+# Modulo -> secondi del primo import nel processo (import differiti)
+TEMPI_IMPORT = {}
+
+
+def profiling_da_env():
+    return os.environ.get("EASYM2_PROFILE", "").strip().lower() in ("1", "true", "yes", "si")
+
+
+# --- IMPORT DIFFERITI ---
+
+def importa(nome):
+    """
+    Modulo `nome`, importato al primo uso invece che all'avvio dell'app
+    (es. fpdf solo quando si crea un PDF). Il tempo del primo import va in TEMPI_IMPORT.
+    """
+    gia_caricato = nome in sys.modules
+    inizio = time.perf_counter()
+    modulo = importlib.import_module(nome)
+    if not gia_caricato:
+        TEMPI_IMPORT.setdefault(nome, round(time.perf_counter() - inizio, 4))
+    return modulo
+
+
+def tempi_avvio():
+    """
+    Import a freddo dei moduli dell'app in un interprete nuovo (-X importtime).
+    Restituisce {"totale_s", "moduli": {modulo: secondi}, "differite_caricate": [...]}:
+    le librerie differite caricate all'avvio sono una regressione.
+    """
+    codice = (
+        f"import sys; import {', '.join(MODULI_AVVIO)}; "
+        f"print(','.join(m for m in {LIBRERIE_DIFFERITE!r} if m in sys.modules))"
+    )
+    esito = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", codice],
+        capture_output=True, text=True, cwd=BASE_DIR, check=True
+    )
+    moduli = {}
+    for riga in esito.stderr.splitlines():
+        # "import time:  self [us] | cumulative | imported package" (i nidificati sono indentati)
+        parti = riga.split("|")
+        if riga.startswith("import time:") and len(parti) == 3 and parti[2].rstrip()[1:] in MODULI_AVVIO:
+            moduli[parti[2].strip()] = round(int(parti[1]) / 1e6, 4)
+    return {
+        "totale_s": round(sum(moduli.values()), 4),
+        "moduli": moduli,
+        "differite_caricate": [m for m in esito.stdout.strip().split(",") if m],
+    }
+
+
+# --- ANONIMIZZAZIONE ---
+
+def anonimizza(df, sale):
+    """
+    Copia di df con i valori testuali sostituiti da token stabili (stesso valore ->
+    stesso token, quindi duplicati e corrispondenze restano); i numeri non cambiano.
+    """
+    anonimo = df.copy()
+    for c in anonimo.columns:
+        if pd.api.types.is_numeric_dtype(anonimo[c]):
+            continue
+        anonimo[c] = anonimo[c].astype(object).map(
+            lambda v: v if v is None or (isinstance(v, float) and pd.isna(v))
+            else "X" + hashlib.sha256(sale + str(v).encode()).hexdigest()[:10]
+        )
+    return anonimo
+
+
+# --- PROFILAZIONE ---
+
+@contextmanager
+def profila(fase, attivo):
+    """
+    Se `attivo`, esegue il blocco sotto cProfile + tracemalloc e salva in PROFILE_DIR:
+    - profilo.prof (pstats) e riepilogo.txt (funzioni più costose)
+    - meta.json (tempo, picco memoria)
+    - <nome>.csv: snapshot ANONIMIZZATO degli input, per rieseguire il caso offline
+
+    Il blocco riceve un dizionario in cui mettere i DataFrame da salvare:
+
+        with profila("run_processing", attivo) as snapshot:
+            snapshot["voci"] = voci_df
+    """
+    snapshot = {}
+    if not attivo or not _PROFILE_LOCK.acquire(blocking=False):
+        # Profilazione spenta (o già in corso in un'altra sessione): nessun overhead
+        yield snapshot
+        return
+
+    profiler = cProfile.Profile()
+    tracemalloc_gia_attivo = tracemalloc.is_tracing()
+    if tracemalloc_gia_attivo:
+        tracemalloc.reset_peak()
+    else:
+        tracemalloc.start()
+
+    inizio = time.perf_counter()
+    esito = "ok"
+    try:
+        try:
+            profiler.enable()
+        except ValueError:
+            profiler = None # Un altro profiler è già attivo nel processo
+        yield snapshot
+    except BaseException as e:
+        esito = f"errore: {type(e).__name__}"
+        raise
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        durata = time.perf_counter() - inizio
+        _, picco = tracemalloc.get_traced_memory()
+        if not tracemalloc_gia_attivo:
+            tracemalloc.stop()
+        try:
+            _salva_profilo(fase, profiler, durata, picco, esito, snapshot)
+        except Exception:
+            pass # La profilazione non deve mai bloccare l'operatore
+        finally:
+            _PROFILE_LOCK.release()
+
+
+def _salva_profilo(fase, profiler, durata, picco, esito, snapshot):
+    cartella = os.path.join(
+        PROFILE_DIR, f"{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}_{fase}"
+    )
+    os.makedirs(cartella, exist_ok=True)
+
+    if profiler is not None:
+        profiler.dump_stats(os.path.join(cartella, "profilo.prof"))
+        riepilogo = io.StringIO()
+        pstats.Stats(profiler, stream=riepilogo).sort_stats("cumulative").print_stats(40)
+        with open(os.path.join(cartella, "riepilogo.txt"), "w", encoding="utf-8") as f:
+            f.write(riepilogo.getvalue())
+
+    # Snapshot anonimizzato degli input (sale casuale per ogni profilo)
+    sale = os.urandom(8)
+    tabelle = {}
+    for nome, df in snapshot.items():
+        if isinstance(df, pd.DataFrame):
+            anonimizza(df, sale).to_csv(os.path.join(cartella, f"{nome}.csv"), index=False)
+            tabelle[nome] = list(df.shape)
+
+    with open(os.path.join(cartella, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump({
+            "fase": fase,
+            "esito": esito,
+            "durata_s": round(durata, 4),
+            "picco_memoria_mb": round(picco / 1e6, 2),
+            "tabelle": tabelle,
+            "import_differiti_s": dict(TEMPI_IMPORT),
+            "python": sys.version.split()[0],
+            "pandas": pd.__version__,
+        }, f, indent=2)
+
+
+# --- RIESECUZIONE OFFLINE ---
+
+def riesegui_calcolo(cartella):
+    """Riesegue SolverA3 sugli input anonimizzati di un profilo e stampa i tempi."""
+    from core_logic import SolverA3
+
+    voci = pd.read_csv(os.path.join(cartella, "voci.csv"))
+    partite = pd.read_csv(os.path.join(cartella, "partite.csv"))
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    SolverA3(voci, partite).risolvi()
+    profiler.disable()
+    pstats.Stats(profiler).sort_stats("cumulative").print_stats(25)
+
+
+def registra_avvio():
+    """Misura l'avvio a freddo, lo stampa e lo accoda a PROFILE_DIR/avvio.jsonl (storico regressioni)."""
+    misura = {"data": datetime.now().isoformat(timespec="seconds"), **tempi_avvio()}
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    with open(os.path.join(PROFILE_DIR, "avvio.jsonl"), "a", encoding="utf-8") as f:
+        f.write(json.dumps(misura) + "\n")
+
+    print(f"Avvio a freddo: {misura['totale_s']:.3f} s")
+    for modulo, secondi in misura["moduli"].items():
+        print(f"  {modulo:<12} {secondi:.3f} s")
+    if misura["differite_caricate"]:
+        print(f"ATTENZIONE: librerie differite caricate all'avvio: {', '.join(misura['differite_caricate'])}")
+    return misura
+
+
+if __name__ == "__main__":
+    # Uso: python profiling.py <cartella_profilo>   (riesecuzione di un profilo)
+    #      python profiling.py --avvio              (tempi di import all'avvio)
+    if sys.argv[1:] == ["--avvio"]:
+        registra_avvio()
+    else:
+        riesegui_calcolo(sys.argv[1])
@@ -0,0 +1,359 @@
+# prova_carico.py
+
+# Prova di carico dell'app con più operatori contemporanei. Ogni sessione è un AppTest
+# di Streamlit (headless) nello STESSO processo: cache_resource, pool di processi e
+# worker dei job sono condivisi come nel deployment unico dello sportello.
+# Ogni sessione segue il copione di un operatore: apertura, upload bolla PDF, upload A3,
+# modifiche nell'editor, Calcola M2, pagina dei risultati con i download PDF/Excel.
+# Riporta i percentili di latenza per passo e la memoria per sessione.
+#
+# Uso: python prova_carico.py [--sessioni 20] [--concorrenza 20] [--voci 50] [--partite 200]
+#                             [--pausa 1.0] [--rampa 5] [--seme 0] [--uscita cartella]
+#
+# AppTest non simula st.data_editor: le modifiche alle righe passano da session_state
+# (stesso master e stessa verifica totali di un'edizione vera, senza il widget).
+# AppTest installa un runtime globale a ogni run: i rerun delle sessioni sono quindi
+# serializzati (uno alla volta, come gli script che si contendono il GIL nel server),
+# mentre letture, calcoli ed export in background restano concorrenti. L'attesa del
+# turno di ogni rerun è riportata a parte ("attesa_rerun").
+
+import argparse
+import io
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+APP = os.path.join(BASE_DIR, "app.py")
+
+PASSI = ("apertura", "upload_pdf", "upload_a3", "modifica_righe", "calcola_m2", "download")
+MISURE = PASSI + ("attesa_rerun",)
+PERCENTILI = (50, 90, 95, 99)
+ATTESA_RUN = 120 # Secondi massimi di un singolo rerun (AppTest default_timeout)
+ATTESA_JOB = 600 # Secondi massimi di una lettura o di un calcolo in background
+
+# Un solo AppTest.run alla volta nel processo (runtime e opzioni di config sono globali)
+_RERUN = threading.Lock()
+
+
+# --- DOCUMENTI DEL COPIONE ---
+
+def genera_documenti(generatore, n_voci, n_partite):
+    """
+    Bolla PDF e file A3 (Excel) con totali che quadrano: pesi in grammi interi,
+    ripartiti tra le partite con tagli casuali. Restituisce (pdf bytes, xlsx bytes).
+    """
+    from fpdf import FPDF
+
+    colli_voci = generatore.integers(1, 50, n_voci)
+    grammi_voci = generatore.integers(1_000, 2_000_000, n_voci)
+
+    pdf = FPDF()
+    pdf.set_font("Helvetica", size=9)
+    pdf.add_page()
+    for k, (colli, grammi) in enumerate(zip(colli_voci, grammi_voci)):
+        peso = f"{grammi / 1000:.3f}".replace(".", ",")
+        for riga in (f"Sing. {k + 1} Reg. 40 00", f"Colli PK {colli}", f"P.lordo (kg) {peso}", f"Taric {8_400_000_000 + k}"):
+            pdf.cell(0, 4, riga, new_x="LMARGIN", new_y="NEXT")
+
+    def _ripartisci(totale, minimo):
+        # n_partite quote >= minimo che sommano a totale
+        tagli = np.sort(generatore.integers(0, totale - minimo * n_partite + 1, n_partite - 1))
+        return np.diff(np.concatenate(([0], tagli, [totale - minimo * n_partite]))) + minimo
+
+    colli_partite = _ripartisci(int(colli_voci.sum()), 0)
+    grammi_partite = _ripartisci(int(grammi_voci.sum()), 1)
+    a3 = pd.DataFrame({
+        "MRN": [f"26IT{generatore.integers(10**9, 10**10)}A{i}" for i in range(n_partite)],
+        "Colli": colli_partite,
+        "Peso": grammi_partite / 1000,
+        "Container": [f"MSCU{1_000_000 + i % max(1, n_partite // 10)}" for i in range(n_partite)],
+    })
+    buffer = io.BytesIO()
+    a3.to_excel(buffer, index=False)
+    return bytes(pdf.output()), buffer.getvalue()
+
+
+# --- MISURE ---
+
+def _dimensione(valore, visti):
+    """Byte occupati (approssimati) da un valore di session_state."""
+    if id(valore) in visti:
+        return 0
+    visti.add(id(valore))
+    if isinstance(valore, pd.DataFrame):
+        return int(valore.memory_usage(deep=True).sum())
+    if isinstance(valore, pd.Series):
+        return int(valore.memory_usage(deep=True))
+    if isinstance(valore, np.ndarray):
+        return valore.nbytes
+    if isinstance(valore, (bytes, bytearray, str)):
+        return len(valore)
+    if isinstance(valore, dict):
+        return sum(_dimensione(v, visti) for v in valore.values())
+    if isinstance(valore, (list, tuple)):
+        return sum(_dimensione(v, visti) for v in valore)
+    if hasattr(valore, "__dict__"):
+        return sum(_dimensione(v, visti) for v in vars(valore).values())
+    return sys.getsizeof(valore)
+
+
+def memoria_sessione(at):
+    """MB di session_state di una sessione (tabelle, risultati, export)."""
+    visti = set()
+    return sum(_dimensione(v, visti) for v in at.session_state.values()) / 1e6
+
+
+def _rss_mb(pid):
+    """Memoria residente attuale di un processo (MB, da /proc: solo Linux; 0 se non leggibile)."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for riga in f:
+                if riga.startswith("VmRSS:"):
+                    return int(riga.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+
+class CampionatoreMemoria(threading.Thread):
+    """Campiona ogni `intervallo` secondi la memoria del processo e dei worker del pool; tiene i picchi."""
+
+    def __init__(self, pid_worker, intervallo=0.5):
+        super().__init__(daemon=True)
+        self.pid_worker = list(pid_worker)
+        self.intervallo = intervallo
+        self.picco = {"processo": 0.0, "worker": 0.0}
+        self._ferma = threading.Event()
+
+    def campiona(self):
+        attuale = {
+            "processo": _rss_mb(os.getpid()),
+            "worker": sum(_rss_mb(pid) for pid in self.pid_worker),
+        }
+        for chiave, valore in attuale.items():
+            self.picco[chiave] = max(self.picco[chiave], valore)
+        return attuale
+
+    def run(self):
+        while not self._ferma.wait(self.intervallo):
+            self.campiona()
+
+    def ferma(self):
+        self._ferma.set()
+        self.join()
+        self.campiona()
+
+
+# --- SESSIONE ---
+
+class ErroreSessione(Exception):
+    """Un passo del copione non ha prodotto il risultato atteso."""
+
+
+def _controlla(at, passo):
+    if at.exception:
+        raise ErroreSessione(f"{passo}: {at.exception[0].value}")
+
+
+def _rerun(at, tempi):
+    """AppTest.run nel proprio turno; l'attesa del turno va in tempi["attesa_rerun"]."""
+    inizio = time.perf_counter()
+    with _RERUN:
+        tempi["attesa_rerun"].append(time.perf_counter() - inizio)
+        at.run()
+
+
+def _attendi_job(at, chiave, passo, tempi):
+    """Attende il job in background `chiave` e rilancia l'app per applicarne il risultato."""
+    scadenza = time.monotonic() + ATTESA_JOB
+    while True:
+        job = at.session_state[chiave] if chiave in at.session_state else None
+        if job is None or job.done():
+            break
+        if time.monotonic() > scadenza:
+            job.cancel()
+            raise ErroreSessione(f"{passo}: oltre {ATTESA_JOB} s")
+        time.sleep(0.05)
+    _rerun(at, tempi)
+    _controlla(at, passo)
+
+
+def esegui_sessione(indice, documenti, pausa, generatore):
+    """
+    Copione di un operatore su un nuovo AppTest. Restituisce
+    {"sessione", "tempi": {passo: [secondi, ...]}, "memoria_mb", "errore"}.
+    """
+    from streamlit.testing.v1 import AppTest
+
+    pdf, a3 = documenti
+    tempi = {misura: [] for misura in MISURE}
+    esito = {"sessione": indice, "tempi": tempi, "memoria_mb": None, "errore": None}
+    at = AppTest.from_file(APP, default_timeout=ATTESA_RUN)
+
+    def passo(nome, azione):
+        inizio = time.perf_counter()
+        azione()
+        tempi[nome].append(time.perf_counter() - inizio)
+        time.sleep(pausa * generatore.uniform(0.5, 1.5)) # Tempo di lettura dell'operatore
+
+    def apertura():
+        _rerun(at, tempi)
+        _controlla(at, "apertura")
+
+    def upload_pdf():
+        at.file_uploader(key="pdf_bolla").set_value([("bolla.pdf", pdf, "application/pdf")])
+        _rerun(at, tempi)
+        _attendi_job(at, "job_bolle", "upload_pdf", tempi)
+        if at.session_state["voci_data_source"].empty or not at.success:
+            raise ErroreSessione("upload_pdf: nessuna voce estratta")
+
+    def upload_a3():
+        at.file_uploader(key="excel_a3").set_value([(
+            "a3.xlsx", a3, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        )])
+        _rerun(at, tempi)
+        _attendi_job(at, "job_a3", "upload_a3", tempi)
+
+    def modifica_riga(delta):
+        # Come una correzione nell'editor: stessa tabella master, un valore diverso
+        voci = at.session_state["voci_data_source"].copy()
+        voci.loc[voci.index[0], "Colli"] += delta
+        at.session_state["voci_data_source"] = voci
+        _rerun(at, tempi)
+        _controlla(at, "modifica_righe")
+
+    def calcola():
+        if at.button(key="main_calcola_m2").disabled:
+            raise ErroreSessione("calcola_m2: totali non quadrati, calcolo disabilitato")
+        at.button(key="main_calcola_m2").click()
+        _rerun(at, tempi)
+        _attendi_job(at, "job_calcolo", "calcola_m2", tempi)
+        if at.session_state["risultati"] is None:
+            raise ErroreSessione(f"calcola_m2: {at.session_state['job_esito']}")
+
+    def download():
+        # Rerun della pagina risultati: i download PDF/Excel vengono registrati a ogni rerun
+        _rerun(at, tempi)
+        _controlla(at, "download")
+        risultati = at.session_state["risultati"]
+        if not risultati["pdf_output"] or not risultati["excel_output"]:
+            raise ErroreSessione("download: export vuoti")
+
+    try:
+        passo("apertura", apertura)
+        passo("upload_pdf", upload_pdf)
+        passo("upload_a3", upload_a3)
+        passo("modifica_righe", lambda: modifica_riga(1))
+        passo("modifica_righe", lambda: modifica_riga(-1))
+        passo("calcola_m2", calcola)
+        passo("download", download)
+    except Exception as e:
+        esito["errore"] = str(e) if isinstance(e, ErroreSessione) else f"{type(e).__name__}: {e}"
+    esito["memoria_mb"] = memoria_sessione(at)
+    return esito
+
+
+# --- ESECUZIONE ---
+
+def _statistiche(valori):
+    if not valori:
+        return None
+    valori = np.asarray(valori)
+    return {
+        "n": int(valori.size),
+        **{f"p{p}": float(np.percentile(valori, p)) for p in PERCENTILI},
+        "max": float(valori.max()),
+    }
+
+
+def esegui(sessioni=20, concorrenza=20, voci=50, partite=200, pausa=1.0, rampa=5.0, seme=0, uscita=None):
+    from jobs import reset_process_pool, riscalda_pool
+
+    generatore = np.random.default_rng(seme)
+    # Documenti diversi per ogni operatore: niente risultati condivisi in cache tra sessioni
+    documenti = [genera_documenti(generatore, voci, partite) for _ in range(sessioni)]
+    generatori = [np.random.default_rng([seme, i]) for i in range(sessioni)]
+    campionatore = CampionatoreMemoria(riscalda_pool())
+    memoria_iniziale = campionatore.campiona()
+    campionatore.start()
+
+    def avvia(i):
+        time.sleep(rampa * i / max(1, sessioni)) # Arrivo graduale degli operatori
+        return esegui_sessione(i, documenti[i], pausa, generatori[i])
+
+    inizio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concorrenza, thread_name_prefix="prova-carico") as esecutore:
+        esiti = list(esecutore.map(avvia, range(sessioni)))
+    durata = time.perf_counter() - inizio
+    campionatore.ferma()
+    reset_process_pool()
+
+    errori = [e for e in esiti if e["errore"]]
+    rapporto = {
+        "parametri": {
+            "sessioni": sessioni, "concorrenza": concorrenza, "voci": voci, "partite": partite,
+            "pausa": pausa, "rampa": rampa, "seme": seme, "thread": threading.active_count(),
+        },
+        "durata_s": durata,
+        "sessioni_completate": sessioni - len(errori),
+        "latenze_s": {m: _statistiche([t for e in esiti for t in e["tempi"][m]]) for m in MISURE},
+        "memoria_sessione_mb": _statistiche([e["memoria_mb"] for e in esiti]),
+        "rss_mb": {"iniziale": memoria_iniziale, "picco": campionatore.picco},
+        "errori": [{"sessione": e["sessione"], "errore": e["errore"]} for e in errori],
+    }
+
+    print(
+        f"{sessioni} sessioni, {concorrenza} concorrenti ({voci} voci x {partite} partite, "
+        f"pausa {pausa} s, rampa {rampa} s): {durata:.1f} s, {rapporto['sessioni_completate']} completate"
+    )
+    print(f"  {'passo':<16}{'n':>5}" + "".join(f"{f'p{p}':>9}" for p in PERCENTILI) + f"{'max':>9}   (s)")
+    for nome, stat in rapporto["latenze_s"].items():
+        if stat:
+            print(f"  {nome:<16}{stat['n']:>5}" + "".join(f"{stat[f'p{p}']:>9.3f}" for p in PERCENTILI) + f"{stat['max']:>9.3f}")
+    memoria = rapporto["memoria_sessione_mb"]
+    print(f"  memoria per sessione: p50 {memoria['p50']:.2f} MB, p95 {memoria['p95']:.2f} MB, max {memoria['max']:.2f} MB")
+    print(
+        f"  picco RSS: processo {rapporto['rss_mb']['picco']['processo']:.0f} MB "
+        f"(iniziale {memoria_iniziale['processo']:.0f} MB), "
+        f"worker {rapporto['rss_mb']['picco']['worker']:.0f} MB (iniziale {memoria_iniziale['worker']:.0f} MB)"
+    )
+    for errore in rapporto["errori"][:10]:
+        print(f"- sessione {errore['sessione']}: {errore['errore']}")
+
+    if uscita:
+        os.makedirs(uscita, exist_ok=True)
+        with open(os.path.join(uscita, "prova_carico.json"), "w", encoding="utf-8") as f:
+            json.dump({**rapporto, "sessioni": esiti}, f, indent=2, ensure_ascii=False)
+        print(f"Dettagli in {os.path.join(uscita, 'prova_carico.json')}")
+    return 1 if errori else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prova di carico dell'app con sessioni concorrenti (AppTest)")
+    parser.add_argument("--sessioni", type=int, default=20)
+    parser.add_argument("--concorrenza", type=int, default=20, help="Sessioni attive contemporaneamente")
+    parser.add_argument("--voci", type=int, default=50, help="Voci per bolla")
+    parser.add_argument("--partite", type=int, default=200, help="Partite per file A3")
+    parser.add_argument("--pausa", type=float, default=1.0, help="Secondi medi di lettura tra un passo e l'altro")
+    parser.add_argument("--rampa", type=float, default=5.0, help="Secondi in cui arrivano tutte le sessioni")
+    parser.add_argument("--seme", type=int, default=0)
+    parser.add_argument("--uscita", default=None, help="Cartella in cui salvare il rapporto (JSON)")
+    argomenti = parser.parse_args()
+    # Thread della prova e job in background girano fuori dal runtime di AppTest: avvisi inutili qui
+    for nome_logger, avviso in (
+        ("streamlit.runtime.scriptrunner_utils.script_run_context", "missing ScriptRunContext"),
+        ("streamlit.runtime.caching.cache_data_api", "No runtime found"),
+    ):
+        logging.getLogger(nome_logger).addFilter(lambda record, avviso=avviso: avviso not in record.getMessage())
+    sys.exit(esegui(
+        argomenti.sessioni, argomenti.concorrenza, argomenti.voci, argomenti.partite,
+        argomenti.pausa, argomenti.rampa, argomenti.seme, argomenti.uscita
+    ))
@@ -0,0 +1,251 @@
+# servizio.py
+
+# Servizio HTTP/JSON locale (nessuna connessione esterna) per altri strumenti interni.
+# Avvio: python servizio.py   (EASYM2_SERVIZIO_HOST / EASYM2_SERVIZIO_PORTA per cambiare indirizzo)
+#
+#   GET  /salute                         -> stato del servizio
+#   POST /bolla           (corpo: PDF)   -> voci estratte dalla bolla
+#   POST /a3?nome=f.xlsx  (corpo: file)  -> partite A3 riconosciute
+#   POST /risolvi         (corpo: JSON)  -> allocazioni M2
+#        {"voci": [{"Voce Doganale", "Colli", "Peso lordo"}, ...],
+#         "partite": [{"Partita A3/MRN", "Colli", "Peso lordo", "Contenitore", "MRN-S"}, ...],
+#         "formato": "json" | "csv" | "jsonl" | "parquet" | "xlsx" | "pdf",
+#         "motore": "cascata" | "min_righe"}
+#
+# Il lavoro gira sul pool di processi condiviso (jobs.get_process_pool), avviato e
+# "riscaldato" all'avvio; le richieste oltre la coda ricevono 503.
+
+import json
+import os
+import threading
+import time
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pandas as pd
+
+from core_logic import estrai_dati_bolla_da_bytes, risolvi_a3, risolvi_a3_min_righe, risolvi_a3_streaming
+from data_utils import leggi_a3_da_bytes, prepara_dati_solver
+from jobs import (
+    BUDGET_MIN_RIGHE, MAX_PROCESS_WORKERS, MAX_SECONDI_CALCOLO, LimiteSuperato,
+    get_process_pool, reset_process_pool, riscalda_pool, stima_calcolo
+)
+from styles import (
+    create_bulk_exports, create_excel_from_df, create_pdf_from_df,
+    prepare_data_entry_export_da_risultato
+)
+
+# --- CONFIGURAZIONE ---
+HOST = os.environ.get("EASYM2_SERVIZIO_HOST", "127.0.0.1")
+PORTA = int(os.environ.get("EASYM2_SERVIZIO_PORTA", 8765))
+MAX_RICHIESTE = int(os.environ.get("EASYM2_SERVIZIO_CODA", 2 * MAX_PROCESS_WORKERS)) # In esecuzione + in coda
+MAX_BYTE_RICHIESTA = 50 * 1024 * 1024
+ATTESA_MASSIMA = MAX_SECONDI_CALCOLO + 60 # Secondi di attesa del risultato di un worker
+
+_POSTI = threading.BoundedSemaphore(MAX_RICHIESTE)
+
+# Colonne della bolla -> colonne dell'editor voci (come nell'app)
+COLONNE_VOCI_PDF = {"Voce": "Voce Doganale", "Colli Totali": "Colli", "Peso Totale": "Peso lordo"}
+
+TIPI_FORMATO = {
+    "json": "application/json",
+    "csv": "text/csv; charset=utf-8",
+    "jsonl": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "pdf": "application/pdf",
+}
+
+
+class RichiestaNonValida(ValueError):
+    """Dati della richiesta non utilizzabili (risposta 400)."""
+
+
+def _tabella_json(df):
+    """Righe di un DataFrame come lista di dizionari (NaN -> null)."""
+    return json.loads(df.to_json(orient="records", force_ascii=False))
+
+
+def _risposta_json(dati):
+    return TIPI_FORMATO["json"], json.dumps(dati, ensure_ascii=False).encode("utf-8")
+
+
+# --- LAVORI (eseguiti nei processi worker) ---
+
+def lavoro_bolla(contenuto):
+    voci = estrai_dati_bolla_da_bytes(contenuto)
+    if voci.empty:
+        raise RichiestaNonValida("Nessuna voce trovata nel PDF.")
+    return _risposta_json({"voci": _tabella_json(voci.rename(columns=COLONNE_VOCI_PDF))})
+
+
+def lavoro_a3(nome_file, contenuto):
+    partite = leggi_a3_da_bytes(nome_file, contenuto)
+    if partite.empty:
+        raise RichiestaNonValida("Impossibile leggere il file A3 (formati: .xls/.xlsx/.csv).")
+    return _risposta_json({"partite": _tabella_json(partite)})
+
+
+def lavoro_risolvi(richiesta):
+    formato = richiesta.get("formato", "json")
+    if formato not in TIPI_FORMATO:
+        raise RichiestaNonValida(f"Formato non supportato: {formato}")
+    motore = richiesta.get("motore", "cascata")
+    if motore not in ("cascata", "min_righe"):
+        raise RichiestaNonValida(f"Motore non supportato: {motore}")
+    for chiave in ("voci", "partite"):
+        if not isinstance(richiesta.get(chiave) or [], list):
+            raise RichiestaNonValida(f"'{chiave}' deve essere una lista di righe.")
+
+    report_msg, voci, partite = prepara_dati_solver(
+        pd.DataFrame(richiesta.get("voci") or []),
+        pd.DataFrame(richiesta.get("partite") or [])
+    )
+    if voci is None:
+        raise RichiestaNonValida(report_msg)
+
+    # Stessi limiti dell'app: rifiuto oltre MAX_RIGHE, cascata a flusso oltre MAX_CELLE_GRIGLIA
+    stima = stima_calcolo(len(voci), len(partite))
+    if stima["rifiutato"]:
+        raise LimiteSuperato(stima["rifiutato"])
+
+    inizio = time.monotonic()
+    def on_progress(voci_processate, partite_consumate):
+        if time.monotonic() - inizio > MAX_SECONDI_CALCOLO:
+            raise LimiteSuperato(f"tempo di calcolo oltre {MAX_SECONDI_CALCOLO} s")
+
+    if stima["percorso"] == "flusso":
+        risultato = risolvi_a3_streaming(voci, partite, on_progress)
+    elif motore == "min_righe":
+        risultato, _ = risolvi_a3_min_righe(voci, partite, BUDGET_MIN_RIGHE, on_progress)
+    else:
+        risultato = risolvi_a3(voci, partite, on_progress)
+    df_export = prepare_data_entry_export_da_risultato(risultato)
+
+    if formato in ("csv", "jsonl", "parquet"):
+        esportazioni = create_bulk_exports(df_export)
+        if formato not in esportazioni:
+            raise RichiestaNonValida("Parquet non disponibile (pyarrow non installato).")
+        return TIPI_FORMATO[formato], esportazioni[formato]
+    if formato == "xlsx":
+        return TIPI_FORMATO[formato], create_excel_from_df(df_export)
+    if formato == "pdf":
+        return TIPI_FORMATO[formato], create_pdf_from_df(df_export)
+
+    voci_att = risultato.voci_attuali()
+    partite_norm = risultato.partite
+    residui = pd.DataFrame({
+        "Partita A3/MRN": partite_norm["nome"].astype(str),
+        "Contenitore": partite_norm["Contenitore"].astype(str),
+        "MRN-S": partite_norm["MRN-S"].astype(object),
+        "Colli residui": risultato.partite_colli_residui.round(0).astype(int),
+        "Peso residuo": risultato.partite_peso_residui.round(3),
+    })
+    return _risposta_json({
+        "messaggio": report_msg,
+        "percorso": stima["percorso"],
+        "quadratura": {
+            "colli": float(abs(voci_att["Colli Attesi"] - voci_att["Colli Allocati"]).sum()),
+            "peso": round(float(abs(voci_att["Peso Atteso"] - voci_att["Peso Allocato"]).sum()), 3),
+        },
+        "allocazioni": _tabella_json(df_export),
+        "partite_residue": _tabella_json(residui),
+    })
+
+
+# --- SERVER HTTP ---
+
+class GestoreRichieste(BaseHTTPRequestHandler):
+    server_version = "EasyM2/1.0"
+
+    def _rispondi(self, stato, tipo, dati, intestazioni=None):
+        self.send_response(stato)
+        self.send_header("Content-Type", tipo)
+        self.send_header("Content-Length", str(len(dati)))
+        for nome, valore in (intestazioni or {}).items():
+            self.send_header(nome, valore)
+        self.end_headers()
+        self.wfile.write(dati)
+
+    def _errore(self, stato, messaggio, intestazioni=None):
+        self._rispondi(stato, *_risposta_json({"errore": messaggio}), intestazioni)
+
+    def do_GET(self):
+        if urlparse(self.path).path != "/salute":
+            return self._errore(404, "Percorso sconosciuto.")
+        self._rispondi(200, *_risposta_json({
+            "stato": "ok", "worker": MAX_PROCESS_WORKERS, "max_richieste": MAX_RICHIESTE
+        }))
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path not in ("/bolla", "/a3", "/risolvi"):
+            return self._errore(404, "Percorso sconosciuto.")
+
+        lunghezza = int(self.headers.get("Content-Length") or 0)
+        if lunghezza > MAX_BYTE_RICHIESTA:
+            return self._errore(413, f"Richiesta oltre {MAX_BYTE_RICHIESTA // (1024 * 1024)} MB.")
+
+        # Coda limitata: oltre MAX_RICHIESTE si rifiuta subito invece di accumulare.
+        # Il posto si libera quando il lavoro FINISCE davvero (non allo scadere dell'attesa:
+        # un worker già avviato non si può fermare e occupa ancora il pool)
+        if not _POSTI.acquire(blocking=False):
+            return self._errore(503, "Servizio occupato, riprova.", {"Retry-After": "5"})
+        futuro = None
+        try:
+            corpo = self.rfile.read(lunghezza)
+            pool = get_process_pool()
+            if url.path == "/bolla":
+                futuro = pool.submit(lavoro_bolla, corpo)
+            elif url.path == "/a3":
+                nome_file = parse_qs(url.query).get("nome", ["a3.xlsx"])[0]
+                futuro = pool.submit(lavoro_a3, nome_file, corpo)
+            else:
+                try:
+                    richiesta = json.loads(corpo or b"{}")
+                except ValueError:
+                    return self._errore(400, "JSON non valido.")
+                if not isinstance(richiesta, dict):
+                    return self._errore(400, "Il corpo JSON deve essere un oggetto.")
+                formato = parse_qs(url.query).get("formato")
+                if formato:
+                    richiesta["formato"] = formato[0]
+                futuro = pool.submit(lavoro_risolvi, richiesta)
+            futuro.add_done_callback(lambda _: _POSTI.release())
+
+            try:
+                self._rispondi(200, *futuro.result(timeout=ATTESA_MASSIMA))
+            except FuturesTimeoutError:
+                futuro.cancel() # Libera il posto solo se il lavoro era ancora in coda
+                self._errore(504, "Tempo di attesa scaduto.")
+        except RichiestaNonValida as e:
+            self._errore(400, str(e))
+        except LimiteSuperato as e:
+            self._errore(422, f"Oltre i limiti di risorse: {e}")
+        except BrokenProcessPool:
+            reset_process_pool() # Worker terminato: il prossimo uso ricrea il pool
+            self._errore(503, "Worker non disponibile, riprova.")
+        except Exception as e:
+            self._errore(500, f"Errore interno: {e}")
+        finally:
+            if futuro is None:
+                _POSTI.release() # Nessun lavoro avviato (errore prima o durante l'invio)
+
+
+def avvia(host=HOST, porta=PORTA):
+    worker = riscalda_pool()
+    server = ThreadingHTTPServer((host, porta), GestoreRichieste)
+    print(f"Servizio Easy M2 su http://{host}:{porta} ({len(worker)} worker pronti, max {MAX_RICHIESTE} richieste)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        reset_process_pool()
+
+
+if __name__ == "__main__":
+    avvia()
@@ -2,11 +2,22 @@
 
 import streamlit as st
 import pandas as pd
-from fpdf import FPDF, XPos, YPos
 import io
-import re 
 import numpy as np 
 import os 
+import base64
+import csv
+import json
+import functools
+
+from profiling import importa # fpdf solo al primo export PDF (import differito)
+
+# Parquet è opzionale: se pyarrow non è installato l'export bulk produce solo CSV e JSON Lines
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
 
 # ======================================================================
 # FUNZIONE CSS PRINCIPALE
@@ -147,22 +158,63 @@ def apply_custom_css():
     st.markdown(custom_css, unsafe_allow_html=True)
 
 
+# ======================================================================
+# ASSET STATICI (CACHE DI PROCESSO)
+# ======================================================================
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+LOGO_PATH = os.path.join(BASE_DIR, "LOGO_EASYM2.png")
+TEMPLATE_PATH = os.path.join(BASE_DIR, "EASYM2_A3_TEMPLATE.xlsx")
+
+
+def _leggi_bytes(path):
+    """Legge un file binario, None se non esiste."""
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+@st.cache_resource(show_spinner=False)
+def load_static_assets():
+    """
+    Carica logo e template UNA sola volta per processo (non a ogni rerun).
+    Il dizionario è condiviso tra tutte le sessioni e dal renderer PDF:
+    trattarlo come sola lettura.
+    """
+    logo_bytes = _leggi_bytes(LOGO_PATH)
+
+    # Tag HTML del logo già codificato in base64
+    if logo_bytes:
+        logo_base64 = base64.b64encode(logo_bytes).decode()
+        logo_img_tag = f'<img src="data:image/png;base64,{logo_base64}" style="height:auto; max-height:80px; width:auto;">'
+    else:
+        logo_img_tag = '<span style="font-size:2rem;">📦</span>'
+
+    return {
+        "logo_bytes": logo_bytes,
+        "logo_img_tag": logo_img_tag,
+        "template_bytes": _leggi_bytes(TEMPLATE_PATH),
+    }
+
+
 # ======================================================================
 # FUNZIONI HELPER PER PDF
 # ======================================================================
 
 # --- CLASSE PDF HELPER ---
-class PDF(FPDF):
+class _MetodiPDF:
+    """Metodi del report PDF; la classe vera (con FPDF come base) la crea _classe_pdf."""
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        # CORREZIONE: Il file fornito è .jpg
-        self.logo_path = "LOGO_EASYM2.png" 
+        # Logo già in memoria (cache di processo), nessuna lettura da disco per pagina
+        self.logo_bytes = load_static_assets()["logo_bytes"]
 
     def header(self):
         try:
-            # Usiamo un controllo file_exists più robusto
-            if self.logo_path and os.path.exists(self.logo_path):
-                 self.image(self.logo_path, 10, 8, 33)
+            if self.logo_bytes:
+                 self.image(self.logo_bytes, 10, 8, 33)
         except Exception:
             pass # Non bloccare il PDF se il logo manca
         self.set_font('Arial', 'B', 15)
@@ -241,11 +293,20 @@ class PDF(FPDF):
         self.cell(sum(widths), 0, '', 'T')
 
 
+@functools.lru_cache(maxsize=None)
+def _classe_pdf():
+    """
+    Classe PDF del report, creata una volta sola al primo export PDF: fpdf
+    (pesante) non si importa all'avvio dell'app.
+    """
+    return type("PDF", (_MetodiPDF, importa("fpdf").FPDF), {"__module__": __name__})
+
+
 def create_pdf_from_df(df_export):
     """Crea un file PDF FPDF dal DataFrame di esportazione (Formato Lungo)."""
     
     # Imposta orientamento a Portrait (Verticale)
-    pdf = PDF(orientation='P', unit='mm', format='A4')
+    pdf = _classe_pdf()(orientation='P', unit='mm', format='A4')
     
     pdf.add_page()
     pdf.set_font('Arial', '', 8)
@@ -276,18 +337,101 @@ def create_pdf_from_df(df_export):
     # Converti 'bytearray' in 'bytes' per st.download_button
     return bytes(pdf.output(dest='S'))
 
+
+def create_excel_from_df(df_export):
+    """Crea il file Excel (xlsxwriter) dal DataFrame di esportazione (Formato Lungo)."""
+    excel_data = io.BytesIO()
+    importa("xlsxwriter") # Al primo export Excel (tempo registrato)
+    with pd.ExcelWriter(excel_data, engine='xlsxwriter') as writer:
+         df_export.to_excel(writer, index=False, sheet_name='Data Entry M2')
+         
+         # 1. Ottieni il foglio di lavoro
+         worksheet = writer.sheets['Data Entry M2']
+         
+         # 2. Itera sulle colonne e imposta la larghezza
+         for i, col in enumerate(df_export.columns):
+             # Trova la larghezza massima (celle vuote/NaN contano 0)
+             lunghezze = df_export[col].astype(object).fillna("").astype(str).str.len()
+             max_len = max(
+                 int(lunghezze.max()) if len(lunghezze) else 0, # Larghezza dati
+                 len(str(col)) # Larghezza intestazione
+             )
+             # Imposta la larghezza della colonna (con un po' di padding)
+             worksheet.set_column(i, i, max_len + 2)
+             
+    return excel_data.getvalue()
+
+
+def _valore_export(valore):
+    """Valore nativo Python per CSV/JSON (NaN/None -> None, tipi NumPy -> int/float/str)."""
+    if valore is None or (isinstance(valore, float) and np.isnan(valore)):
+        return None
+    if isinstance(valore, (np.integer, int)):
+        return int(valore)
+    if isinstance(valore, (np.floating, float)):
+        return round(float(valore), 3)
+    return str(valore)
+
+
+def create_bulk_exports(df_export):
+    """
+    Export per il caricamento massivo nel gestionale doganale, senza passare dall'Excel.
+
+    Una sola passata sulle righe di allocazione (formato lungo, solo celle non vuote)
+    scrive insieme CSV (UTF-8, separatore ';') e JSON Lines (un oggetto per riga);
+    il Parquet si costruisce dalle stesse colonne, se pyarrow è disponibile.
+    Restituisce {"csv": bytes, "jsonl": bytes[, "parquet": bytes]}.
+    """
+    colonne = [str(c) for c in df_export.columns]
+    valori = [[_valore_export(v) for v in df_export[c].to_numpy(dtype=object)] for c in df_export.columns]
+
+    csv_data = io.StringIO()
+    writer = csv.writer(csv_data, delimiter=";", lineterminator="\n")
+    writer.writerow(colonne)
+    jsonl_data = io.StringIO()
+
+    for riga in zip(*valori):
+        writer.writerow(["" if v is None else (f"{v:.3f}" if isinstance(v, float) else v) for v in riga])
+        jsonl_data.write(json.dumps(dict(zip(colonne, riga)), ensure_ascii=False))
+        jsonl_data.write("\n")
+
+    esportazioni = {
+        "csv": csv_data.getvalue().encode("utf-8"),
+        "jsonl": jsonl_data.getvalue().encode("utf-8"),
+    }
+    if pa is not None:
+        parquet_data = io.BytesIO()
+        # Colonne testuali sempre string (anche se tutte vuote, es. MRN-S non fornito)
+        tabella = pa.table({
+            c: pa.array(v, type=pa.string()) if all(x is None or isinstance(x, str) for x in v) else pa.array(v)
+            for c, v in zip(colonne, valori)
+        })
+        pq.write_table(tabella, parquet_data)
+        esportazioni["parquet"] = parquet_data.getvalue()
+    return esportazioni
+
 # ======================================================================
 # FUNZIONE PREPARAZIONE EXPORT
 # ======================================================================
 
-def prepare_data_entry_export(griglia_colli, griglia_peso, partite_df):
+def prepare_data_entry_export_da_risultato(risultato):
     """
-    Prepara il DataFrame in formato "lungo", ottimizzato per il data entry.
-    Gestisce dinamicamente le colonne (Classico vs Avanzato).
+    Prepara il DataFrame in formato "lungo", ottimizzato per il data entry, dalle
+    allocazioni sparse di un RisultatoA3 (per posizione: TARIC/MRN duplicati restano
+    distinti). Gestisce dinamicamente le colonne (Classico vs Avanzato).
     """
-    
+    mask = (np.abs(risultato.colli) > 0.01) | (np.abs(risultato.peso) > 0.001)
+    return _formato_lungo(
+        risultato.voci["nome"].to_numpy(), risultato.righe[mask], risultato.colonne[mask],
+        risultato.colli[mask].astype(float), risultato.peso[mask], risultato.partite
+    )
+
+
+def _formato_lungo(nomi_voci, righe, colonne, colli, peso, partite_df):
+    """Formato lungo dalle allocazioni non vuote (voce righe[k] <- partita colonne[k])."""
     # 1. Determina il modo (Classico vs Avanzato)
-    is_avanzato = (partite_df['nome'] != partite_df['Contenitore']).any()
+    # (confronto sui valori: le chiavi possono essere categoriche con categorie diverse)
+    is_avanzato = (partite_df['nome'].to_numpy() != partite_df['Contenitore'].to_numpy()).any()
     
     # 2. Imposta il nome della colonna "Partita"
     if is_avanzato:
@@ -295,27 +439,13 @@ def prepare_data_entry_export(griglia_colli, griglia_peso, partite_df):
     else:
         partita_col_name = 'Contenitore' # Nel modo Classico, 'nome' è il contenitore
 
-    # 3. Mappe (necessarie solo in modo Avanzato)
-    if is_avanzato:
-        mrn_to_container_map = partite_df.set_index('nome')['Contenitore'].to_dict()
-        if 'MRN-S' in partite_df.columns:
-            mrn_to_mrns_map = partite_df.set_index('nome')['MRN-S'].to_dict()
-        else:
-            mrn_to_mrns_map = {} # MRN-S non fornito
-
-    # 4. Resetta indici
-    df_c = griglia_colli.reset_index().rename(columns={'nome': 'Voce Doganale (H1)'})
-    df_p = griglia_peso.reset_index().rename(columns={'nome': 'Voce Doganale (H1)'})
-    
-    # 5. Melt usando il nome colonna dinamico
-    df_c = df_c.melt(id_vars=['Voce Doganale (H1)'], var_name=partita_col_name, value_name='Colli Allocati')
-    df_p = df_p.melt(id_vars=['Voce Doganale (H1)'], var_name=partita_col_name, value_name='Peso Allocato')
-    
-    # 6. Unisci i dati
-    df_merged = pd.merge(df_c, df_p, on=['Voce Doganale (H1)', partita_col_name])
-    
-    # 7. Filtra righe vuote
-    df_merged = df_merged[ (df_merged['Colli Allocati'].abs() > 0.01) | (df_merged['Peso Allocato'].abs() > 0.001) ]
+    # 3. Costruisci il formato lungo direttamente dagli array (per posizione)
+    df_merged = pd.DataFrame({
+        'Voce Doganale (H1)': nomi_voci[righe],
+        partita_col_name: partite_df['nome'].to_numpy()[colonne],
+        'Colli Allocati': colli,
+        'Peso Allocato': peso,
+    })
 
     # 8. Pulisci e formatta i valori
     # Arrotonda a 3 decimali per coerenza con il solver
@@ -324,10 +454,16 @@ def prepare_data_entry_export(griglia_colli, griglia_peso, partite_df):
     
     # 9. Aggiungi colonne extra e definisci l'ordine finale
     if is_avanzato:
-        df_merged['Contenitore'] = df_merged[partita_col_name].map(mrn_to_container_map)
-        df_merged['MRN-S'] = df_merged[partita_col_name].map(mrn_to_mrns_map)
-        
-        df_final = df_merged.sort_values(by=['Voce Doganale (H1)', 'Contenitore', partita_col_name]).reset_index(drop=True)
+        df_merged['Contenitore'] = partite_df['Contenitore'].to_numpy()[colonne]
+        if 'MRN-S' in partite_df.columns:
+            df_merged['MRN-S'] = partite_df['MRN-S'].to_numpy()[colonne]
+        else:
+            df_merged['MRN-S'] = None # MRN-S non fornito
+
+        # Ordinamento stabile: a parità di etichetta resta l'ordine posizionale
+        df_final = df_merged.sort_values(
+            by=['Voce Doganale (H1)', 'Contenitore', partita_col_name], kind='stable'
+        ).reset_index(drop=True)
         
         # Ordine colonne finale Avanzato
         col_order = ['Voce Doganale (H1)', 'Contenitore', 'Partita A3/MRN', 'MRN-S', 'Colli Allocati', 'Peso Allocato']
@@ -338,7 +474,9 @@ def prepare_data_entry_export(griglia_colli, griglia_peso, partite_df):
             if 'MRN-S' in col_order: col_order.remove('MRN-S')
             
     else: # Classico
-        df_final = df_merged.sort_values(by=['Voce Doganale (H1)', partita_col_name]).reset_index(drop=True)
+        df_final = df_merged.sort_values(
+            by=['Voce Doganale (H1)', partita_col_name], kind='stable'
+        ).reset_index(drop=True)
         # Ordine colonne finale Classico
         col_order = ['Voce Doganale (H1)', 'Contenitore', 'Colli Allocati', 'Peso Allocato']
 
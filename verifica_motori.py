@@ -0,0 +1,285 @@
+# verifica_motori.py
+
+# Verifica differenziale dei motori di allocazione rispetto alla cascata di riferimento
+# (SolverA3.risolvi). Genera casi casuali e "ostili" (colli a zero, righe solo peso,
+# pesi al limite dell'arrotondamento, nomi duplicati, offerta scarsa o in eccesso),
+# esegue ogni motore e confronta griglie, residui e tempi.
+# Per ogni discrepanza stampa un caso minimo che la riproduce.
+#
+# Uso: python verifica_motori.py [--casi 500] [--seme 0] [--max-righe 40] [--uscita cartella]
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from core_logic import (
+    SolverA3, colli_array, compatta_tabella_solver, peso_array,
+    risolvi_a3, risolvi_a3_min_righe, risolvi_a3_streaming
+)
+
+TOLLERANZA_RESIDUI = 1e-6
+
+# Pesi "al limite": mezzi grammi, somme float inesatte, quasi zero, valori grandi
+PESI_LIMITE = [0.0005, 0.0004999, 0.0015, 0.1 + 0.2, 1.0005, 2.675, 1e-9, 12345.6785, 9999999.999]
+
+
+# --- MOTORI ---
+
+def _griglie_riferimento(voci, partite):
+    solver = SolverA3(voci, partite)
+    griglia_colli, griglia_peso = solver.risolvi()
+    return (
+        griglia_colli.to_numpy(), griglia_peso.to_numpy(),
+        solver.partite_colli_disponibili, solver.partite_peso_disponibili
+    )
+
+
+def _griglie_risultato(risultato):
+    griglia_colli, griglia_peso = risultato.griglie()
+    return (
+        griglia_colli.to_numpy(), griglia_peso.to_numpy(),
+        risultato.partite_colli_residui, risultato.partite_peso_residui
+    )
+
+
+# nome -> (funzione(voci, partite) -> (colli, peso, colli_residui, peso_residui), deve coincidere?)
+# I motori "esatti" devono dare le stesse griglie della cascata; gli altri solo le stesse
+# proprietà (capacità, quadratura per voce).
+MOTORI = {
+    "risolvi_a3": (lambda v, p: _griglie_risultato(risolvi_a3(v, p)), True),
+    "streaming (blocchi da 1)": (lambda v, p: _griglie_risultato(risolvi_a3_streaming(v, p, dimensione_blocco=1)), True),
+    "streaming (blocchi da 7)": (lambda v, p: _griglie_risultato(risolvi_a3_streaming(v, p, dimensione_blocco=7)), True),
+    "min_righe (budget 0)": (lambda v, p: _griglie_risultato(risolvi_a3_min_righe(v, p, budget_secondi=0)[0]), True),
+    "min_righe (budget 0.05 s)": (lambda v, p: _griglie_risultato(risolvi_a3_min_righe(v, p, budget_secondi=0.05)[0]), False),
+}
+
+
+# --- GENERAZIONE DEI CASI ---
+
+def _nomi(generatore, prefisso, n, duplicati):
+    distinti = max(1, n // 3) if duplicati else n
+    return [f"{prefisso}{generatore.integers(0, distinti)}" for _ in range(n)]
+
+
+def _valori(generatore, n, tipo):
+    colli = generatore.integers(0, 40, n).astype(float)
+    peso = generatore.integers(0, 40000, n) / 1000
+    if tipo == "colli_zero":
+        colli[generatore.random(n) < 0.5] = 0
+    elif tipo == "solo_peso":
+        colli[:] = 0
+    elif tipo == "solo_colli":
+        peso[:] = 0
+    elif tipo == "pesi_limite":
+        peso = generatore.choice(PESI_LIMITE, n) + generatore.integers(0, 3, n)
+    return colli, peso
+
+
+def genera_caso(generatore, max_righe):
+    """Coppia (voci, partite) in colonne del solver, con caratteristiche scelte a caso."""
+    n_voci = int(generatore.integers(1, max_righe + 1))
+    n_partite = int(generatore.integers(1, max_righe + 1))
+    tipo = generatore.choice(["casuale", "colli_zero", "solo_peso", "solo_colli", "pesi_limite"])
+    duplicati = bool(generatore.random() < 0.5)
+
+    voci_colli, voci_peso = _valori(generatore, n_voci, tipo)
+    offerta = generatore.choice(["bilanciata", "scarsa", "abbondante", "casuale"])
+    if offerta == "casuale":
+        partite_colli, partite_peso = _valori(generatore, n_partite, tipo)
+    else:
+        # Spezza i totali delle voci sulle partite (con un fattore per scarsa/abbondante)
+        fattore = {"bilanciata": 1.0, "scarsa": 0.7, "abbondante": 1.4}[offerta]
+        quote = generatore.dirichlet(np.ones(n_partite))
+        partite_colli = np.floor(quote * voci_colli.sum() * fattore)
+        partite_colli[-1] += max(0, round(voci_colli.sum() * fattore) - partite_colli.sum())
+        partite_peso = np.round(quote * voci_peso.sum() * fattore, 3)
+        partite_peso[-1] = max(0.0, round(voci_peso.sum() * fattore - partite_peso[:-1].sum(), 3))
+
+    voci = pd.DataFrame({
+        "nome": _nomi(generatore, "V", n_voci, duplicati),
+        "colli": voci_colli,
+        "peso": voci_peso,
+    })
+    partite = pd.DataFrame({
+        "nome": _nomi(generatore, "M", n_partite, duplicati),
+        "colli": partite_colli,
+        "peso": partite_peso,
+        "Contenitore": _nomi(generatore, "C", n_partite, True),
+        "MRN-S": None,
+    })
+    # Metà dei casi nel formato compatto dell'app (peso in grammi), metà con peso float
+    if generatore.random() < 0.5:
+        voci, partite = compatta_tabella_solver(voci), compatta_tabella_solver(partite)
+    return voci, partite, f"{tipo}/{offerta}{'/duplicati' if duplicati else ''}"
+
+
+# --- CONFRONTI ---
+
+def _proprieta(voci, partite, colli, peso, colli_residui, peso_residui):
+    """Invarianti valide per qualunque motore. Restituisce l'elenco dei problemi."""
+    problemi = []
+    capacita_colli, capacita_peso = colli_array(partite), peso_array(partite)
+    if (colli < 0).any() or (peso < 0).any():
+        problemi.append("allocazioni negative")
+    if not np.array_equal(colli, np.round(colli)):
+        problemi.append("colli non interi")
+    if (colli.sum(axis=0) > np.maximum(capacita_colli, 0) + TOLLERANZA_RESIDUI).any():
+        problemi.append("colli oltre la capacità di una partita")
+    if (peso.sum(axis=0) > np.maximum(capacita_peso, 0) + 0.0005).any():
+        problemi.append("peso oltre la capacità di una partita")
+    if (colli.sum(axis=1) > np.maximum(np.round(colli_array(voci)), 0) + TOLLERANZA_RESIDUI).any():
+        problemi.append("colli oltre il fabbisogno di una voce")
+    if (peso.sum(axis=1) > np.maximum(np.round(peso_array(voci), 3), 0) + 0.0005).any():
+        problemi.append("peso oltre il fabbisogno di una voce")
+    if not np.allclose(colli_residui, capacita_colli - colli.sum(axis=0), atol=TOLLERANZA_RESIDUI):
+        problemi.append("residui colli incoerenti")
+    if not np.allclose(peso_residui, capacita_peso - peso.sum(axis=0), atol=0.0005):
+        problemi.append("residui peso incoerenti")
+    return problemi
+
+
+def confronta(voci, partite, nome_motore, riferimento=None):
+    """
+    Problemi del motore rispetto alla cascata di riferimento (lista vuota = ok)
+    e secondi impiegati dal solo motore: (problemi, secondi).
+    """
+    funzione, esatto = MOTORI[nome_motore]
+    if riferimento is None:
+        riferimento = _griglie_riferimento(voci, partite)
+    inizio = time.perf_counter()
+    try:
+        colli, peso, colli_residui, peso_residui = funzione(voci, partite)
+    except Exception as e:
+        return [f"eccezione: {type(e).__name__}: {e}"], time.perf_counter() - inizio
+    secondi = time.perf_counter() - inizio
+
+    problemi = _proprieta(voci, partite, colli, peso, colli_residui, peso_residui)
+    rif_colli, rif_peso, rif_colli_residui, rif_peso_residui = riferimento
+    if esatto:
+        if not np.array_equal(colli, rif_colli):
+            problemi.append("griglia colli diversa")
+        if not np.array_equal(peso, rif_peso):
+            problemi.append("griglia peso diversa")
+        if not (
+            np.allclose(colli_residui, rif_colli_residui, atol=TOLLERANZA_RESIDUI)
+            and np.allclose(peso_residui, rif_peso_residui, atol=TOLLERANZA_RESIDUI)
+        ):
+            problemi.append("residui diversi")
+    else:
+        # Stessa quadratura per voce della cascata, mai più righe
+        if not np.array_equal(colli.sum(axis=1), rif_colli.sum(axis=1)):
+            problemi.append("colli per voce diversi dalla cascata")
+        if not np.allclose(peso.sum(axis=1), rif_peso.sum(axis=1), atol=0.0005):
+            problemi.append("peso per voce diverso dalla cascata")
+        if np.count_nonzero((colli != 0) | (peso != 0)) > np.count_nonzero((rif_colli != 0) | (rif_peso != 0)):
+            problemi.append("più righe della cascata")
+    return problemi, secondi
+
+
+# --- MINIMIZZAZIONE DEL CASO ---
+
+def minimizza(voci, partite, nome_motore):
+    """
+    Riduce un caso che fallisce togliendo righe (voci e partite) e semplificando
+    i nomi finché il motore continua a fallire. Restituisce (voci, partite).
+    """
+    def fallisce(v, p):
+        return bool(confronta(v.reset_index(drop=True), p.reset_index(drop=True), nome_motore)[0])
+
+    cambiato = True
+    while cambiato:
+        cambiato = False
+        for tabella in ("voci", "partite"):
+            k = 0
+            while k < len(voci if tabella == "voci" else partite):
+                corrente = voci if tabella == "voci" else partite
+                if len(corrente) == 1:
+                    break
+                ridotta = corrente.drop(corrente.index[k])
+                prova = (ridotta, partite) if tabella == "voci" else (voci, ridotta)
+                if fallisce(*prova):
+                    voci, partite = prova
+                    cambiato = True
+                else:
+                    k += 1
+
+    # Nomi distinti e leggibili, se il difetto non dipende dai duplicati
+    for tabella, prefisso in (("voci", "V"), ("partite", "M")):
+        corrente = (voci if tabella == "voci" else partite).copy()
+        corrente["nome"] = [f"{prefisso}{k}" for k in range(len(corrente))]
+        prova = (corrente, partite) if tabella == "voci" else (voci, corrente)
+        if fallisce(*prova):
+            voci, partite = prova
+    return voci.reset_index(drop=True), partite.reset_index(drop=True)
+
+
+def _tabella_riproducibile(df):
+    colonne = {}
+    for c in df.columns:
+        valori = df[c].astype(object).where(df[c].notna(), None).tolist()
+        colonne[c] = [v.item() if isinstance(v, np.generic) else v for v in valori]
+    return colonne
+
+
+# --- ESECUZIONE ---
+
+def esegui(casi=500, seme=0, max_righe=40, uscita=None):
+    generatore = np.random.default_rng(seme)
+    tempi = {"cascata (riferimento)": 0.0, **{nome: 0.0 for nome in MOTORI}}
+    discrepanze = []
+
+    for n in range(casi):
+        voci, partite, descrizione = genera_caso(generatore, max_righe)
+
+        inizio = time.perf_counter()
+        riferimento = _griglie_riferimento(voci, partite)
+        tempi["cascata (riferimento)"] += time.perf_counter() - inizio
+
+        for nome_motore in MOTORI:
+            problemi, secondi = confronta(voci, partite, nome_motore, riferimento)
+            tempi[nome_motore] += secondi
+            if problemi:
+                voci_min, partite_min = minimizza(voci, partite, nome_motore)
+                discrepanze.append({
+                    "caso": n,
+                    "descrizione": descrizione,
+                    "motore": nome_motore,
+                    "problemi": problemi,
+                    "voci": _tabella_riproducibile(voci_min),
+                    "partite": _tabella_riproducibile(partite_min),
+                })
+
+    print(f"{casi} casi (seme {seme}, fino a {max_righe} righe per tabella)")
+    for nome, secondi in tempi.items():
+        print(f"  {nome:<28} {secondi:8.3f} s")
+
+    if not discrepanze:
+        print("Nessuna discrepanza.")
+        return 0
+
+    print(f"{len(discrepanze)} DISCREPANZE:")
+    for d in discrepanze[:10]:
+        print(f"- caso {d['caso']} ({d['descrizione']}), {d['motore']}: {', '.join(d['problemi'])}")
+        print(f"  voci = pd.DataFrame({d['voci']})")
+        print(f"  partite = pd.DataFrame({d['partite']})")
+    if uscita:
+        os.makedirs(uscita, exist_ok=True)
+        with open(os.path.join(uscita, "discrepanze.json"), "w", encoding="utf-8") as f:
+            json.dump(discrepanze, f, indent=2, ensure_ascii=False)
+        print(f"Dettagli in {os.path.join(uscita, 'discrepanze.json')}")
+    return 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Verifica differenziale dei motori SolverA3")
+    parser.add_argument("--casi", type=int, default=500)
+    parser.add_argument("--seme", type=int, default=0)
+    parser.add_argument("--max-righe", type=int, default=40)
+    parser.add_argument("--uscita", default=None, help="Cartella in cui salvare i casi minimi (JSON)")
+    argomenti = parser.parse_args()
+    sys.exit(esegui(argomenti.casi, argomenti.seme, argomenti.max_righe, argomenti.uscita))